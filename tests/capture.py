@@ -0,0 +1,237 @@
+"""Reader of host-side USB captures for trace-driven replay
+
+Reads pcap and pcapng files captured on the host: usbmon on Linux (link
+types 189 and 220, also written by the `decode` target) and USBPcap on
+Windows (link type 249). Submissions are paired with their completions into
+URBs holding the setup packet, the data sent by the host, the data returned
+by the device and how the transfer ended. Captures are transfer-level, so
+the replay rebuilds the token and data packets of every URB.
+
+The module has no cocotb dependency so tools can read captures too.
+"""
+
+import struct
+from collections import Counter
+
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+LINKTYPE_USBPCAP = 249
+
+# Transfer types, the same in usbmon and USBPcap
+ISOCHRONOUS, INTERRUPT, CONTROL, BULK = range(4)
+TRANSFER_NAMES = ('isochronous', 'interrupt', 'control', 'bulk')
+
+# How a transfer ended
+OK, STALL, ERROR = 'ok', 'stall', 'error'
+
+# usbmon header, followed by 16 more bytes in the mmapped variant
+USBMON = struct.Struct('<QBBBBHBBqiiII8s')
+EPIPE = -32
+# USBPcap header, followed by the stage of control transfers
+USBPCAP = struct.Struct('<HQIHBHHBBI')
+USBD_STATUS_STALL_PID = 0xc0000004
+STAGE_SETUP, STAGE_DATA, STAGE_STATUS, STAGE_COMPLETE = range(4)
+
+
+class CaptureError(Exception):
+    pass
+
+
+class Urb:
+    """One transfer of the capture, `time` being its submission in s"""
+
+    def __init__(self, time, bus, device, endpoint, transfer, setup=None,
+                 data=b'', length=None):
+        self.time = time
+        self.bus = bus
+        self.device = device
+        # Endpoint address, bit 7 set for IN
+        self.endpoint = endpoint
+        self.transfer = transfer
+        self.setup = setup
+        self.data = data
+        # Length requested by the host, None if the capture does not say
+        self.length = length
+        self.response = b''
+        # OK, STALL, ERROR, or None if the capture has no completion
+        self.status = None
+
+    @property
+    def is_in(self):
+        if self.setup is not None:
+            return bool(self.setup[0] & 0x80)
+        return bool(self.endpoint & 0x80)
+
+    def __repr__(self):
+        request = " setup {}".format(self.setup.hex()) if self.setup else ""
+        return "{:.6f} s {}.{} EP{} {} {}{}".format(
+            self.time, self.bus, self.device, self.endpoint & 0xf,
+            "IN" if self.is_in else "OUT", TRANSFER_NAMES[self.transfer],
+            request)
+
+
+def _records(f):
+    """Yields (link type, time in s, bytes) of the packets of a pcap or
+    pcapng file"""
+    magic = f.read(4)
+    if magic == b'\x0a\x0d\x0d\x0a':
+        yield from _pcapng_records(f)
+        return
+    for order in '<>':
+        value = struct.unpack(order + 'I', magic)[0]
+        if value in (0xa1b2c3d4, 0xa1b23c4d):
+            break
+    else:
+        raise CaptureError("not a pcap or pcapng file")
+    resolution = 1e-6 if value == 0xa1b2c3d4 else 1e-9
+    link_type = struct.unpack(order + 'HHiIII', f.read(20))[5]
+    record = struct.Struct(order + 'IIII')
+    while True:
+        data = f.read(record.size)
+        if len(data) < record.size:
+            return
+        seconds, fraction, captured, _ = record.unpack(data)
+        yield link_type, seconds + fraction * resolution, f.read(captured)
+
+
+def _pcapng_records(f):
+    # The section header block was started by the caller
+    order = '<'
+    interfaces = []
+    block_type = 0x0a0d0d0a
+    while True:
+        if block_type is None:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            block_type = struct.unpack(order + 'I', header[:4])[0]
+            length_bytes = header[4:]
+        else:
+            length_bytes = f.read(4)
+        if block_type == 0x0a0d0d0a:
+            magic = f.read(4)
+            order = '<' if magic == b'\x4d\x3c\x2b\x1a' else '>'
+            length = struct.unpack(order + 'I', length_bytes)[0]
+            body = f.read(length - 12)
+            interfaces = []
+        else:
+            length = struct.unpack(order + 'I', length_bytes)[0]
+            body = f.read(length - 8)
+        body = body[:-4]
+        if block_type == 1:
+            # Interface description: link type and timestamp resolution
+            link_type = struct.unpack(order + 'H', body[:2])[0]
+            resolution = 1e-6
+            offset = 8
+            while offset + 4 <= len(body):
+                code, size = struct.unpack(order + 'HH',
+                                           body[offset:offset + 4])
+                if code == 0:
+                    break
+                if code == 9:
+                    value = body[offset + 4]
+                    resolution = 2 ** -(value & 0x7f) if value & 0x80 else \
+                        10 ** -value
+                offset += 4 + (size + 3) // 4 * 4
+            interfaces.append((link_type, resolution))
+        elif block_type == 6:
+            # Enhanced packet
+            interface, high, low, captured = struct.unpack(order + 'IIII',
+                                                           body[:16])
+            link_type, resolution = interfaces[interface]
+            yield (link_type, (high << 32 | low) * resolution,
+                   body[20:20 + captured])
+        block_type = None
+
+
+def _usbmon_urbs(records):
+    pending = {}
+    for link_type, time, data in records:
+        header_size = 64 if link_type == LINKTYPE_USB_LINUX_MMAPPED else 48
+        (urb_id, event, transfer, endpoint, device, bus, flag_setup, _,
+         _, _, status, length, _, setup) = USBMON.unpack(
+             data[:USBMON.size])
+        payload = data[header_size:]
+        if event == ord('S'):
+            urb = Urb(time, bus, device, endpoint, transfer,
+                      setup if transfer == CONTROL and flag_setup == 0
+                      else None, length=length)
+            if not urb.is_in:
+                urb.data = payload
+            pending[urb_id] = urb
+            yield urb
+            continue
+        urb = pending.pop(urb_id, None)
+        if urb is None:
+            continue
+        if event == ord('C') and status == 0:
+            urb.status = OK
+            if urb.is_in:
+                urb.response = payload
+        else:
+            urb.status = STALL if status == EPIPE else ERROR
+
+
+def _usbpcap_urbs(records):
+    pending = {}
+    for _, time, data in records:
+        (header_size, irp, status, _, info, bus, device, endpoint, transfer,
+         _) = USBPCAP.unpack(data[:USBPCAP.size])
+        stage = data[USBPCAP.size] if transfer == CONTROL else None
+        payload = data[header_size:]
+        from_device = info & 1
+        urb = pending.get(irp)
+        if not from_device:
+            if stage in (None, STAGE_SETUP):
+                urb = Urb(time, bus, device, endpoint, transfer,
+                          payload[:8] if stage == STAGE_SETUP else None)
+                if stage is None and not urb.is_in:
+                    urb.data = payload
+                pending[irp] = urb
+                yield urb
+            elif urb is not None and stage == STAGE_DATA:
+                urb.data = payload
+            continue
+        if urb is None:
+            continue
+        if status == 0:
+            if urb.is_in and payload:
+                urb.response = payload
+        else:
+            urb.status = STALL if status == USBD_STATUS_STALL_PID else ERROR
+        if stage in (None, STAGE_COMPLETE) or status != 0:
+            if urb.status is None:
+                urb.status = OK
+            del pending[irp]
+
+
+def read_capture(path):
+    """Returns the URBs of a capture, in submission order"""
+    with open(path, 'rb') as f:
+        records = list(_records(f))
+    if not records:
+        return []
+    link_types = {link_type for link_type, _, _ in records}
+    if link_types <= {LINKTYPE_USB_LINUX, LINKTYPE_USB_LINUX_MMAPPED}:
+        return list(_usbmon_urbs(records))
+    if link_types == {LINKTYPE_USBPCAP}:
+        return list(_usbpcap_urbs(records))
+    raise CaptureError("unsupported link type {}".format(
+        ", ".join(str(t) for t in sorted(link_types))))
+
+
+def select_device(urbs, device=None):
+    """URBs of one device, given as `bus.address`, by default the one with
+    the most URBs. URBs to address 0 on its bus come along, they are the
+    ones sent before it got its address."""
+    if device is None:
+        counts = Counter((urb.bus, urb.device) for urb in urbs
+                         if urb.device != 0)
+        if not counts:
+            return urbs
+        bus, device = counts.most_common(1)[0][0]
+    else:
+        bus, _, device = device.rpartition('.')
+        bus, device = int(bus or 0), int(device)
+    return [urb for urb in urbs if urb.bus == bus and
+            urb.device in (0, device)]
@@ -0,0 +1,244 @@
+"""Functional coverage of the bus traffic
+
+Counts, in fixed-size arrays filled from the bus monitor callback:
+
+- response: token PID x endpoint x device answer (NONE when the host went
+  on without one),
+- toggle: direction x endpoint x DATA0/DATA1 of consecutive data packets,
+- descriptor: descriptor type x wLength range of GET_DESCRIPTOR requests,
+- state: device state transitions caused by SET_ADDRESS,
+  SET_CONFIGURATION and port resets.
+
+Only the traffic of the device under test is counted: tokens for other
+addresses, and the packets of their transactions, are skipped. The device
+address follows the SET_ADDRESS requests, from the end of their status
+stage, and port resets.
+
+The counts of all tests of a simulation are saved to one file per process
+after every test. tools/coverage.py merges the files of all runs and lists
+the bins never hit. The module has no cocotb dependency so the tool can use
+the bin definitions.
+"""
+
+import json
+import os
+from array import array
+
+# PID values, see cocotb_usb.usb.pid
+OUT, IN, SOF, SETUP = 0x1, 0x9, 0x5, 0xd
+DATA0, DATA1 = 0x3, 0xb
+ACK, NAK, STALL = 0x2, 0xa, 0xe
+
+TOKENS = ('OUT', 'IN', 'SETUP')
+TOKEN_INDEX = {OUT: 0, IN: 1, SETUP: 2}
+RESPONSES = ('ACK', 'NAK', 'STALL', 'DATA0', 'DATA1', 'NONE')
+RESPONSE_INDEX = {ACK: 0, NAK: 1, STALL: 2, DATA0: 3, DATA1: 4}
+NONE = 5
+ENDPOINTS = 16
+DIRECTIONS = ('out', 'in')
+TOGGLES = ('DATA0>DATA0', 'DATA0>DATA1', 'DATA1>DATA0', 'DATA1>DATA1')
+DESCRIPTOR_TYPES = 16
+LENGTHS = ((0, 0), (1, 8), (9, 18), (19, 64), (65, 255), (256, 0xffff))
+STATES = ('default', 'address', 'configured')
+DEFAULT, ADDRESS, CONFIGURED = range(len(STATES))
+
+GROUPS = {
+    'response': len(TOKENS) * ENDPOINTS * len(RESPONSES),
+    'toggle': len(DIRECTIONS) * ENDPOINTS * len(TOGGLES),
+    'descriptor': DESCRIPTOR_TYPES * len(LENGTHS),
+    'state': len(STATES) * len(STATES),
+}
+
+# Answers a device may give to each token
+LEGAL_RESPONSES = {
+    'OUT': ('ACK', 'NAK', 'STALL', 'NONE'),
+    'IN': ('NAK', 'STALL', 'DATA0', 'DATA1', 'NONE'),
+    'SETUP': ('ACK', 'NONE'),
+}
+# Standard descriptor types hosts request
+REQUESTED_TYPES = {1: 'device', 2: 'configuration', 3: 'string',
+                   6: 'device_qualifier'}
+LEGAL_TRANSITIONS = (
+    ('default', 'address'),
+    ('address', 'configured'),
+    ('configured', 'address'),
+    ('configured', 'configured'),
+    ('address', 'default'),
+    ('configured', 'default'),
+)
+
+
+def bin_name(group, index):
+    """Readable name of bin `index` of `group`"""
+    if group == 'response':
+        token, rest = divmod(index, ENDPOINTS * len(RESPONSES))
+        endpoint, response = divmod(rest, len(RESPONSES))
+        return "{} EP{} {}".format(TOKENS[token], endpoint,
+                                   RESPONSES[response])
+    if group == 'toggle':
+        direction, rest = divmod(index, ENDPOINTS * len(TOGGLES))
+        endpoint, toggle = divmod(rest, len(TOGGLES))
+        return "EP{} {} {}".format(endpoint, DIRECTIONS[direction].upper(),
+                                   TOGGLES[toggle])
+    if group == 'descriptor':
+        kind, length = divmod(index, len(LENGTHS))
+        low, high = LENGTHS[length]
+        return "{} wLength {}-{}".format(
+            REQUESTED_TYPES.get(kind, 'type {}'.format(kind)), low, high)
+    old, new = divmod(index, len(STATES))
+    return "{} > {}".format(STATES[old], STATES[new])
+
+
+def legal_bins(group, endpoints):
+    """Indices of the bins of `group` that can be hit by a device using
+    `endpoints` ({(number, direction)}, EP0 included)"""
+    bins = []
+    for index in range(GROUPS[group]):
+        if group == 'response':
+            token, rest = divmod(index, ENDPOINTS * len(RESPONSES))
+            endpoint, response = divmod(rest, len(RESPONSES))
+            direction = 'in' if TOKENS[token] == 'IN' else 'out'
+            if (TOKENS[token] == 'SETUP' and endpoint != 0) or \
+                    (endpoint, direction) not in endpoints or \
+                    RESPONSES[response] not in \
+                    LEGAL_RESPONSES[TOKENS[token]]:
+                continue
+        elif group == 'toggle':
+            direction, rest = divmod(index, ENDPOINTS * len(TOGGLES))
+            endpoint = rest // len(TOGGLES)
+            if (endpoint, DIRECTIONS[direction]) not in endpoints:
+                continue
+        elif group == 'descriptor':
+            if index // len(LENGTHS) not in REQUESTED_TYPES:
+                continue
+        else:
+            old, new = divmod(index, len(STATES))
+            if (STATES[old], STATES[new]) not in LEGAL_TRANSITIONS:
+                continue
+        bins.append(index)
+    return bins
+
+
+def _length_bin(length):
+    for i, (low, high) in enumerate(LENGTHS):
+        if low <= length <= high:
+            return i
+    return len(LENGTHS) - 1
+
+
+class Coverage:
+    def __init__(self, filename):
+        self.filename = filename
+        self.counts = {name: array('L', [0]) * size
+                       for name, size in GROUPS.items()}
+        self.tests = 0
+        self._start_test()
+
+    def _start_test(self):
+        # Response bin base of the token waiting for an answer
+        self._pending = None
+        self._token = None
+        self._endpoint = 0
+        # Last data PID per direction and endpoint, -1 if none
+        self._toggles = array('b', [-1]) * (len(DIRECTIONS) * ENDPOINTS)
+        self.state = DEFAULT
+        self.address = 0
+        # Address of a SET_ADDRESS waiting for its status stage
+        self._new_address = None
+
+    def attach(self, harness):
+        """Follow the traffic of a new test"""
+        self._start_test()
+        harness.monitor.callbacks.append(self.packet)
+        port_reset = harness.port_reset
+
+        def wrapper(*args, **kwargs):
+            self._transition(DEFAULT)
+            self.address = 0
+            self._new_address = None
+            return port_reset(*args, **kwargs)
+
+        harness.port_reset = wrapper
+
+    def _transition(self, state):
+        self.counts['state'][self.state * len(STATES) + state] += 1
+        self.state = state
+
+    def _toggle(self, direction, pid):
+        index = direction * ENDPOINTS + self._endpoint
+        current = 1 if pid == DATA1 else 0
+        last = self._toggles[index]
+        if last >= 0:
+            self.counts['toggle'][index * len(TOGGLES) + last * 2 +
+                                  current] += 1
+        self._toggles[index] = current
+
+    def _setup(self, data):
+        if len(data) < 8:
+            return
+        value = data[2] | data[3] << 8
+        length = data[6] | data[7] << 8
+        # A new SETUP aborts a SET_ADDRESS still in its status stage
+        self._new_address = None
+        if data[0] == 0x80 and data[1] == 6:
+            kind = min(value >> 8, DESCRIPTOR_TYPES - 1)
+            self.counts['descriptor'][kind * len(LENGTHS) +
+                                      _length_bin(length)] += 1
+        elif data[0] == 0x00 and data[1] == 5:
+            self._transition(ADDRESS if value else DEFAULT)
+            self._new_address = value & 0x7f
+        elif data[0] == 0x00 and data[1] == 9:
+            self._transition(CONFIGURED if value else ADDRESS)
+        # A SETUP starts the toggles of EP0 over
+        self._toggles[self._endpoint] = -1
+        self._toggles[ENDPOINTS + self._endpoint] = -1
+
+    def packet(self, packet):
+        """Bus monitor callback"""
+        if not packet.valid:
+            return
+        pid = packet.pid
+        if packet.device:
+            if self._pending is not None and pid in RESPONSE_INDEX:
+                self.counts['response'][self._pending +
+                                        RESPONSE_INDEX[pid]] += 1
+                self._pending = None
+            if self._token == IN and pid in (DATA0, DATA1):
+                self._toggle(1, pid)
+                if self._endpoint == 0 and len(packet.data) == 2 and \
+                        self._new_address is not None:
+                    # Status stage of SET_ADDRESS, the address applies
+                    # from now on
+                    self.address = self._new_address
+                    self._new_address = None
+            return
+        if pid in TOKEN_INDEX or pid == SOF:
+            if self._pending is not None:
+                self.counts['response'][self._pending + NONE] += 1
+                self._pending = None
+            if pid == SOF or packet.addr != self.address:
+                # Data and answers up to the next token are not ours
+                self._token = None
+                return
+            self._token = pid
+            self._endpoint = packet.endp
+            self._pending = (TOKEN_INDEX[pid] * ENDPOINTS + packet.endp) * \
+                len(RESPONSES)
+        elif pid in (DATA0, DATA1):
+            if self._token == OUT:
+                self._toggle(0, pid)
+            elif self._token == SETUP:
+                # Strip CRC16
+                self._setup(packet.data[:-2])
+
+    def save(self, result=None):
+        """Write the counts of all tests so far"""
+        self.tests += 1
+        os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+        with open(self.filename, 'w') as f:
+            json.dump({
+                'target': os.getenv('TARGET', ''),
+                'tests': self.tests,
+                'counts': {name: list(counts)
+                           for name, counts in self.counts.items()},
+            }, f)
@@ -0,0 +1,134 @@
+"""Enumeration latency of the host OS profiles
+
+Measures the simulated time from the first connect to the end of
+SET_CONFIGURATION and, for every standard request issued in between, its
+duration and the number of times the device answered NAK. The results are
+attached to results.xml and, when ENUMERATION_HISTORY names a file,
+appended to it, see tools/enumeration.py.
+"""
+
+import datetime
+import json
+import os
+
+import cocotb
+from cocotb.utils import get_sim_time
+from cocotb_usb.usb.pid import PID
+
+from tests.harness import at_test_end
+from tests.monitor import UsbMonitor
+
+# Harness methods timed as one request each
+REQUESTS = (
+    'get_device_descriptor',
+    'get_configuration_descriptor',
+    'get_string_descriptor',
+    'get_device_qualifier',
+    'set_device_address',
+    'set_configuration',
+    'control_transfer_in',
+    'control_transfer_out',
+)
+
+
+class EnumerationTimer:
+    def __init__(self, harness, profile, target='', history_file=None):
+        self.harness = harness
+        self.profile = profile
+        self.target = target
+        self.history_file = history_file
+        self.connected = None
+        self.configured = None
+        # [name, start in ns, duration in ns, NAKs]
+        self.requests = []
+        self._depth = 0
+
+        if harness.monitor is None:
+            harness.monitor = UsbMonitor(harness.dut)
+            harness.monitor.start()
+        self.monitor = harness.monitor
+
+        self._wrap('connect', self._connect)
+        for name in REQUESTS:
+            if hasattr(harness, name):
+                self._wrap(name, self._request)
+        at_test_end(self.report)
+
+    def _wrap(self, name, timer):
+        method = getattr(self.harness, name)
+
+        @cocotb.coroutine
+        def wrapper(*args, **kwargs):
+            result = yield timer(name, method, *args, **kwargs)
+            return result
+
+        setattr(self.harness, name, wrapper)
+
+    @cocotb.coroutine
+    def _connect(self, name, method, *args, **kwargs):
+        result = yield method(*args, **kwargs)
+        if self.connected is None:
+            self.connected = get_sim_time('ns')
+        return result
+
+    @cocotb.coroutine
+    def _request(self, name, method, *args, **kwargs):
+        # Requests call each other, only the outermost one is timed
+        self._depth += 1
+        start = get_sim_time('ns')
+        first_packet = len(self.monitor.packets)
+        try:
+            result = yield method(*args, **kwargs)
+        finally:
+            self._depth -= 1
+        if self._depth == 0:
+            naks = sum(1 for p in self.monitor.packets[first_packet:]
+                       if p.device and p.valid and p.pid == PID.NAK)
+            self.requests.append(
+                [name, start, get_sim_time('ns') - start, naks])
+            if name == 'set_configuration':
+                self.configured = get_sim_time('ns')
+        return result
+
+    def report(self, result):
+        """at_test_end() callback: appends the timings to the history file
+        and returns them as results.xml properties"""
+        if self.connected is None or self.configured is None:
+            return {}
+        requests = [r for r in self.requests if r[1] >= self.connected]
+        total_us = (self.configured - self.connected) / 1e3
+        naks = sum(r[3] for r in requests)
+        if self.history_file:
+            with open(self.history_file, 'a') as f:
+                f.write(json.dumps({
+                    'date': datetime.datetime.now().isoformat(
+                        timespec='seconds'),
+                    'target': self.target,
+                    'profile': self.profile,
+                    'test': result['test'],
+                    'enumeration_us': total_us,
+                    'naks': naks,
+                    'requests': [{'request': name,
+                                  'start_us': (start - self.connected) / 1e3,
+                                  'duration_us': duration / 1e3,
+                                  'naks': request_naks}
+                                 for name, start, duration, request_naks
+                                 in requests],
+                }) + "\n")
+
+        properties = {
+            'enumeration_profile': self.profile,
+            'enumeration_us': "{:.1f}".format(total_us),
+            'enumeration_naks': naks,
+        }
+        for i, (name, start, duration, request_naks) in enumerate(requests):
+            properties['enumeration_{:02}_{}'.format(i, name)] = \
+                "us={:.1f} naks={}".format(duration / 1e3, request_naks)
+        return properties
+
+
+def time_enumeration(harness, profile):
+    """Time the enumeration done by the current test as host `profile`"""
+    return EnumerationTimer(harness, profile,
+                            target=os.getenv('TARGET', ''),
+                            history_file=os.getenv('ENUMERATION_HISTORY'))
@@ -0,0 +1,95 @@
+"""Event-driven waits on DUT status signals
+
+Waiting on a signal edge costs neither bus cycles nor Python scheduling for
+every simulated clock, unlike polling a status register until it changes.
+
+On targets exposing the core interrupt (`usb_irq`), `use_irq()` makes the
+harness sleep on it before draining SETUP packets, where the cocotb_usb
+harness would poll the SETUP status register until data shows up.
+"""
+
+import cocotb
+from cocotb.result import TestFailure
+from cocotb.triggers import FallingEdge, First, RisingEdge, Timer
+
+# How long a drain waits for a SETUP packet that has not arrived yet
+SETUP_TIMEOUT_US = 1000
+
+
+@cocotb.coroutine
+def wait_for(signal, value=1, timeout=None, units="us", fail=True):
+    """Wait until a single-bit `signal` equals `value`.
+
+    Returns True at once if it already does. If `timeout` (in `units`)
+    passes first, fails the test, or returns False when `fail` is unset.
+    """
+    if signal.value.is_resolvable and int(signal) == value:
+        return True
+    edge = RisingEdge(signal) if value else FallingEdge(signal)
+    if timeout is None:
+        yield edge
+        return True
+    timer = Timer(timeout, units)
+    trigger = yield First(edge, timer)
+    if trigger is not timer:
+        return True
+    if fail:
+        raise TestFailure("{} did not become {} within {} {}".format(
+            signal._name, value, timeout, units))
+    return False
+
+
+@cocotb.coroutine
+def wait_irq(dut, timeout=None, units="us", fail=True):
+    """Wait for the USB interrupt of the core.
+
+    Only the sources enabled in the `*_ev_enable` registers raise it.
+    """
+    raised = yield wait_for(dut.usb_irq, 1, timeout, units, fail)
+    return raised
+
+
+def use_irq(harness):
+    """Replace the polling for SETUP packets of `drain_setup()` and
+    `expect_setup()` by a wait on the SETUP event interrupt.
+
+    Returns False, leaving the harness alone, on cores without SETUP
+    events."""
+    try:
+        # Generated from csr.csv when building dut.v
+        from regmap import USB_SETUP_EV_ENABLE, USB_SETUP_EV_PENDING
+    except ImportError:
+        return False
+
+    # Set while a wrapped method runs, expect_setup() may drain through
+    # drain_setup() and the packet must only be waited for once
+    draining = []
+
+    def wrap(name):
+        method = getattr(harness, name)
+
+        @cocotb.coroutine
+        def wait_then_drain(*args, **kwargs):
+            if draining:
+                result = yield method(*args, **kwargs)
+                return result
+            draining.append(name)
+            try:
+                # Pending bits latch whatever the enables, so a SETUP
+                # received earlier raises the interrupt once enabled
+                yield harness.write(USB_SETUP_EV_ENABLE, 1)
+                raised = yield wait_irq(harness.dut, SETUP_TIMEOUT_US,
+                                        fail=False)
+                if raised:
+                    # A SETUP arriving during the drain raises it again
+                    yield harness.write(USB_SETUP_EV_PENDING, 1)
+                result = yield method(*args, **kwargs)
+            finally:
+                draining.pop()
+            return result
+
+        setattr(harness, name, wait_then_drain)
+
+    wrap('drain_setup')
+    wrap('expect_setup')
+    return True
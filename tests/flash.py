@@ -0,0 +1,79 @@
+"""Behavioural model of a NOR flash
+
+Programming can only clear bits and erasing sets whole sectors back to
+0xff. Every operation returns how long a typical SPI NOR flash would be
+busy with it, so tests can account for flash time the simulated designs do
+not have.
+"""
+
+# Typical timings of a 25-series SPI NOR flash, erase times per erase size
+ERASE_US = {4096: 45000, 32768: 120000, 65536: 150000}
+PAGE_PROGRAM_US = 700
+
+
+class FlashModel:
+    def __init__(self, size=1 << 20, sector_size=4096, page_size=256,
+                 erase_us=ERASE_US, page_program_us=PAGE_PROGRAM_US):
+        self.size = size
+        self.sector_size = sector_size
+        self.page_size = page_size
+        self.erase_us = erase_us
+        self.page_program_us = page_program_us
+        self.data = bytearray(b'\xff' * size)
+        # Sectors erased since the model was created
+        self.erased = set()
+        # Total time the flash was busy
+        self.busy_us = 0
+
+    def _check(self, addr, length):
+        if addr < 0 or addr + length > self.size:
+            raise ValueError("Flash access 0x{:x}+{} out of range".format(
+                addr, length))
+
+    def read(self, addr, length):
+        self._check(addr, length)
+        return bytes(self.data[addr:addr + length])
+
+    def erase(self, addr, size=None):
+        """Erase the `size` bytes block (default: a sector) holding `addr`,
+        returns the busy time in us"""
+        size = size or self.sector_size
+        self._check(addr, 1)
+        start = addr - addr % size
+        self.data[start:start + size] = b'\xff' * size
+        for sector in range(start, start + size, self.sector_size):
+            self.erased.add(sector)
+        self.busy_us += self.erase_us[size]
+        return self.erase_us[size]
+
+    def program(self, addr, data):
+        """Program `data` within one page, returns the busy time in us"""
+        self._check(addr, len(data))
+        if addr // self.page_size != \
+                (addr + max(len(data), 1) - 1) // self.page_size:
+            # Real devices wrap around within the page
+            raise ValueError("Program at 0x{:x}+{} crosses a page".format(
+                addr, len(data)))
+        for i, byte in enumerate(data):
+            self.data[addr + i] &= byte
+        self.busy_us += self.page_program_us
+        return self.page_program_us
+
+    def write(self, addr, data):
+        """Erase the sectors not erased yet and program `data` page by page
+        the way a bootloader does. Returns the busy time in us."""
+        busy = 0
+        end = addr + len(data)
+        sector = addr - addr % self.sector_size
+        while sector < end:
+            if sector not in self.erased:
+                busy += self.erase(sector)
+            sector += self.sector_size
+        offset = addr
+        while offset < end:
+            chunk = min(end, offset - offset % self.page_size +
+                        self.page_size) - offset
+            busy += self.program(offset, data[offset - addr:
+                                              offset - addr + chunk])
+            offset += chunk
+        return busy
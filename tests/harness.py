@@ -0,0 +1,267 @@
+"""Testbench-side extensions of the cocotb_usb harness
+
+Tests get their harness from `get_harness()` in this module. It returns the
+regular cocotb_usb harness with the primitives wrapped, so that optional
+features (configured through environment variables, see README) can follow
+what every test does without changes to the tests themselves.
+"""
+
+import inspect
+import itertools
+import logging
+import os
+from collections import deque
+
+import cocotb
+from cocotb.clock import Clock
+from cocotb.regression import RegressionManager
+from cocotb.utils import get_sim_time
+from cocotb_usb import harness as usb_harness
+from cocotb_usb.device import UsbDevice
+
+from tests.coverage import Coverage
+from tests.events import use_irq
+from tests.lockstep import Lockstep
+from tests.monitor import UsbMonitor
+from tests.profiler import Profiler
+from tests.scoreboard import Scoreboard
+from tests.turnaround import LIMIT_BITS, TurnaroundCheck
+from tests.utilization import UtilizationReport
+from tests.watchdog import start_watchdog
+
+# Harness methods recorded in the transaction history
+PRIMITIVES = (
+    'host_send_token_packet',
+    'host_send_data_packet',
+    'host_send_sof',
+    'host_send_ack',
+    'host_expect_ack',
+    'host_expect_nak',
+    'host_expect_stall',
+    'host_expect_data_packet',
+    'host_recv',
+    'transaction_setup',
+    'transaction_data_in',
+    'transaction_data_out',
+    'transaction_status_in',
+    'transaction_status_out',
+    'control_transfer_in',
+    'control_transfer_out',
+    'read',
+    'write',
+)
+
+# Number of primitive calls kept for post-mortem dumps
+HISTORY_LENGTH = 32
+
+_test_end_callbacks = []
+_record_result = None
+# Coverage counts of all tests of the simulation, see tests/coverage.py
+_coverage = None
+
+
+def _hook_record_result():
+    """Hook the regression manager to run callbacks after every test"""
+    global _record_result
+    if _record_result is not None:
+        return
+    _record_result = RegressionManager._record_result
+
+    def my_record_result(self, test, outcome, wall_time_s, sim_time_ns):
+        _record_result(self, test, outcome, wall_time_s, sim_time_ns)
+        result = self.test_results[-1]
+        for callback, persistent in list(_test_end_callbacks):
+            if not persistent:
+                _test_end_callbacks.remove((callback, persistent))
+            properties = callback(result)
+            # Callbacks may annotate the test case in results.xml
+            for name, value in (properties or {}).items():
+                self.xunit.add_property(testsuite=self.xunit.last_testcase,
+                                        name=name,
+                                        value=str(value))
+
+    RegressionManager._record_result = my_record_result
+
+
+def at_test_end(callback, persistent=False):
+    """Call `callback(result)` once the currently running test finishes.
+
+    `result` is the dictionary cocotb stores in its test summary (keys
+    `test`, `pass`, `sim`, `real` and `ratio`). The callback may return a
+    dictionary of properties that get attached to the test case in
+    results.xml. Persistent callbacks are called for every following test.
+    """
+    _hook_record_result()
+    _test_end_callbacks.append((callback, persistent))
+
+
+def report_properties(dut, properties):
+    """Log the results of a test and attach them to its test case in
+    results.xml"""
+    for name, value in properties.items():
+        dut._log.info("{}: {}".format(name, value))
+    at_test_end(lambda result: properties)
+
+
+def skip_if(reason):
+    """Value of the `skip` argument of cocotb.test(): True, logging the
+    reason, when `reason` is set. Decided at import from the target and its
+    descriptors, so that results.xml records the test as skipped."""
+    if reason:
+        logging.getLogger('cocotb').info("Skipping: {}".format(reason))
+    return bool(reason)
+
+
+def skip_generated(factory, reason):
+    """Skip the tests generated by `factory` whose options do not apply to
+    the target: `reason(**options)` returns why, or None to run the test.
+    Call from the test module, after factory.generate_tests()."""
+    module = inspect.getmodule(inspect.stack()[1][0])
+    options = factory.kwargs
+    for index, values in enumerate(itertools.product(*options.values())):
+        why = reason(**dict(zip(options, values)))
+        if why:
+            name = "{}_{:03d}".format(factory.name, index + 1)
+            factory.log.info("Skipping {}: {}".format(name, why))
+            getattr(module, name).skip = True
+
+
+def min_mean_max(values):
+    if not values:
+        return 0, 0, 0
+    return min(values), sum(values) / len(values), max(values)
+
+
+def _wrap_primitive(harness, name):
+    method = getattr(harness, name)
+
+    profiler = harness.profiler
+
+    @cocotb.coroutine
+    def recorded(*args, **kwargs):
+        harness.history.append((get_sim_time('ns'), name, args))
+        result = yield method(*args, **kwargs)
+        return result
+
+    def profiled(*args, **kwargs):
+        harness.history.append((get_sim_time('ns'), name, args))
+        return profiler.call(name, method, args, kwargs)
+
+    primitive = recorded if profiler is None else profiled
+
+    setattr(harness, name, primitive)
+
+
+def _record_clocks(get, *args, **kwargs):
+    """Call `get(*args, **kwargs)` and return its result with the clocks it
+    forked, {signal name: [Clock, task]}"""
+    start = Clock.start
+    add = cocotb.scheduler.add
+    started = []
+    clocks = {}
+
+    def recorded_start(clock, *start_args, **start_kwargs):
+        coro = start(clock, *start_args, **start_kwargs)
+        started.append((clock, coro))
+        return coro
+
+    def recorded_add(coro):
+        task = add(coro)
+        for clock, clock_coro in started:
+            if clock_coro is coro:
+                clocks[clock.signal._name] = [clock, task]
+        return task
+
+    Clock.start = recorded_start
+    cocotb.scheduler.add = recorded_add
+    try:
+        return get(*args, **kwargs), clocks
+    finally:
+        Clock.start = start
+        cocotb.scheduler.add = add
+
+
+def stop_clock(harness, name):
+    """Stop the clock the harness drives on signal `name`. Returns False if
+    the harness started no cocotb Clock on it."""
+    clock = harness.clocks.get(name)
+    if clock is None or clock[1] is None:
+        return False
+    clock[1].kill()
+    clock[1] = None
+    return True
+
+
+def restart_clock(harness, name):
+    """Start again a clock stopped with stop_clock()"""
+    clock = harness.clocks[name]
+    if clock[1] is None:
+        clock[1] = cocotb.fork(clock[0].start())
+
+
+def get_harness(dut, **kwargs):
+    """Same as cocotb_usb.harness.get_harness, with testbench extensions"""
+    harness, clocks = _record_clocks(usb_harness.get_harness, dut, **kwargs)
+    # Clocks started by the harness, {signal name: [Clock, task or None]}
+    harness.clocks = clocks
+
+    # (sim time in ns, primitive, arguments) of the latest calls
+    harness.history = deque(maxlen=HISTORY_LENGTH)
+    harness.profiler = None
+    if os.getenv('PROFILE', '0') != '0':
+        harness.profiler = Profiler(
+            os.getenv('PROFILE_FILE', 'profile.folded'))
+        at_test_end(harness.profiler.report)
+    for name in PRIMITIVES:
+        if hasattr(harness, name):
+            _wrap_primitive(harness, name)
+    # Sleep on the core interrupt instead of polling for SETUP packets
+    if hasattr(dut, 'usb_irq'):
+        use_irq(harness)
+
+    # Passive decoder of the bus traffic, see tests/monitor.py
+    harness.monitor = None
+    turnaround = os.getenv('TURNAROUND', '0') != '0'
+    utilization = os.getenv('UTILIZATION', '0') != '0'
+    coverage = os.getenv('COVERAGE', '0') != '0'
+    lockstep = os.getenv('LOCKSTEP', '')
+    scoreboard = os.getenv('SCOREBOARD', '0') != '0'
+    if turnaround or utilization or coverage or lockstep or scoreboard:
+        harness.monitor = UsbMonitor(dut)
+        harness.monitor.start()
+    if turnaround:
+        check = TurnaroundCheck(
+            harness.monitor,
+            target=os.getenv('TARGET', ''),
+            samples_file=os.getenv('TURNAROUND_FILE'),
+            limit_bits=float(os.getenv('TURNAROUND_LIMIT_BITS', LIMIT_BITS)))
+        at_test_end(check.report)
+    if utilization:
+        report = UtilizationReport(
+            harness.monitor,
+            target=os.getenv('TARGET', ''),
+            directory=os.getenv('UTILIZATION_DIR', 'utilization'))
+        at_test_end(report.report)
+    if coverage:
+        global _coverage
+        if _coverage is None:
+            _coverage = Coverage(os.path.join(
+                os.getenv('COVERAGE_DIR', 'coverage'), '{}-{}-{}.json'.format(
+                    os.getenv('TARGET', ''), os.getenv('MODULE', ''),
+                    os.getpid())))
+            at_test_end(_coverage.save, persistent=True)
+        _coverage.attach(harness)
+    if scoreboard:
+        board = Scoreboard(UsbDevice(os.environ['TARGET_CONFIG']))
+        board.attach(harness)
+        at_test_end(board.report)
+    if lockstep:
+        check = Lockstep(dut, harness.monitor,
+                         targets=(os.getenv('TARGET', ''), lockstep),
+                         strict=os.getenv('LOCKSTEP_STRICT', '0') != '0')
+        at_test_end(check.report)
+
+    start_watchdog(harness,
+                   sim_limit_ms=float(os.getenv('WATCHDOG_SIM_MS', 0)),
+                   wall_limit_s=float(os.getenv('WATCHDOG_WALL_S', 0)))
+    return harness
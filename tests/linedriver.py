@@ -0,0 +1,130 @@
+"""Host packet encoder and line driver with fault injection
+
+Builds full-speed host packets (PID, CRC5/CRC16, bit stuffing, NRZI) and
+drives them on the D+/D- lines, bypassing the harness primitives so that
+packets can be sent damaged:
+
+- 'crc': the last bit of the CRC field is flipped,
+- 'pid': the check nibble of the PID no longer matches,
+- 'stuff': seven consecutive ones are sent without a stuffed bit,
+- 'truncate': the packet is cut short at a random bit and ended with EOP.
+
+The lines are given back in the state found before sending.
+"""
+
+import cocotb
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time
+from tests.monitor import BIT_TIME_NS, SYNC
+
+CRC, PID_CHECK, STUFF, TRUNCATE = 'crc', 'pid', 'stuff', 'truncate'
+
+# (D+, D-) of the line states
+J, K, SE0 = (1, 0), (0, 1), (0, 0)
+
+
+def _bits(data):
+    """Bits of `data`, LSB of every byte first"""
+    return [(byte >> i) & 1 for byte in data for i in range(8)]
+
+
+def crc5(value, width=11):
+    """USB CRC5 of the `width` low bits of `value`, sent LSB first"""
+    crc = 0x1f
+    for i in range(width):
+        if (crc ^ (value >> i)) & 1:
+            crc = (crc >> 1) ^ 0x14
+        else:
+            crc >>= 1
+    return crc ^ 0x1f
+
+
+def crc16(data):
+    """USB CRC16 of `data`, as the two bytes sent after it"""
+    crc = 0xffff
+    for bit in _bits(data):
+        if (crc ^ bit) & 1:
+            crc = (crc >> 1) ^ 0xa001
+        else:
+            crc >>= 1
+    crc ^= 0xffff
+    return [crc & 0xff, crc >> 8]
+
+
+def pid_byte(pid):
+    return pid | (~pid & 0xf) << 4
+
+
+def token_packet(pid, addr, endp):
+    value = addr | endp << 7
+    value |= crc5(value) << 11
+    return [pid_byte(pid), value & 0xff, value >> 8]
+
+
+def sof_packet(frame):
+    value = frame | crc5(frame) << 11
+    return [pid_byte(0x5), value & 0xff, value >> 8]
+
+
+def data_packet(pid, data):
+    return [pid_byte(pid)] + list(data) + crc16(data)
+
+
+def handshake_packet(pid):
+    return [pid_byte(pid)]
+
+
+def stuff(bits):
+    """Insert a 0 after every six consecutive ones"""
+    stuffed = []
+    ones = 0
+    for bit in bits:
+        stuffed.append(bit)
+        ones = ones + 1 if bit else 0
+        if ones == 6:
+            stuffed.append(0)
+            ones = 0
+    return stuffed
+
+
+def line_states(packet, fault=None, rng=None):
+    """Line states of SYNC, `packet` and EOP, damaged by `fault`"""
+    packet = list(packet)
+    if fault == CRC and len(packet) > 1:
+        # Last bit sent belongs to the CRC field
+        packet[-1] ^= 0x80
+    elif fault == PID_CHECK:
+        packet[0] ^= 0x10 << rng.randrange(4)
+    bits = stuff(_bits([SYNC] + packet))
+    if fault == STUFF:
+        position = rng.randrange(8, len(bits))
+        bits[position:position] = [1] * 7
+    elif fault == TRUNCATE:
+        bits = bits[:rng.randrange(9, len(bits))]
+    states = []
+    state = J
+    for bit in bits:
+        if not bit:
+            state = K if state == J else J
+        states.append(state)
+    return states + [SE0, SE0, J]
+
+
+class LineDriver:
+    def __init__(self, dut, bit_time_ns=BIT_TIME_NS):
+        self.dut = dut
+        self.bit_time = bit_time_ns
+
+    @cocotb.coroutine
+    def send(self, packet, fault=None, rng=None):
+        """Drive `packet` (bytes from the PID on) on the bus"""
+        idle = (self.dut.usb_d_p.value, self.dut.usb_d_n.value)
+        start = get_sim_time('ns')
+        for i, (d_p, d_n) in enumerate(line_states(packet, fault, rng)):
+            self.dut.usb_d_p <= d_p
+            self.dut.usb_d_n <= d_n
+            # Absolute bit times, so rounding does not add up
+            yield Timer(start + (i + 1) * self.bit_time - get_sim_time('ns'),
+                        'ns')
+        self.dut.usb_d_p <= idle[0]
+        self.dut.usb_d_n <= idle[1]
@@ -0,0 +1,127 @@
+"""Packet-by-packet comparison of two DUTs simulated side by side
+
+tools/lockstep.py builds a testbench with a second DUT on a bus of its own
+(signals prefixed with `b_`) that receives a copy of the host traffic of the
+first one. The harness drives and checks the first DUT as usual; here both
+buses are decoded and the answers of the two devices to every host token are
+compared. A difference is logged as soon as both answers are known, the
+first DUT being the reference the host follows.
+
+The copy of the host traffic is released while the second DUT drives its
+bus, so a host packet sent while the second DUT is still answering never
+reaches it. Such packets are logged as differences too.
+"""
+
+from cocotb.result import TestFailure
+
+from tests.monitor import UsbMonitor
+
+
+def _answer(packets):
+    return [(packet.name, bytes(packet.data).hex()) for packet in packets]
+
+
+def _format(packets):
+    return ", ".join("{} {}".format(packet.name, bytes(packet.data).hex())
+                     .rstrip() for packet in packets) or "no answer"
+
+
+class Lockstep:
+    def __init__(self, dut, monitor, targets, strict=False):
+        self.dut = dut
+        self.targets = targets
+        self.strict = strict
+        self.monitors = (monitor, UsbMonitor(dut, prefix='b_'))
+        # Per bus: [[host token, [device packets after it]]]
+        self.transactions = ([], [])
+        self.compared = 0
+        self.differences = 0
+        # Host packets of the first bus and device packets of the second one
+        # still to check for collisions
+        self._host = []
+        self._second = []
+        self.lost = 0
+        for side, bus in enumerate(self.monitors):
+            bus.callbacks.append(
+                lambda packet, side=side: self.packet(side, packet))
+        self.monitors[1].start()
+
+    def _collisions(self, side, packet):
+        """Host packets of the first bus that overlap what the second DUT
+        sent, and were not copied to its bus"""
+        if side == 0 and not packet.device:
+            self._host.append(packet)
+        elif side == 1 and packet.device:
+            self._second.append(packet)
+        else:
+            return
+        # Neither bus goes back in time: packets that ended before the
+        # start of the latest packet of the other list are done with
+        for mine, others in ((self._host, self._second),
+                             (self._second, self._host)):
+            if others:
+                start = others[-1].start
+                while mine and mine[0].end < start:
+                    mine.pop(0)
+        for host in list(self._host):
+            for device in self._second:
+                if host.start < device.end and device.start < host.end:
+                    self._host.remove(host)
+                    self.lost += 1
+                    self._difference(
+                        "host {} at {:.1f} ns lost on the {} bus, the device "
+                        "was sending {}".format(
+                            _format([host]), host.start, self.targets[1],
+                            _format([device])))
+                    break
+
+    def packet(self, side, packet):
+        """Bus monitor callback"""
+        self._collisions(side, packet)
+        transactions = self.transactions[side]
+        if packet.device:
+            if transactions:
+                transactions[-1][1].append(packet)
+        elif packet.is_token:
+            transactions.append([packet, []])
+        # The last transaction of a bus is complete once the next one started
+        self._compare(min(len(t) for t in self.transactions) - 1)
+
+    def _compare(self, count):
+        while self.compared < count:
+            (token, first), (other_token, second) = [
+                t[self.compared] for t in self.transactions]
+            self.compared += 1
+            if _answer([token]) != _answer([other_token]):
+                self._difference(
+                    "host traffic differs at token {}: {} on {}, {} on "
+                    "{}".format(self.compared, _format([token]),
+                                self.targets[0], _format([other_token]),
+                                self.targets[1]))
+            elif _answer(first) != _answer(second):
+                self._difference(
+                    "answer to {} EP{} (token {}, {:.1f} ns) differs: {} on "
+                    "{}, {} on {}".format(
+                        token.name, token.endp, self.compared, token.start,
+                        _format(first), self.targets[0], _format(second),
+                        self.targets[1]))
+
+    def _difference(self, message):
+        self.differences += 1
+        if self.strict:
+            raise TestFailure("Lockstep: " + message)
+        self.dut._log.error("Lockstep: " + message)
+
+    def report(self, result):
+        """at_test_end() callback: compares the last transactions and
+        returns the totals as results.xml properties"""
+        self.monitors[1].stop()
+        # Too late to fail the test, the last differences are only logged
+        self.strict = False
+        self._compare(min(len(t) for t in self.transactions))
+        return {
+            'lockstep_targets': " ".join(self.targets),
+            'lockstep_compared': self.compared,
+            'lockstep_differences': self.differences,
+            'lockstep_lost_host_packets': self.lost,
+        }
@@ -0,0 +1,236 @@
+"""Passive decoder of the full-speed USB traffic on the D+/D- lines
+
+The harness primitives check the device response they expect. The monitor
+instead records every packet on the bus, whoever sent it, with the times it
+started and ended, so that tests can react to whatever the device answered
+and measure the bus timing.
+"""
+
+import cocotb
+from cocotb.triggers import Edge, Event, First, ReadOnly, Timer
+from cocotb.utils import get_sim_time
+from cocotb_usb.usb.pid import PID
+
+# Full-speed bit time
+BIT_TIME_NS = 1e3 / 12
+
+# Line states
+SE0, J, K, SE1 = 'SE0', 'J', 'K', 'SE1'
+
+# Byte sent as the SYNC field, LSB first
+SYNC = 0x80
+
+
+def _pid_name(pid):
+    try:
+        return PID(pid).name
+    except ValueError:
+        return "0x{:x}".format(pid)
+
+
+class Packet:
+    """A packet seen on the bus.
+
+    Times are in ns of simulated time: `start` is the first transition of
+    SYNC, `eop` the start of the SE0 and `end` the end of the EOP.
+    `turnaround` is set for packets that answer the previous packet in the
+    other direction, it is the time from its EOP end to this SYNC start.
+    """
+
+    def __init__(self, start, eop, end, device, payload):
+        self.start = start
+        self.eop = eop
+        self.end = end
+        self.device = device
+        self.turnaround = None
+        # Token of the transaction this packet belongs to
+        self.token = None
+        self.valid = len(payload) > 0 and \
+            (payload[0] & 0xf) == (~payload[0] >> 4) & 0xf
+        self.pid = payload[0] & 0xf if payload else None
+        self.data = payload[1:]
+
+    @property
+    def name(self):
+        return _pid_name(self.pid) if self.valid else "INVALID"
+
+    @property
+    def is_token(self):
+        return self.valid and self.pid in (PID.OUT, PID.IN, PID.SETUP)
+
+    @property
+    def is_data(self):
+        return self.valid and self.pid in (PID.DATA0, PID.DATA1)
+
+    @property
+    def addr(self):
+        return self.data[0] & 0x7f
+
+    @property
+    def endp(self):
+        return ((self.data[1] & 0x7) << 1) | (self.data[0] >> 7)
+
+    def __repr__(self):
+        return "Packet({:.1f} ns, {}, {}, {})".format(
+            self.start, "device" if self.device else "host", self.name,
+            bytes(self.data).hex())
+
+
+def decode_nrzi(runs):
+    """Turn the lengths in bit times of the line states of a packet into
+    bytes, LSB first, after removing stuffed bits"""
+    bits = []
+    ones = 0
+    for length in runs:
+        # A transition is a 0, a constant line a 1
+        for bit in [0] + [1] * (length - 1):
+            if ones == 6:
+                # Stuffed bit
+                ones = 0
+                continue
+            bits.append(bit)
+            ones = ones + 1 if bit else 0
+    return [sum(bit << i for i, bit in enumerate(bits[n:n + 8]))
+            for n in range(0, len(bits) - 7, 8)]
+
+
+class UsbMonitor:
+    def __init__(self, dut, bit_time_ns=BIT_TIME_NS, prefix=''):
+        self.dut = dut
+        # Bus signals, `prefix` selects another bus of the testbench
+        self.d_p = getattr(dut, prefix + 'usb_d_p')
+        self.d_n = getattr(dut, prefix + 'usb_d_n')
+        self.tx_en = getattr(dut, prefix + 'usb_tx_en')
+        self.bit_time = bit_time_ns
+        self.packets = []
+        self.new_packet = Event()
+        # Called with every packet as soon as it is decoded
+        self.callbacks = []
+        self._token = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = cocotb.fork(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.kill()
+            self._task = None
+
+    @staticmethod
+    def _bit(signal):
+        value = signal.value
+        return int(value) if value.is_resolvable else 0
+
+    def _line_state(self):
+        return ((SE0, K), (J, SE1))[self._bit(self.d_p)][self._bit(self.d_n)]
+
+    def _bits(self, duration):
+        return max(1, int(round(duration / self.bit_time)))
+
+    def _packet(self, start, eop, end, device, runs):
+        decoded = decode_nrzi(runs)
+        payload = decoded[1:] if decoded and decoded[0] == SYNC else []
+        return Packet(start, eop, end, device, payload)
+
+    def _add(self, packet):
+        if self.packets:
+            previous = self.packets[-1]
+            if previous.device != packet.device:
+                packet.turnaround = packet.start - previous.end
+        if packet.is_token:
+            self._token = packet
+        elif packet.valid and packet.pid == PID.SOF:
+            self._token = None
+        else:
+            packet.token = self._token
+        self.packets.append(packet)
+        for callback in self.callbacks:
+            callback(packet)
+        self.new_packet.set(packet)
+
+    @cocotb.coroutine
+    def _run(self):
+        edges = (Edge(self.d_p), Edge(self.d_n))
+        eop_timeout = 3 * self.bit_time
+        state = self._line_state()
+        start = eop = last = None
+        runs = []
+        device = False
+        while True:
+            if eop is None:
+                yield First(*edges)
+            else:
+                # An undriven bus stays SE0 after the EOP
+                trigger = yield First(*edges, Timer(eop_timeout, 'ns'))
+                if isinstance(trigger, Timer):
+                    self._add(self._packet(start, eop,
+                                           eop + 2 * self.bit_time, device,
+                                           runs))
+                    start = eop = None
+                    continue
+            yield ReadOnly()
+            now = get_sim_time('ns')
+            new_state = self._line_state()
+            if new_state == state:
+                continue
+            state = new_state
+
+            if eop is not None:
+                # End of the EOP
+                end = now if now - eop < eop_timeout else \
+                    eop + 2 * self.bit_time
+                self._add(self._packet(start, eop, end, device, runs))
+                start = eop = None
+
+            if start is None:
+                if state == K:
+                    # First transition of SYNC
+                    start = last = now
+                    runs = []
+                    device = bool(self._bit(self.tx_en))
+                continue
+
+            device |= bool(self._bit(self.tx_en))
+            runs.append(self._bits(now - last))
+            last = now
+            if state == SE0:
+                eop = now
+
+    @cocotb.coroutine
+    def wait_packet(self, index, timeout=None, units='us'):
+        """Wait until packet number `index` was seen and return it.
+
+        Returns None if `timeout` passes first."""
+        if timeout is not None:
+            deadline = get_sim_time(units) + timeout
+        while len(self.packets) <= index:
+            self.new_packet.clear()
+            if timeout is None:
+                yield self.new_packet.wait()
+                continue
+            remaining = deadline - get_sim_time(units)
+            if remaining <= 0:
+                return None
+            timer = Timer(remaining, units)
+            trigger = yield First(self.new_packet.wait(), timer)
+            if trigger is timer:
+                return None
+        return self.packets[index]
+
+    @cocotb.coroutine
+    def wait_response(self, since, timeout=None, units='us'):
+        """Wait for the first packet sent by the device since packet number
+        `since` and return it, or None if `timeout` passes first."""
+        if timeout is not None:
+            deadline = get_sim_time(units) + timeout
+        index = since
+        while True:
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, deadline - get_sim_time(units))
+            packet = yield self.wait_packet(index, remaining, units)
+            if packet is None or packet.device:
+                return packet
+            index += 1
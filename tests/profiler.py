@@ -0,0 +1,166 @@
+"""Per-call timing of the harness primitives
+
+Every primitive call is timed in wall-clock and simulated time. Primitives
+call each other (a control transfer is made of transactions, which are made
+of packets): a primitive called by another one is run inside the caller's
+coroutine, stepped by the profiler, so every coroutine keeps its own call
+stack. Primitives started with cocotb.fork() begin a stack of their own.
+
+The wall-clock time of a call is split into the Python time of the
+primitive itself (building and encoding packets, checking answers), measured
+while its generator runs, and the time it waits on triggers, during which
+the simulator and the other coroutines run. Self Python time and waiting
+time of every call path are written out as collapsed stacks that
+flamegraph.pl or speedscope can display.
+"""
+
+import inspect
+import time
+from collections import Counter, defaultdict
+
+import cocotb
+from cocotb.result import ReturnValue
+from cocotb.utils import get_sim_time
+
+# Files written by this simulator run, the others are truncated first
+_opened_files = set()
+
+# Leaf added to the call paths for the time spent waiting on triggers
+WAITING = '[waiting]'
+
+
+class CallStats:
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.python = 0.0
+        self.waiting = 0.0
+        self.sim = 0
+
+
+def _whole(task):
+    """Generator waiting for `task` as a single trigger"""
+    result = yield task
+    return result
+
+
+def _generator(method, args, kwargs):
+    """Generator of a cocotb coroutine, so it can be stepped call by call"""
+    function = getattr(method, '__wrapped__', None)
+    if function is not None and inspect.isgeneratorfunction(function):
+        return function(*args, **kwargs)
+    # Not a generator based coroutine: timed as a whole
+    return _whole(method(*args, **kwargs))
+
+
+class Profiler:
+    def __init__(self, folded_file):
+        self.folded_file = folded_file
+        self.stats = defaultdict(CallStats)
+        # Self time in microseconds of every call path
+        self.folded = Counter()
+        # {id(task): (task, name, method, args, kwargs)} of the calls not
+        # started yet
+        self._calls = {}
+
+    def call(self, name, method, args, kwargs):
+        """Coroutine running `method` as the primitive `name`"""
+        holder = []
+
+        @cocotb.coroutine
+        def primitive():
+            # Started by the scheduler: the bottom of a new stack
+            del self._calls[id(holder[0])]
+            result = yield from self._run([], name, method, args, kwargs)
+            return result
+
+        task = primitive()
+        holder.append(task)
+        self._calls[id(task)] = (task, name, method, args, kwargs)
+        return task
+
+    def _inline(self, yielded):
+        """The call behind `yielded` if it is a profiled primitive"""
+        entry = self._calls.get(id(yielded))
+        if entry is None or entry[0] is not yielded:
+            return None
+        del self._calls[id(yielded)]
+        return entry[1:]
+
+    def _run(self, stack, name, method, args, kwargs):
+        stack.append(name)
+        path = ";".join(stack)
+        stats = CallStats()
+        wall_start = time.perf_counter()
+        sim_start = get_sim_time('ns')
+        coro = _generator(method, args, kwargs)
+        value, error = None, None
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    if error is not None:
+                        yielded = coro.throw(error)
+                    else:
+                        yielded = coro.send(value)
+                except StopIteration as e:
+                    return e.value
+                except ReturnValue as e:
+                    return e.retval
+                finally:
+                    stats.python += time.perf_counter() - start
+                value, error = None, None
+                call = self._inline(yielded)
+                try:
+                    if call is not None:
+                        # Nested primitive, on the stack of this coroutine
+                        value = yield from self._run(stack, *call)
+                    else:
+                        start = time.perf_counter()
+                        try:
+                            value = yield yielded
+                        finally:
+                            stats.waiting += time.perf_counter() - start
+                except Exception as e:
+                    error = e
+        finally:
+            coro.close()
+            stack.pop()
+            stats.wall = time.perf_counter() - wall_start
+            stats.sim = get_sim_time('ns') - sim_start
+            self._record(name, path, stats)
+
+    def _record(self, name, path, call):
+        stats = self.stats[name]
+        stats.count += 1
+        stats.wall += call.wall
+        stats.python += call.python
+        stats.waiting += call.waiting
+        stats.sim += call.sim
+        self.folded[path] += int(call.python * 1e6)
+        self.folded[path + ';' + WAITING] += int(call.waiting * 1e6)
+
+    def report(self, result):
+        """at_test_end() callback: writes the collapsed stacks of the test
+        and returns the summary as results.xml properties"""
+        test = result['test']
+        mode = 'a' if self.folded_file in _opened_files else 'w'
+        _opened_files.add(self.folded_file)
+        with open(self.folded_file, mode) as f:
+            for path, us in sorted(self.folded.items()):
+                if us:
+                    f.write("{};{} {}\n".format(test, path, us))
+        properties = {}
+        python = 0.0
+        for name, stats in sorted(self.stats.items()):
+            python += stats.python
+            properties['profile_' + name] = (
+                "calls={} wall_s={:.6f} python_s={:.6f} waiting_s={:.6f} "
+                "sim_ns={}".format(stats.count, stats.wall, stats.python,
+                                   stats.waiting, stats.sim))
+        # Wall time of the test outside the Python code of the primitives:
+        # simulator, cocotb scheduler and the test code itself
+        properties['profile_python_s'] = "{:.6f}".format(python)
+        properties['profile_other_s'] = "{:.6f}".format(
+            max(0.0, result.get('real', 0) - python))
+        return properties
@@ -0,0 +1,292 @@
+"""Constrained-random host stimulus
+
+Builds random but legal host traffic out of the harness primitives: control
+reads of the descriptors with random lengths, SETUPs abandoned before their
+data stage, IN tokens and OUT data with random lengths and data toggles on
+random endpoints of the device, SOFs with random frame numbers, tokens and
+data for other devices on the bus, idle periods and random gaps between
+transactions, with a SOF every millisecond. Descriptors are checked against
+the UsbDevice model, the other answers against what the USB protocol
+allows. OUT data only goes to endpoints the descriptors do not declare as
+OUT, so that it is not taken as input by the device function.
+
+On targets where the harness plays the firmware, control reads go through
+the harness control transfers. On the others, the host may also drop the
+ACK of an IN data packet, after which the device has to send the same data
+with the same toggle again.
+
+Everything is drawn from the `random.Random` given, so a sequence is fully
+reproduced from its seed.
+"""
+
+import cocotb
+from cocotb.result import TestFailure
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time
+from tests.monitor import BIT_TIME_NS
+from tests.scoreboard import model_descriptors
+from tests.transfers import NAK_LIMIT, NakLimit, out_transaction, toggled
+from cocotb_usb.usb.pid import PID
+
+FRAME_NS = 1e6
+# Gaps between host transactions, in bit times
+MIN_GAP_BITS = 2
+MAX_GAP_BITS = 40
+# Idle periods, in us
+MAX_IDLE_US = 400
+# Host timeout waiting for the device answer, in bit times
+TIMEOUT_BITS = 18
+# Relative weights of the operations
+WEIGHTS = {
+    'get_descriptor': 4,
+    'setup': 1,
+    'in_token': 2,
+    'out_data': 2,
+    'sof': 1,
+    'other_device': 2,
+    'idle': 1,
+}
+# Answers allowed to an IN token and to OUT data
+IN_ANSWERS = (PID.DATA0, PID.DATA1, PID.NAK, PID.STALL)
+OUT_ANSWERS = (PID.ACK, PID.NAK, PID.STALL)
+
+
+class RandomStimulus:
+    """`endpoints` are the (number, direction) of the endpoints the
+    descriptors declare"""
+
+    def __init__(self, harness, monitor, model, rng, addr, emulated,
+                 endpoints=()):
+        self.harness = harness
+        self.monitor = monitor
+        self.rng = rng
+        self.addr = addr
+        self.emulated = emulated
+        self.endpoints = set(endpoints)
+        self.frame = rng.randrange(0x800)
+        self.next_sof = get_sim_time('ns')
+        # Operations done so far, logged when a check fails
+        self.log = []
+        self.descriptors = model_descriptors(model)
+
+    def fail(self, message, error=TestFailure):
+        for entry in self.log:
+            self.harness.dut._log.info("  " + entry)
+        raise error(message)
+
+    @cocotb.coroutine
+    def gap(self):
+        """Random pacing before a host transaction, with SOFs on time"""
+        yield Timer(self.rng.uniform(MIN_GAP_BITS, MAX_GAP_BITS) *
+                    BIT_TIME_NS, 'ns')
+        if get_sim_time('ns') >= self.next_sof:
+            yield self.harness.host_send_sof(self.frame)
+            self.frame = (self.frame + 1) & 0x7ff
+            self.next_sof += FRAME_NS
+            yield Timer(MIN_GAP_BITS * BIT_TIME_NS, 'ns')
+
+    @cocotb.coroutine
+    def response(self, since):
+        """Device answer to the host packets since packet number `since`,
+        None if there was none within the host timeout"""
+        packet = yield self.monitor.wait_response(since, 100)
+        if packet is None or (packet.turnaround or 0) > \
+                TIMEOUT_BITS * BIT_TIME_NS:
+            return None
+        return packet
+
+    @cocotb.coroutine
+    def run(self, count):
+        ops = list(WEIGHTS)
+        weights = [WEIGHTS[op] for op in ops]
+        for _ in range(count):
+            op = self.rng.choices(ops, weights)[0]
+            yield getattr(self, op)()
+
+    @cocotb.coroutine
+    def idle(self):
+        idle_us = self.rng.uniform(0, MAX_IDLE_US)
+        self.log.append("idle {:.1f} us".format(idle_us))
+        end = get_sim_time('ns') + idle_us * 1e3
+        while get_sim_time('ns') < end:
+            if self.next_sof <= end:
+                yield Timer(max(1, self.next_sof - get_sim_time('ns')), 'ns')
+                yield self.harness.host_send_sof(self.frame)
+                self.frame = (self.frame + 1) & 0x7ff
+                self.next_sof += FRAME_NS
+            else:
+                yield Timer(end - get_sim_time('ns'), 'ns')
+
+    @cocotb.coroutine
+    def setup(self):
+        """SETUP of a descriptor read abandoned before its data stage, which
+        the next control transfer aborts"""
+        _, value, index, _ = self.rng.choice(self.descriptors)
+        length = self.rng.randint(1, 255)
+        setup = [0x80, 0x06, value & 0xff, value >> 8,
+                 index & 0xff, index >> 8, length & 0xff, length >> 8]
+        self.log.append("SETUP GET_DESCRIPTOR 0x{:04x} wLength {}, "
+                        "abandoned".format(value, length))
+        yield self.gap()
+        since = len(self.monitor.packets)
+        yield self.harness.host_send_token_packet(PID.SETUP, self.addr, 0)
+        yield self.harness.host_send_data_packet(PID.DATA0, setup)
+        response = yield self.response(since)
+        if response is None or not response.valid or \
+                response.pid != PID.ACK:
+            self.fail("SETUP answered with {}".format(
+                response.name if response is not None else "nothing"))
+        if self.emulated:
+            # The firmware reads the request, the host never asks for the
+            # answer
+            yield self.harness.drain_setup()
+
+    @cocotb.coroutine
+    def in_token(self):
+        """IN on a random endpoint, data is acknowledged"""
+        epnum = self.rng.randrange(1, 16)
+        self.log.append("IN to EP{}".format(epnum))
+        yield self.gap()
+        since = len(self.monitor.packets)
+        yield self.harness.host_send_token_packet(PID.IN, self.addr, epnum)
+        response = yield self.response(since)
+        if response is None:
+            # Cores may ignore the endpoints they do not have
+            if (epnum, 'in') in self.endpoints:
+                self.fail("No answer to IN on EP{}".format(epnum))
+            return
+        if not (response.valid and response.pid in IN_ANSWERS):
+            self.fail("Unexpected answer to IN on EP{}: {}".format(
+                epnum, repr(response)))
+        if response.is_data:
+            yield Timer(MIN_GAP_BITS * BIT_TIME_NS, 'ns')
+            yield self.harness.host_send_ack()
+
+    @cocotb.coroutine
+    def out_data(self):
+        """OUT with random data and toggle on a random endpoint that is not
+        an OUT endpoint of the device function"""
+        epnum = self.rng.choice([n for n in range(1, 16)
+                                 if (n, 'out') not in self.endpoints])
+        pid = self.rng.choice([PID.DATA0, PID.DATA1])
+        data = [self.rng.getrandbits(8)
+                for _ in range(self.rng.randint(0, 64))]
+        self.log.append("OUT {} of {} bytes to EP{}".format(
+            pid.name, len(data), epnum))
+        yield self.gap()
+        since = len(self.monitor.packets)
+        yield self.harness.host_send_token_packet(PID.OUT, self.addr, epnum)
+        yield self.harness.host_send_data_packet(pid, data)
+        response = yield self.response(since)
+        if response is not None and \
+                not (response.valid and response.pid in OUT_ANSWERS):
+            self.fail("Unexpected answer to OUT on EP{}: {}".format(
+                epnum, repr(response)))
+
+    @cocotb.coroutine
+    def sof(self):
+        """Extra SOF with a random frame number, the device must stay
+        silent"""
+        frame = self.rng.randrange(0x800)
+        self.log.append("SOF frame {}".format(frame))
+        yield self.gap()
+        since = len(self.monitor.packets)
+        yield self.harness.host_send_sof(frame)
+        response = yield self.response(since)
+        if response is not None:
+            self.fail("Device answered {} to a SOF".format(response.name))
+
+    @cocotb.coroutine
+    def other_device(self):
+        """Token (and data) for another device, which must stay silent"""
+        addr = self.rng.choice([a for a in range(1, 128) if a != self.addr])
+        epnum = self.rng.randrange(16)
+        pid = self.rng.choice([PID.IN, PID.OUT, PID.SETUP])
+        if pid == PID.SETUP:
+            epnum = 0
+        self.log.append("{} to address {} EP{}".format(pid.name, addr, epnum))
+        yield self.gap()
+        index = len(self.monitor.packets)
+        yield self.harness.host_send_token_packet(pid, addr, epnum)
+        if pid != PID.IN:
+            length = 8 if pid == PID.SETUP else self.rng.randint(0, 64)
+            data = [self.rng.getrandbits(8) for _ in range(length)]
+            data_pid = PID.DATA0 if pid == PID.SETUP else \
+                self.rng.choice([PID.DATA0, PID.DATA1])
+            yield self.harness.host_send_data_packet(data_pid, data)
+        response = yield self.response(index)
+        if response is not None:
+            self.fail("Device answered {} to a {} for address {}".format(
+                response.name, pid.name, addr))
+
+    @cocotb.coroutine
+    def get_descriptor(self):
+        name, value, index, expected = self.rng.choice(self.descriptors)
+        length = self.rng.choice([len(expected), self.rng.randint(1, 255)])
+        setup = [0x80, 0x06, value & 0xff, value >> 8,
+                 index & 0xff, index >> 8, length & 0xff, length >> 8]
+        expected = expected[:length]
+        self.log.append("GET_DESCRIPTOR {} wLength {}".format(name, length))
+        yield self.gap()
+        if self.emulated:
+            yield self.harness.control_transfer_in(self.addr, setup, expected)
+            return
+
+        yield self.harness.transaction_setup(self.addr, setup)
+        data = []
+        toggle = PID.DATA1
+        while len(data) < length:
+            packet = yield self.data_in(toggle)
+            data += packet
+            toggle = toggled(toggle)
+            if len(packet) < self.harness.max_packet_size:
+                break
+        if data != expected:
+            self.fail("{} descriptor: got {}, expected {}".format(
+                name, bytes(data).hex(), bytes(expected).hex()))
+        while True:
+            yield self.gap()
+            response = yield out_transaction(self.harness, self.monitor,
+                                             self.addr, 0, PID.DATA1, [])
+            if response.pid == PID.ACK:
+                break
+
+    @cocotb.coroutine
+    def data_in(self, toggle):
+        """IN transaction on EP0 returning the data, possibly dropping the
+        first ACK to check the device sends the same packet again"""
+        drop_ack = self.rng.random() < 0.25
+        sent = None
+        naks = 0
+        while True:
+            yield self.gap()
+            index = len(self.monitor.packets)
+            yield self.harness.host_send_token_packet(PID.IN, self.addr, 0)
+            response = yield self.response(index)
+            if response is None:
+                self.fail("No answer to IN")
+            if response.valid and response.pid == PID.NAK:
+                naks += 1
+                if naks == NAK_LIMIT:
+                    self.fail("EP0 IN answered NAK {} times".format(naks),
+                              NakLimit)
+                continue
+            if not response.is_data:
+                self.fail("Unexpected answer to IN: " + repr(response))
+            if response.pid != toggle:
+                self.fail("Got {}, expected {}".format(response.name,
+                                                       toggle.name))
+            data = response.data[:-2]
+            if sent is not None and data != sent:
+                self.fail("Data sent again differs: {} then {}".format(
+                    bytes(sent).hex(), bytes(data).hex()))
+            if drop_ack:
+                self.log.append("  ACK of {} dropped".format(toggle.name))
+                drop_ack = False
+                sent = data
+                # Let the device time out waiting for the handshake
+                yield Timer(TIMEOUT_BITS * BIT_TIME_NS, 'ns')
+                continue
+            yield Timer(MIN_GAP_BITS * BIT_TIME_NS, 'ns')
+            yield self.harness.host_send_ack()
+            return data
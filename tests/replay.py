@@ -0,0 +1,235 @@
+"""Replay of captured host sessions, see tests/capture.py
+
+Every URB of the capture is sent again at its original time, scaled by
+`time_scale` (0 sends them back to back), with a SOF every millisecond in
+between. Control transfers go through the setup, data and status stages,
+bulk and interrupt transfers are split into packets of at most 64 bytes
+with the data toggles of each endpoint kept. Isochronous transfers and URBs
+that did not complete in the capture are skipped.
+
+The device address follows the capture: URBs to address 0 are sent to
+address 0, SET_ADDRESS is replayed like any request, and if the capture
+starts after the device got its address the replay assigns it first.
+
+What the device answers is compared with the completion of the captured
+URB: the data of IN transfers and whether the transfer was stalled. On
+targets where the harness plays the firmware, the harness control transfers
+answer with the captured data and no firmware arms the data endpoints, so
+control IN URBs and the bulk and interrupt URBs the device never answers are
+counted as unchecked rather than compared.
+"""
+
+import cocotb
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time
+from tests.capture import BULK, CONTROL, INTERRUPT, OK, STALL
+from tests.transfers import (MAX_BULK_PACKET, NAK_LIMIT, NakLimit, Stall,
+                             control_read, control_write, in_transaction,
+                             out_transaction, toggled)
+from cocotb_usb.usb.pid import PID
+
+FRAME_NS = 1e6
+# Gap between two URBs sent back to back, in ns
+MIN_GAP_NS = 1e3
+# Outcome of a transaction given up after NAK_LIMIT NAKs
+NAK = 'nak'
+
+SET_ADDRESS = 5
+SET_CONFIGURATION = 9
+CLEAR_FEATURE = 1
+ENDPOINT_HALT = 0
+
+
+class Replayer:
+    def __init__(self, harness, monitor, urbs, time_scale=1, emulated=False):
+        self.harness = harness
+        self.monitor = monitor
+        self.urbs = urbs
+        self.time_scale = time_scale
+        self.emulated = emulated
+        self.address = 0
+        # {endpoint address: next data PID}
+        self.toggles = {}
+        self.frame = 0
+        self.next_sof = get_sim_time('ns')
+        self.replayed = 0
+        self.skipped = 0
+        # Replayed URBs whose answer says nothing about the device
+        self.unchecked = 0
+        # [(URB number, URB, message)]
+        self.mismatches = []
+
+    @cocotb.coroutine
+    def idle_until(self, end):
+        """Keep the bus alive with SOFs until `end` ns"""
+        while True:
+            now = get_sim_time('ns')
+            if self.next_sof <= max(end, now):
+                if self.next_sof > now:
+                    yield Timer(self.next_sof - now, 'ns')
+                yield self.harness.host_send_sof(self.frame)
+                self.frame = (self.frame + 1) & 0x7ff
+                self.next_sof = max(self.next_sof + FRAME_NS,
+                                    get_sim_time('ns'))
+            elif end > now:
+                yield Timer(end - now, 'ns')
+            else:
+                return
+
+    @cocotb.coroutine
+    def run(self):
+        if not self.urbs:
+            return
+        start = get_sim_time('ns')
+        first = self.urbs[0].time
+        for number, urb in enumerate(self.urbs):
+            due = start + (urb.time - first) * 1e9 * self.time_scale
+            yield self.idle_until(max(due, get_sim_time('ns') + MIN_GAP_NS))
+            if urb.status not in (OK, STALL) or \
+                    urb.transfer not in (CONTROL, BULK, INTERRUPT):
+                self.skipped += 1
+                continue
+            if urb.device != 0 and self.address == 0:
+                # Captured after the host assigned the address
+                yield self.harness.set_device_address(urb.device)
+                self.address = urb.device
+                yield self.idle_until(get_sim_time('ns') + MIN_GAP_NS)
+            addr = 0 if urb.device == 0 else self.address
+            try:
+                if urb.transfer == CONTROL:
+                    response = yield self.control(addr, urb)
+                elif urb.is_in:
+                    response = yield self.data_in(addr, urb)
+                else:
+                    response = yield self.data_out(addr, urb)
+                status = OK
+            except Stall:
+                response = b''
+                status = STALL
+            except NakLimit:
+                if self.emulated and urb.transfer != CONTROL:
+                    # No firmware armed the endpoint
+                    response = None
+                else:
+                    response = b''
+                    status = NAK
+            self.replayed += 1
+            if response is None:
+                self.unchecked += 1
+            else:
+                self.compare(number, urb, status, response)
+
+    @cocotb.coroutine
+    def control(self, addr, urb):
+        """Returns the data stage of IN requests, None when it is not the
+        answer of the device"""
+        setup = list(urb.setup)
+        if self.emulated and setup[:2] == [0x00, SET_ADDRESS]:
+            # The harness firmware has to program the new address
+            yield self.harness.set_device_address(setup[2] & 0x7f)
+        elif self.emulated:
+            if urb.is_in:
+                # Answers with the captured data, whatever the device does
+                yield self.harness.control_transfer_in(addr, setup,
+                                                       list(urb.response))
+                return None
+            yield self.harness.control_transfer_out(
+                addr, setup, list(urb.data) if urb.data else None)
+        elif urb.is_in:
+            data = yield control_read(self.harness, self.monitor, addr,
+                                      setup)
+            return bytes(data)
+        else:
+            yield control_write(self.harness, self.monitor, addr, setup,
+                                urb.data)
+        self.request_done(setup)
+        return b''
+
+    def request_done(self, setup):
+        """Follow the state changes caused by a successful request"""
+        value = setup[2] | setup[3] << 8
+        if setup[0] == 0x00 and setup[1] == SET_ADDRESS:
+            self.address = value & 0x7f
+        elif setup[0] == 0x00 and setup[1] == SET_CONFIGURATION:
+            self.toggles = {}
+        elif setup[0] == 0x02 and setup[1] == CLEAR_FEATURE and \
+                value == ENDPOINT_HALT:
+            self.toggles.pop(setup[4], None)
+
+    @cocotb.coroutine
+    def data_out(self, addr, urb):
+        epnum = urb.endpoint & 0xf
+        data = list(urb.data)
+        # A zero-length transfer is one empty packet
+        for offset in range(0, max(len(data), 1), MAX_BULK_PACKET):
+            toggle = self.toggles.get(urb.endpoint, PID.DATA0)
+            for _ in range(NAK_LIMIT):
+                response = yield out_transaction(
+                    self.harness, self.monitor, addr, epnum, toggle,
+                    data[offset:offset + MAX_BULK_PACKET])
+                if response.pid == PID.ACK:
+                    break
+            else:
+                raise NakLimit("EP{} OUT answered NAK {} times".format(
+                    epnum, NAK_LIMIT))
+            self.toggles[urb.endpoint] = toggled(toggle)
+        return b''
+
+    @cocotb.coroutine
+    def data_in(self, addr, urb):
+        epnum = urb.endpoint & 0xf
+        length = urb.length if urb.length is not None else len(urb.response)
+        data = []
+        received = False
+        retries = 0
+        while True:
+            if retries == NAK_LIMIT:
+                raise NakLimit("EP{} IN answered NAK {} times".format(
+                    epnum, retries))
+            response = yield in_transaction(self.harness, self.monitor, addr,
+                                            epnum)
+            if not response.is_data:
+                if received:
+                    # The device has nothing more for this transfer
+                    break
+                retries += 1
+                continue
+            toggle = self.toggles.get(urb.endpoint, PID.DATA0)
+            if response.pid != toggle:
+                # Retransmission of a packet we already have
+                retries += 1
+                continue
+            received = True
+            retries = 0
+            self.toggles[urb.endpoint] = toggled(toggle)
+            packet = response.data[:-2]
+            data += packet
+            if len(packet) < MAX_BULK_PACKET or len(data) >= length:
+                break
+        return bytes(data)
+
+    def compare(self, number, urb, status, response):
+        if status != urb.status:
+            message = "{} in the capture, {} in the replay".format(
+                urb.status, status)
+        elif urb.is_in and response != urb.response:
+            message = "captured {}, got {}".format(urb.response.hex(),
+                                                   response.hex())
+        else:
+            return
+        self.mismatches.append((number, urb, message))
+        self.harness.dut._log.warning("URB {} ({}): {}".format(
+            number, urb, message))
+
+    def report(self, result):
+        """at_test_end() callback: returns the replay totals as results.xml
+        properties"""
+        return {
+            'replay_urbs': len(self.urbs),
+            'replay_replayed': self.replayed,
+            'replay_skipped': self.skipped,
+            'replay_unchecked': self.unchecked,
+            'replay_matched': self.replayed - self.unchecked -
+            len(self.mismatches),
+            'replay_mismatches': len(self.mismatches),
+        }
@@ -0,0 +1,24 @@
+"""Summaries of turnaround samples
+
+Shared by tests/turnaround.py and tools/turnaround.py. The module has no
+cocotb dependency so the tool can use it outside of a simulation.
+"""
+
+import math
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted `values`"""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summary(values):
+    """Returns (count, min, p50, p99, max) of the samples"""
+    values = sorted(values)
+    return (len(values), values[0], percentile(values, 0.5),
+            percentile(values, 0.99), values[-1])
+
+
+def format_summary(values):
+    return "n={} min={:.2f} p50={:.2f} p99={:.2f} max={:.2f}".format(
+        *summary(values))
@@ -0,0 +1,293 @@
+"""Host traffic model scheduling several endpoints in the same frames
+
+Every frame starts with a SOF, then the periodic (interrupt) pipes due in
+that frame get one transaction each and the remaining time goes round robin
+to the control and bulk pipes with a transfer pending, one transaction at a
+time, as long as the largest transaction still fits in the frame. NAKed
+transactions are retried on the next turn of the pipe, like a host
+controller does.
+
+Pipes with a `firmware` (tests.transfers.HarnessFirmware driving the eptri
+CSRs, or FifoFirmware driving the epfifo ones) have their device side
+re-armed by the harness after every transaction, and the data the core
+received on OUT endpoints checked. Each pipe keeps its throughput and the
+latency of its transfers, from submission to completion.
+"""
+
+import abc
+from collections import deque
+
+import cocotb
+from cocotb.result import TestFailure
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time
+from tests.harness import min_mean_max
+from tests.transfers import (in_transaction, out_transaction, toggled,
+                             transaction_ns)
+from cocotb_usb.usb.pid import PID
+
+FRAME_NS = 1e6
+
+
+def payload(offset, length):
+    return [(offset + i) & 0xff for i in range(length)]
+
+
+class Pipe(abc.ABC):
+    """Host side of one endpoint, with its queue of transfers"""
+
+    periodic = False
+
+    def __init__(self, name, addr, epnum, max_packet, firmware=None):
+        self.name = name
+        self.addr = addr
+        self.epnum = epnum
+        self.max_packet = max_packet
+        self.firmware = firmware
+        self.toggle = PID.DATA0
+        self.transfers = deque()
+        self.bytes = 0
+        self.transactions = 0
+        self.naks = 0
+        self.latencies_us = []
+
+    @property
+    def pending(self):
+        return bool(self.transfers)
+
+    def submit(self, transfer):
+        self.transfers.append((get_sim_time('ns'), transfer))
+
+    def _complete(self):
+        submitted, _ = self.transfers.popleft()
+        self.latencies_us.append((get_sim_time('ns') - submitted) / 1e3)
+
+    @cocotb.coroutine
+    def start(self):
+        """Arm the device side before the traffic starts"""
+        if self.firmware is not None:
+            yield self.firmware.arm()
+
+    @abc.abstractmethod
+    def transaction(self, harness, monitor):
+        """Coroutine running the next transaction of the first transfer"""
+
+    def report(self, elapsed_s):
+        latency_min, latency_mean, latency_max = min_mean_max(
+            self.latencies_us)
+        return {
+            'bytes_per_s': "{:.0f}".format(self.bytes / elapsed_s),
+            'transfers': len(self.latencies_us),
+            'transactions': self.transactions,
+            'naks': self.naks,
+            'latency_us_min': "{:.1f}".format(latency_min),
+            'latency_us_mean': "{:.1f}".format(latency_mean),
+            'latency_us_max': "{:.1f}".format(latency_max),
+        }
+
+
+class BulkOutPipe(Pipe):
+    """Transfers are lists of bytes sent to the device"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.offset = 0
+
+    @cocotb.coroutine
+    def _drain(self, sent):
+        received = yield self.firmware.drain()
+        if received != sent:
+            raise TestFailure("{}: device received {}, sent {}".format(
+                self.name, bytes(received).hex(), bytes(sent).hex()))
+
+    @cocotb.coroutine
+    def transaction(self, harness, monitor):
+        _, data = self.transfers[0]
+        chunk = data[self.offset:self.offset + self.max_packet]
+        self.transactions += 1
+        response = yield out_transaction(harness, monitor, self.addr,
+                                         self.epnum, self.toggle, chunk)
+        if response.pid == PID.NAK:
+            self.naks += 1
+            return
+        self.toggle = toggled(self.toggle)
+        self.offset += len(chunk)
+        self.bytes += len(chunk)
+        if self.firmware is not None:
+            cocotb.fork(self._drain(chunk))
+        if self.offset >= len(data):
+            self.offset = 0
+            self._complete()
+
+
+class InPipe(Pipe):
+    """Transfers are byte counts read from the device, which the firmware
+    produces as a counting stream"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = 0
+        self.stream = 0
+
+    def _next_packet(self):
+        data = payload(self.stream, self.max_packet)
+        self.stream += self.max_packet
+        return data
+
+    @cocotb.coroutine
+    def start(self):
+        if self.firmware is not None:
+            yield self.firmware.arm(self._next_packet())
+
+    @cocotb.coroutine
+    def transaction(self, harness, monitor):
+        _, length = self.transfers[0]
+        self.transactions += 1
+        response = yield in_transaction(harness, monitor, self.addr,
+                                        self.epnum)
+        if response.pid == PID.NAK:
+            self.naks += 1
+            return
+        if response.pid != self.toggle:
+            # Retransmission of a packet we already have
+            return
+        self.toggle = toggled(self.toggle)
+        # Strip CRC16
+        data = response.data[:-2]
+        if self.firmware is not None:
+            if data != payload(self.stream - self.max_packet, len(data)):
+                raise TestFailure("{}: wrong data {}".format(
+                    self.name, bytes(data).hex()))
+            cocotb.fork(self.firmware.arm(self._next_packet()))
+        self.received += len(data)
+        self.bytes += len(data)
+        if self.received >= length or len(data) < self.max_packet:
+            self.received = 0
+            self._complete()
+
+
+class BulkInPipe(InPipe):
+    pass
+
+
+class InterruptInPipe(InPipe):
+    """Polled once every `interval` frames"""
+
+    periodic = True
+
+    def __init__(self, *args, interval=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = max(interval, 1)
+
+
+class ControlInPipe(Pipe):
+    """Control read transfers on EP0. Transfers are (setup, response)
+    pairs; with firmwares, the harness answers `response` `delay_us` after
+    the SETUP stage, as a firmware slow to handle the request would. The
+    SETUP packet is drained by `out_firmware`, under its lock."""
+
+    def __init__(self, name, addr, max_packet, in_firmware=None,
+                 out_firmware=None, delay_us=0):
+        super().__init__(name, addr, 0, max_packet, in_firmware)
+        self.out_firmware = out_firmware
+        self.delay_us = delay_us
+        self.stage = 'setup'
+        self.received = []
+
+    @cocotb.coroutine
+    def start(self):
+        if self.out_firmware is not None:
+            yield self.out_firmware.arm()
+
+    @cocotb.coroutine
+    def _answer(self, response):
+        if self.delay_us:
+            yield Timer(self.delay_us, 'us')
+        yield self.out_firmware.drain_setup()
+        yield self.firmware.arm(response)
+
+    @cocotb.coroutine
+    def transaction(self, harness, monitor):
+        _, (setup, response) = self.transfers[0]
+        self.transactions += 1
+        if self.stage == 'setup':
+            yield harness.transaction_setup(self.addr, setup)
+            self.stage = 'data'
+            self.toggle = PID.DATA1
+            self.received = []
+            if self.firmware is not None:
+                cocotb.fork(self._answer(response))
+        elif self.stage == 'data':
+            answer = yield in_transaction(harness, monitor, self.addr, 0)
+            if answer.pid == PID.NAK:
+                self.naks += 1
+                return
+            if answer.pid != self.toggle:
+                return
+            self.toggle = toggled(self.toggle)
+            data = answer.data[:-2]
+            self.received += data
+            self.bytes += len(data)
+            length = setup[6] | setup[7] << 8
+            if len(self.received) >= length or len(data) < self.max_packet:
+                if self.received != list(response[:length]):
+                    raise TestFailure("{}: wrong data {}".format(
+                        self.name, bytes(self.received).hex()))
+                self.stage = 'status'
+        else:
+            answer = yield out_transaction(harness, monitor, self.addr, 0,
+                                           PID.DATA1, [])
+            if answer.pid == PID.NAK:
+                self.naks += 1
+                return
+            if self.out_firmware is not None:
+                cocotb.fork(self.out_firmware.arm())
+            self.stage = 'setup'
+            self._complete()
+
+
+class Scheduler:
+    def __init__(self, harness, monitor, pipes):
+        self.harness = harness
+        self.monitor = monitor
+        self.pipes = pipes
+        self.frame = 0
+        # Called at the start of every frame, to submit new transfers
+        self.frame_callbacks = []
+        self.transaction_ns = transaction_ns(
+            max(pipe.max_packet for pipe in pipes))
+
+    @cocotb.coroutine
+    def run(self, duration_ns, first_frame=2):
+        for pipe in self.pipes:
+            yield pipe.start()
+        periodic = [pipe for pipe in self.pipes if pipe.periodic]
+        ring = [pipe for pipe in self.pipes if not pipe.periodic]
+        turn = 0
+        self.frame = first_frame
+        end = get_sim_time('ns') + duration_ns
+        while get_sim_time('ns') < end:
+            frame_end = get_sim_time('ns') + FRAME_NS
+            yield self.harness.host_send_sof(self.frame & 0x7ff)
+            for callback in self.frame_callbacks:
+                callback(self.frame)
+
+            for pipe in periodic:
+                if self.frame % pipe.interval == 0 and pipe.pending:
+                    yield pipe.transaction(self.harness, self.monitor)
+
+            while ring and frame_end - get_sim_time('ns') > \
+                    self.transaction_ns:
+                for _ in range(len(ring)):
+                    pipe = ring[turn % len(ring)]
+                    turn += 1
+                    if pipe.pending:
+                        break
+                else:
+                    break
+                yield pipe.transaction(self.harness, self.monitor)
+
+            self.frame += 1
+            remaining = frame_end - get_sim_time('ns')
+            if remaining > 0:
+                yield Timer(remaining, 'ns')
@@ -0,0 +1,231 @@
+"""Reference-model checking of the standard control requests
+
+The scoreboard follows every control transfer to the device on the bus
+monitor and checks the answers to the standard requests against what the
+UsbDevice descriptor model defines: the descriptors it holds, the current
+configuration and alternate settings, and the format of GET_STATUS answers.
+It also tracks the device address and configuration from SET_ADDRESS,
+SET_CONFIGURATION, SET_INTERFACE and port resets. Requests the model gives
+no answer for (class and vendor requests, descriptors it does not hold) are
+only counted.
+
+IN data is taken from the packets the host acknowledged, so data sent again
+after a lost handshake is seen once. A transfer is checked when its status
+stage starts, or as soon as the device stalls a request the model answers.
+"""
+
+from cocotb.result import TestFailure
+from cocotb_usb.usb.pid import PID
+
+# Standard request codes
+GET_STATUS = 0
+SET_ADDRESS = 5
+GET_DESCRIPTOR = 6
+GET_CONFIGURATION = 8
+SET_CONFIGURATION = 9
+GET_INTERFACE = 10
+SET_INTERFACE = 11
+
+DEVICE, CONFIGURATION, STRING = 1, 2, 3
+
+
+def model_descriptors(model):
+    """[(name, wValue, wIndex, bytes)] of the descriptors in the model"""
+    config = model.configDescriptor[1]
+    descriptors = [
+        ('device', 0x0100, 0, list(model.deviceDescriptor.get())),
+        ('configuration', 0x0200, 0,
+         list(config.get()[:config.wTotalLength])),
+    ]
+    indices = [idx for idx in (model.deviceDescriptor.iManufacturer,
+                               model.deviceDescriptor.iProduct,
+                               model.deviceDescriptor.iSerialNumber)
+               if idx != 0]
+    if indices:
+        descriptors.append(('string0', 0x0300, 0,
+                            list(model.stringDescriptor[0].get())))
+        lang_id = model.stringDescriptor[0].wLangId[0]
+        for idx in indices:
+            descriptors.append((
+                'string{}'.format(idx), 0x0300 | idx, lang_id,
+                list(model.stringDescriptor[lang_id][idx].get())))
+    return descriptors
+
+
+class Transfer:
+    def __init__(self, setup):
+        self.setup = setup
+        self.request_type = setup[0]
+        self.request = setup[1]
+        self.value = setup[2] | setup[3] << 8
+        self.index = setup[4] | setup[5] << 8
+        self.length = setup[6] | setup[7] << 8
+        self.device_to_host = bool(self.request_type & 0x80)
+        self.data = []
+        # PID of the last IN data packet the host acknowledged
+        self.toggle = None
+        self.stalled = False
+        self.checked = False
+
+    @property
+    def standard(self):
+        return self.request_type & 0x60 == 0
+
+    def __repr__(self):
+        return "request {}".format(bytes(self.setup).hex())
+
+
+class Scoreboard:
+    def __init__(self, model):
+        self.model = model
+        self.descriptors = {(value, index): data for _, value, index, data
+                            in model_descriptors(model)}
+        self.checked = 0
+        self.unchecked = 0
+        self.address = 0
+        self.configuration = 0
+        # {interface: alternate setting}
+        self.alternates = {}
+        self.transfer = None
+        self._token = None
+        self._pending = None
+
+    def attach(self, harness):
+        """Follow the traffic of the test using `harness`"""
+        harness.monitor.callbacks.append(self.packet)
+        port_reset = harness.port_reset
+
+        def wrapper(*args, **kwargs):
+            self.address = 0
+            self.configuration = 0
+            self.alternates = {}
+            return port_reset(*args, **kwargs)
+
+        harness.port_reset = wrapper
+
+    def has_configuration(self, value):
+        try:
+            self.model.configDescriptor[value]
+        except (IndexError, KeyError):
+            return False
+        return True
+
+    def descriptor(self, value, index):
+        """Bytes of the descriptor requested, None if not in the model"""
+        kind = value >> 8
+        if kind == DEVICE:
+            return self.descriptors.get((0x0100, 0))
+        if kind == CONFIGURATION:
+            return self.descriptors.get((value, 0))
+        if kind == STRING and value & 0xff == 0:
+            return self.descriptors.get((0x0300, 0))
+        return self.descriptors.get((value, index))
+
+    def expected(self, transfer):
+        """Data the model answers `transfer` with, a function checking the
+        data when the model only defines its format, or None"""
+        if not transfer.standard or not transfer.device_to_host:
+            return None
+        recipient = transfer.request_type & 0x1f
+        if transfer.request == GET_DESCRIPTOR and recipient == 0:
+            data = self.descriptor(transfer.value, transfer.index)
+            return None if data is None else data[:transfer.length]
+        if transfer.request == GET_CONFIGURATION:
+            return [self.configuration]
+        if transfer.request == GET_INTERFACE and self.configuration:
+            return [self.alternates.get(transfer.index, 0)]
+        if transfer.request == GET_STATUS:
+            # Self powered and remote wakeup bits for the device, halt bit
+            # for an endpoint, nothing for an interface
+            mask = (0x03, 0x00, 0x01)[recipient] if recipient < 3 else 0xff
+            return lambda data: len(data) == 2 and not data[0] & ~mask and \
+                data[1] == 0
+        return None
+
+    def check(self, transfer):
+        if transfer.checked:
+            return
+        transfer.checked = True
+        expected = self.expected(transfer)
+        if expected is None:
+            self.unchecked += 1
+            return
+        self.checked += 1
+        if transfer.stalled:
+            raise TestFailure("Device stalled {}".format(transfer))
+        if callable(expected):
+            if not expected(transfer.data):
+                raise TestFailure("Invalid answer {} to {}".format(
+                    bytes(transfer.data).hex(), transfer))
+        elif transfer.data != expected:
+            raise TestFailure("Answer to {}: got {}, expected {}".format(
+                transfer, bytes(transfer.data).hex(), bytes(expected).hex()))
+
+    def complete(self, transfer):
+        """Status stage acknowledged, apply the effects of the request"""
+        if not transfer.standard or transfer.device_to_host:
+            return
+        if transfer.request == SET_ADDRESS:
+            self.address = transfer.value & 0x7f
+        elif transfer.request == SET_CONFIGURATION:
+            if transfer.value and not self.has_configuration(transfer.value):
+                raise TestFailure("Device accepted {} for a configuration not "
+                                  "in the model".format(transfer))
+            self.configuration = transfer.value
+            self.alternates = {}
+        elif transfer.request == SET_INTERFACE:
+            self.alternates[transfer.index] = transfer.value
+
+    def packet(self, packet):
+        """Bus monitor callback"""
+        if not packet.valid:
+            return
+        pid = packet.pid
+        transfer = self.transfer
+        if packet.device:
+            if self._token is None or transfer is None:
+                return
+            if self._token == PID.IN and pid in (PID.DATA0, PID.DATA1):
+                self._pending = packet
+            elif pid == PID.STALL:
+                transfer.stalled = True
+                if self._token == PID.IN and transfer.device_to_host:
+                    self.check(transfer)
+            return
+        if packet.is_token:
+            self._pending = None
+            ours = packet.addr == self.address and packet.endp == 0
+            self._token = pid if ours else None
+            if not ours or transfer is None:
+                return
+            if pid == PID.OUT and transfer.device_to_host:
+                # Status stage of a control read
+                self.check(transfer)
+        elif pid == PID.DATA0 and self._token == PID.SETUP:
+            if self.transfer is not None and not self.transfer.checked and \
+                    self.transfer.device_to_host:
+                # Aborted by the new SETUP, the host read only part of it
+                self.unchecked += 1
+            self.transfer = Transfer(packet.data[:-2]) \
+                if len(packet.data) == 10 else None
+        elif pid == PID.ACK and self._pending is not None:
+            data = self._pending
+            self._pending = None
+            if transfer.device_to_host:
+                if data.pid != transfer.toggle:
+                    transfer.data += data.data[:-2]
+                    transfer.toggle = data.pid
+            elif len(data.data) == 2:
+                # Zero-length status stage of a control write
+                self.complete(transfer)
+                self.transfer = None
+        elif pid == PID.SOF:
+            self._token = None
+
+    def report(self, result):
+        """at_test_end() callback: returns the request counts as results.xml
+        properties"""
+        return {
+            'scoreboard_checked': self.checked,
+            'scoreboard_unchecked': self.unchecked,
+        }
@@ -0,0 +1,102 @@
+"""Persistent simulator server
+
+Used as the test module of a simulation (see `make serve`), it keeps the
+design loaded and runs test jobs received on a local socket one after
+another, so elaboration is paid once per worker instead of once per test.
+
+A job is a dictionary naming the test module and the test function, e.g.
+`{'module': 'tests.test-sof', 'test': 'test_sof_stuffing'}`, optionally with
+an `env` dictionary exported before the test starts. Every job starts from
+the environment of the server plus its own `env`, and its test module is
+reloaded so that settings read at import time follow the job too. The
+result of every job is sent back as soon as the test finishes. Sending
+`None` stops the server.
+See tools/simclient.py for the client side.
+"""
+
+import importlib
+import os
+import sys
+from multiprocessing.connection import Listener
+
+from cocotb.decorators import test as Test
+from cocotb.regression import RegressionManager
+
+from tests.harness import at_test_end
+
+SOCKET = os.environ.get('SIM_SERVER', 'sim.sock')
+
+_conn = None
+# Environment the server was started with, restored before every job
+_environ = dict(os.environ)
+
+
+def _receive_job():
+    """Block until a client sends a job, accepting new clients as needed"""
+    global _conn
+    while True:
+        if _conn is None:
+            _conn = _listener.accept()
+        try:
+            return _conn.recv()
+        except EOFError:
+            # Client went away, wait for the next one
+            _conn.close()
+            _conn = None
+
+
+def _set_environment(env):
+    os.environ.clear()
+    os.environ.update(_environ)
+    os.environ.update(env)
+
+
+def _load_test(job):
+    module = sys.modules.get(job['module'])
+    if module is None:
+        module = importlib.import_module(job['module'])
+    else:
+        module = importlib.reload(module)
+    test = getattr(module, job['test'])
+    if not isinstance(test, Test):
+        raise ValueError("{} is not a cocotb test".format(job['test']))
+    return test
+
+
+def next_test(self):
+    """Replacement for RegressionManager.next_test taking tests from clients"""
+    while True:
+        job = _receive_job()
+        if job is None:
+            _listener.close()
+            return None
+
+        _set_environment(job.get('env', {}))
+        try:
+            test = _load_test(job)
+        except Exception as e:
+            _conn.send({
+                'test': '.'.join([job['module'], job['test']]),
+                'pass': False,
+                'error': repr(e)})
+            continue
+
+        # Keep the DUT in reset until the harness of the job releases it,
+        # so no state leaks from the previous job
+        self._dut.reset.setimmediatevalue(1)
+        self.count += 1
+        self.ntests += 1
+        return test
+
+
+def _send_result(result):
+    if _conn is not None:
+        _conn.send(result)
+
+
+if os.path.exists(SOCKET):
+    os.unlink(SOCKET)
+_listener = Listener(SOCKET, family='AF_UNIX')
+
+RegressionManager.next_test = next_test
+at_test_end(_send_result, persistent=True)
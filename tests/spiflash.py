@@ -0,0 +1,142 @@
+"""SPI front-end of the flash model, driving the flash pins of the testbench
+
+Implements the commands used by bootloaders on 25-series SPI NOR flashes
+in SPI mode 0. Erase and program make the flash busy (WIP set in the status
+register) for the time the flash model returns, scaled by `time_scale`.
+"""
+
+import cocotb
+from cocotb.triggers import FallingEdge, First, RisingEdge
+from cocotb.utils import get_sim_time
+
+from tests.flash import FlashModel
+
+# JEDEC ID of an AT25SF081, the flash of the TinyFPGA BX
+JEDEC_ID = (0x1f, 0x85, 0x01)
+
+READ = 0x03
+FAST_READ = 0x0b
+PAGE_PROGRAM = 0x02
+SECTOR_ERASE = 0x20
+BLOCK_ERASE_32K = 0x52
+BLOCK_ERASE_64K = 0xd8
+WRITE_ENABLE = 0x06
+WRITE_DISABLE = 0x04
+READ_STATUS = 0x05
+READ_ID = 0x9f
+POWER_DOWN = 0xb9
+RELEASE_POWER_DOWN = 0xab
+
+ERASE_SIZES = {
+    SECTOR_ERASE: 4096,
+    BLOCK_ERASE_32K: 32768,
+    BLOCK_ERASE_64K: 65536,
+}
+
+STATUS_WIP = 0x01
+STATUS_WEL = 0x02
+
+
+class SpiFlash:
+    def __init__(self, dut, flash=None, time_scale=1.0, prefix='spiflash_'):
+        self.dut = dut
+        self.flash = flash or FlashModel()
+        self.time_scale = time_scale
+        self.cs_n = getattr(dut, prefix + 'cs_n')
+        self.clk = getattr(dut, prefix + 'clk')
+        self.mosi = getattr(dut, prefix + 'mosi')
+        self.miso = getattr(dut, prefix + 'miso')
+        self.write_enabled = False
+        self.busy_until = 0
+        self.commands = {}
+        self._task = None
+
+    def start(self):
+        self.miso <= 0
+        if self._task is None:
+            self._task = cocotb.fork(self._run())
+
+    @property
+    def busy(self):
+        return get_sim_time('ns') < self.busy_until
+
+    def _set_busy(self, busy_us):
+        self.busy_until = get_sim_time('ns') + busy_us * 1e3 * \
+            self.time_scale
+        self.write_enabled = False
+
+    def _status(self):
+        return (STATUS_WIP if self.busy else 0) | \
+            (STATUS_WEL if self.write_enabled else 0)
+
+    @staticmethod
+    def _addr(command):
+        return command[1] << 16 | command[2] << 8 | command[3]
+
+    def _output(self, command):
+        """Byte sent after the bytes of `command` received so far"""
+        opcode = command[0]
+        index = len(command)
+        if opcode == READ_STATUS:
+            return self._status()
+        if opcode == READ_ID:
+            return JEDEC_ID[(index - 1) % len(JEDEC_ID)]
+        # Data follows the address, and a dummy byte for FAST_READ
+        start = 4 if opcode == READ else 5
+        if opcode in (READ, FAST_READ) and index >= start:
+            return self.flash.data[(self._addr(command) + index - start) %
+                                   self.flash.size]
+        return 0xff
+
+    def _finish(self, command):
+        """Execute `command` once chip select goes up"""
+        opcode = command[0]
+        self.commands[opcode] = self.commands.get(opcode, 0) + 1
+        if opcode == WRITE_ENABLE and not self.busy:
+            self.write_enabled = True
+        elif opcode == WRITE_DISABLE:
+            self.write_enabled = False
+        elif opcode in ERASE_SIZES and len(command) >= 4:
+            if self.write_enabled and not self.busy:
+                self._set_busy(self.flash.erase(self._addr(command),
+                                                ERASE_SIZES[opcode]))
+        elif opcode == PAGE_PROGRAM and len(command) > 4:
+            if self.write_enabled and not self.busy:
+                addr = self._addr(command)
+                page = addr - addr % self.flash.page_size
+                data = command[4:][-self.flash.page_size:]
+                # Data past the end of the page wraps to its start
+                for i, byte in enumerate(data):
+                    offset = page + (addr - page + i) % self.flash.page_size
+                    self.flash.data[offset] &= byte
+                self.flash.busy_us += self.flash.page_program_us
+                self._set_busy(self.flash.page_program_us)
+
+    @cocotb.coroutine
+    def _run(self):
+        while True:
+            if not self.cs_n.value.is_resolvable or int(self.cs_n.value):
+                yield FallingEdge(self.cs_n)
+            command = []
+            byte = 0
+            bits = 0
+            out = 0xff
+            self.miso <= 1
+            deselect = RisingEdge(self.cs_n)
+            while True:
+                trigger = yield First(RisingEdge(self.clk), deselect)
+                if trigger is deselect:
+                    break
+                byte = (byte << 1) | int(self.mosi.value)
+                bits += 1
+                if bits == 8:
+                    command.append(byte)
+                    out = self._output(command)
+                    byte = bits = 0
+                trigger = yield First(FallingEdge(self.clk), deselect)
+                if trigger is deselect:
+                    break
+                self.miso <= (out >> (7 - bits)) & 1
+            self.miso <= 0
+            if command:
+                self._finish(command)
@@ -35,7 +35,7 @@ from os import environ
 
 import cocotb
 from cocotb.utils import get_sim_time
-from cocotb_usb.harness import get_harness
+from tests.harness import get_harness
 from cocotb_usb.device import UsbDevice
 from cocotb_usb.usb.endpoint import EndpointType
 from cocotb_usb.usb.pid import PID
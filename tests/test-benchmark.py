@@ -0,0 +1,70 @@
+"""Fixed scenarios measuring simulation performance, see tools/benchmark.py
+
+The scenarios should stay the same between runs, otherwise the history of
+results is not comparable.
+"""
+
+import importlib
+from os import environ
+
+import cocotb
+from tests.harness import get_harness
+from cocotb_usb.device import UsbDevice
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+
+# Bytes read from EP0 in the control IN scenario
+CONTROL_IN_BYTES = 1024
+# SOF packets sent in the SOF burst scenario
+SOF_COUNT = 100
+
+# The enumeration scenario is the one of test-enum
+test_enumeration = importlib.import_module('tests.test-enum').test_enumeration
+
+
+@cocotb.coroutine
+def connect(harness):
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+
+
+@cocotb.test()
+def test_control_in_1k(dut):
+    """Read the configuration descriptor until 1 KB went through EP0"""
+    harness = get_harness(dut)
+    yield connect(harness)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+
+    total_config_len = model.configDescriptor[1].wTotalLength
+    config = model.configDescriptor[1].get()[:total_config_len]
+    received = 0
+    while received < CONTROL_IN_BYTES:
+        yield harness.get_configuration_descriptor(length=total_config_len,
+                                                   response=config)
+        received += total_config_len
+
+
+@cocotb.test()
+def test_sof_burst(dut):
+    harness = get_harness(dut)
+    yield connect(harness)
+    for frame in range(2, SOF_COUNT + 2):
+        yield harness.host_send_sof(frame)
+
+
+@cocotb.test()
+def test_idle(dut):
+    """Simulate an idle millisecond of a connected device"""
+    harness = get_harness(dut)
+    yield connect(harness)
+    yield harness.wait(1e3, units="us")
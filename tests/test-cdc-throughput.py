@@ -0,0 +1,253 @@
+"""CDC-ACM data channel throughput (valentyusb)
+
+After setting up the serial line, streams data through the bulk OUT and IN
+endpoints of the data interface for CDC_DURATION_MS of simulated time
+(default 5). The harness plays the firmware of the core: it refills the IN
+endpoint with a pseudo-random stream and drains the OUT endpoint, and at
+random times queues SERIAL_STATE notifications on the interrupt endpoint,
+which the host polls every bInterval frames.
+
+Both streams are checked with rolling Adler-32 checksums: IN data received
+by the host against the stream queued by the firmware, OUT data read out of
+the core FIFO by the firmware against the stream sent by the host.
+Throughput per direction and notification latency are reported.
+"""
+
+import random
+import zlib
+from os import environ
+
+import cocotb
+from cocotb.result import TestFailure
+from cocotb.triggers import Event, Lock, Timer
+from cocotb.utils import get_sim_time
+from tests.harness import (get_harness, min_mean_max, report_properties,
+                           skip_if)
+from tests.monitor import UsbMonitor
+from tests.transfers import (HarnessFirmware, find_endpoints, in_transaction,
+                             out_transaction, toggled, transaction_ns)
+from cocotb_usb.descriptors.cdc import (setLineCoding, setControlLineState,
+                                        LineCodingStructure)
+from cocotb_usb.device import UsbDevice
+from cocotb_usb.usb.endpoint import EndpointType
+from cocotb_usb.usb.pid import PID
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+INTERFACE = 1
+DURATION_MS = float(environ.get('CDC_DURATION_MS', '5'))
+FRAME_NS = 1e6
+# Notification endpoint used when the descriptors have no interrupt IN
+NOTIFY_EP = 3
+# Time between a notification being read and the next one being queued
+NOTIFY_DELAY_US = (100, 2000)
+# CDC SERIAL_STATE notification
+SERIAL_STATE = 0x20
+
+
+def serial_state(state):
+    return [0xa1, SERIAL_STATE, 0, 0, INTERFACE, 0, 2, 0,
+            state & 0xff, state >> 8]
+
+
+class Notifier:
+    """Firmware side of the interrupt endpoint, queueing a notification
+    whenever the previous one was read by the host"""
+
+    def __init__(self, firmware):
+        self.firmware = firmware
+        self.rng = random.Random(0)
+        self.expected = None
+        self.queued_at = None
+        self.latencies_us = []
+        self.delivered = Event()
+
+    @cocotb.coroutine
+    def run(self):
+        state = 0
+        while True:
+            yield Timer(self.rng.randint(*NOTIFY_DELAY_US), 'us')
+            state = (state + 1) & 0x7f
+            self.expected = serial_state(state)
+            self.delivered.clear()
+            yield self.firmware.arm(self.expected)
+            self.queued_at = get_sim_time('ns')
+            yield self.delivered.wait()
+
+    def received(self, data):
+        if self.queued_at is None:
+            raise TestFailure("Notification received before being queued")
+        if data != self.expected:
+            raise TestFailure("Wrong notification: " + bytes(data).hex())
+        self.latencies_us.append((get_sim_time('ns') - self.queued_at) / 1e3)
+        self.queued_at = None
+        self.delivered.set()
+
+
+@cocotb.coroutine
+def setup_serial(harness):
+    yield harness.reset()
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(1e3)
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.set_configuration(1)
+    line_coding = LineCodingStructure(115200,
+                                      LineCodingStructure.STOP_BITS_1,
+                                      LineCodingStructure.PARITY_NONE,
+                                      LineCodingStructure.DATA_BITS_8)
+    yield harness.control_transfer_out(DEVICE_ADDRESS,
+                                       setLineCoding(INTERFACE),
+                                       line_coding.get())
+    yield harness.control_transfer_out(
+        DEVICE_ADDRESS,
+        setControlLineState(interface=0, rts=1, dtr=1),
+        None)
+
+
+@cocotb.coroutine
+def drain(firmware, checksums):
+    """Firmware side of the OUT endpoint, checksumming what the core
+    received"""
+    data = yield firmware.drain()
+    checksums['device_out'] = zlib.adler32(bytes(data),
+                                           checksums['device_out'])
+
+
+def skip_reason():
+    if environ.get('TARGET') != 'valentyusb':
+        return "needs the harness to act as firmware"
+    if environ.get('VALENTYUSB_VARIANT', 'eptri') != 'eptri':
+        return "the harness firmware drives the eptri CSRs"
+    bulk = find_endpoints(descriptorFile, 'Bulk')
+    if 'in' not in bulk or 'out' not in bulk:
+        return "target has no bulk endpoints"
+    return None
+
+
+@cocotb.test(skip=skip_if(skip_reason()))
+def test_cdc_throughput(dut):
+    harness = get_harness(dut)
+    bulk = find_endpoints(descriptorFile, 'Bulk')
+    out_ep, out_size, _ = bulk['out']
+    in_ep, in_size, _ = bulk['in']
+    notify_ep, _, interval = find_endpoints(descriptorFile, 'Interrupt').get(
+        'in', (NOTIFY_EP, 16, 1))
+    interval = max(interval, 1)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+    yield setup_serial(harness)
+
+    lock = Lock()
+    out_firmware = HarnessFirmware(
+        harness, EndpointType.epaddr(out_ep, EndpointType.OUT), lock)
+    in_firmware = HarnessFirmware(
+        harness, EndpointType.epaddr(in_ep, EndpointType.IN), lock)
+    notifier = Notifier(HarnessFirmware(
+        harness, EndpointType.epaddr(notify_ep, EndpointType.IN), lock))
+
+    rng = random.Random(1)
+    in_queued = [rng.getrandbits(8) for _ in range(in_size)]
+    yield out_firmware.arm()
+    yield in_firmware.arm(in_queued)
+    notify_task = cocotb.fork(notifier.run())
+
+    slot_ns = transaction_ns(max(in_size, out_size))
+    toggles = {'out': PID.DATA0, 'in': PID.DATA0, 'notify': PID.DATA0}
+    checksums = {'host_out': 1, 'device_out': 1, 'host_in': 1,
+                 'device_in': 1}
+    drain_task = None
+    transferred = {'out': 0, 'in': 0}
+    naks = {'out': 0, 'in': 0, 'notify': 0}
+    frame = 2
+    start = get_sim_time('ns')
+    end = start + DURATION_MS * 1e6
+
+    while get_sim_time('ns') < end:
+        frame_end = get_sim_time('ns') + FRAME_NS
+        yield harness.host_send_sof(frame & 0x7ff)
+        frame += 1
+
+        # Periodic transfers come first in the frame
+        if frame % interval == 0:
+            response = yield in_transaction(harness, monitor,
+                                            DEVICE_ADDRESS, notify_ep)
+            if response.pid == PID.NAK:
+                naks['notify'] += 1
+            elif response.pid == toggles['notify']:
+                toggles['notify'] = toggled(response.pid)
+                notifier.received(response.data[:-2])
+
+        direction = 'out'
+        while frame_end - get_sim_time('ns') > slot_ns:
+            if direction == 'out':
+                data = [rng.getrandbits(8) for _ in range(out_size)]
+                response = yield out_transaction(
+                    harness, monitor, DEVICE_ADDRESS, out_ep,
+                    toggles['out'], data)
+                if response.pid == PID.ACK:
+                    checksums['host_out'] = zlib.adler32(
+                        bytes(data), checksums['host_out'])
+                    transferred['out'] += len(data)
+                    toggles['out'] = toggled(toggles['out'])
+                    drain_task = cocotb.fork(drain(out_firmware, checksums))
+                else:
+                    naks['out'] += 1
+            else:
+                response = yield in_transaction(harness, monitor,
+                                                DEVICE_ADDRESS, in_ep)
+                if response.pid == PID.NAK:
+                    naks['in'] += 1
+                elif response.pid == toggles['in']:
+                    toggles['in'] = toggled(toggles['in'])
+                    checksums['host_in'] = zlib.adler32(
+                        bytes(response.data[:-2]), checksums['host_in'])
+                    checksums['device_in'] = zlib.adler32(
+                        bytes(in_queued), checksums['device_in'])
+                    transferred['in'] += len(response.data) - 2
+                    in_queued = [rng.getrandbits(8) for _ in range(in_size)]
+                    cocotb.fork(in_firmware.arm(in_queued))
+            direction = 'in' if direction == 'out' else 'out'
+
+        if drain_task is not None:
+            # The last packet of the frame may still be in the FIFO
+            yield drain_task.join()
+        for stream in ('out', 'in'):
+            host = checksums['host_' + stream]
+            other = checksums['device_' + stream]
+            if host != other:
+                raise TestFailure(
+                    "{} stream checksum mismatch in frame {}: "
+                    "{:08x} != {:08x}".format(stream.upper(), frame - 1,
+                                              host, other))
+        remaining = frame_end - get_sim_time('ns')
+        if remaining > 0:
+            yield Timer(remaining, 'ns')
+
+    notify_task.kill()
+    monitor.stop()
+    elapsed_s = (get_sim_time('ns') - start) / 1e9
+    if not transferred['out'] or not transferred['in']:
+        raise TestFailure("No data went through: {}".format(transferred))
+    latency_min, latency_mean, latency_max = min_mean_max(
+        notifier.latencies_us)
+    properties = {
+        'cdc_duration_ms': DURATION_MS,
+        'cdc_out_bytes_per_s': "{:.0f}".format(
+            transferred['out'] / elapsed_s),
+        'cdc_in_bytes_per_s': "{:.0f}".format(transferred['in'] / elapsed_s),
+        'cdc_out_naks': naks['out'],
+        'cdc_in_naks': naks['in'],
+        'cdc_out_checksum': "{:08x}".format(checksums['host_out']),
+        'cdc_in_checksum': "{:08x}".format(checksums['host_in']),
+        'cdc_notifications': len(notifier.latencies_us),
+        'cdc_notify_latency_us_min': "{:.1f}".format(latency_min),
+        'cdc_notify_latency_us_mean': "{:.1f}".format(latency_mean),
+        'cdc_notify_latency_us_max': "{:.1f}".format(latency_max),
+    }
+    report_properties(dut, properties)
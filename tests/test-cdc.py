@@ -1,7 +1,7 @@
 import cocotb
 from cocotb.triggers import Timer
 
-from cocotb_usb.harness import get_harness
+from tests.harness import get_harness
 from cocotb_usb.device import UsbDevice
 from cocotb_usb.descriptors.cdc import (setLineCoding, setControlLineState,
                                         getLineCoding, LineCodingStructure)
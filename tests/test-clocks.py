@@ -3,7 +3,7 @@ from os import environ
 import cocotb
 from cocotb.clock import Clock
 
-from cocotb_usb.harness import get_harness
+from tests.harness import get_harness
 from cocotb_usb.device import UsbDevice
 from cocotb_usb.clocks import UnstableClock
 
@@ -0,0 +1,195 @@
+"""Concurrent traffic on several endpoints (valentyusb eptri and epfifo)
+
+Runs the host traffic model of tests/scheduler.py with, in the same frames:
+a GET_DESCRIPTOR control read on EP0 submitted every frame, the bulk OUT
+and IN endpoints kept busy with SCHED_BULK_BYTES transfers, and an
+interrupt IN endpoint polled every bInterval frames. The harness plays the
+firmware and answers the control requests `control_delay_us` after their
+SETUP stage, showing whether a slow control request starves the data
+pipes. Throughput and transfer latency are reported per endpoint.
+
+On eptri, the harness firmware drives the CSRs of the core, the device is
+enumerated first. With SCHED_ENDPOINTS=N, the descriptors are ignored and
+every endpoint from EP1 to EP(N-1) gets a bulk OUT and a bulk IN pipe, to
+match cores built with N endpoints.
+
+On epfifo, the harness drives the FIFO and CSRs of every endpoint
+(tests.transfers.FifoFirmware). The endpoints are the ones the core was
+built with, found in its register map: every data endpoint gets bulk
+pipes for the directions it has, and there is no interrupt pipe. The core
+has no address register the harness knows of, so the device stays at
+address 0 and SET_ADDRESS and SET_CONFIGURATION are not sent. The dummy
+variant has no endpoints and is skipped.
+
+SCHED_DURATION_MS sets the simulated time of the traffic.
+"""
+
+from os import environ
+
+import cocotb
+from cocotb.regression import TestFactory
+from cocotb.triggers import Lock
+from cocotb.utils import get_sim_time
+from tests.harness import get_harness, report_properties, skip_generated
+from tests.monitor import UsbMonitor
+from tests.scheduler import (BulkInPipe, BulkOutPipe, ControlInPipe,
+                             InterruptInPipe, Scheduler, payload)
+from tests.transfers import (MAX_BULK_PACKET, FifoFirmware, HarnessFirmware,
+                             fifo_endpoints, find_endpoints)
+from cocotb_usb.device import UsbDevice
+from cocotb_usb.usb.endpoint import EndpointType
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+DURATION_MS = float(environ.get('SCHED_DURATION_MS', '5'))
+BULK_BYTES = int(environ.get('SCHED_BULK_BYTES', '512'), 0)
+ENDPOINTS = int(environ.get('SCHED_ENDPOINTS', '0'))
+# Interrupt endpoint used when the descriptors have none
+INTERRUPT_EP = 3
+INTERRUPT_PACKET = 8
+GET_DEVICE_DESCRIPTOR = [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 18, 0x00]
+
+VARIANT = environ.get('VALENTYUSB_VARIANT', 'eptri')
+if environ.get('TARGET') != 'valentyusb':
+    SKIP_REASON = "needs the harness to act as firmware"
+elif VARIANT not in ('eptri', 'epfifo'):
+    SKIP_REASON = "{} has no endpoints to schedule".format(VARIANT)
+else:
+    SKIP_REASON = None
+
+
+def control_pipe(address, firmware, control_delay_us):
+    return ControlInPipe('ep0', address,
+                         model.deviceDescriptor.bMaxPacketSize0,
+                         firmware(0, EndpointType.IN),
+                         firmware(0, EndpointType.OUT),
+                         control_delay_us)
+
+
+def build_fifo_pipes(harness, control_delay_us):
+    """Pipes of the endpoints of the epfifo core, at address 0, with the
+    harness acting as their firmware"""
+    lock = Lock()
+
+    def firmware(epnum, direction):
+        return FifoFirmware(harness, epnum, direction, lock)
+
+    pipes = [control_pipe(0, firmware, control_delay_us)]
+    for epnum, directions in sorted(fifo_endpoints().items()):
+        if epnum == 0:
+            continue
+        if EndpointType.OUT in directions:
+            pipes.append(BulkOutPipe('ep{}out'.format(epnum), 0, epnum,
+                                     MAX_BULK_PACKET,
+                                     firmware(epnum, EndpointType.OUT)))
+        if EndpointType.IN in directions:
+            pipes.append(BulkInPipe('ep{}in'.format(epnum), 0, epnum,
+                                    MAX_BULK_PACKET,
+                                    firmware(epnum, EndpointType.IN)))
+    return pipes
+
+
+def build_pipes(harness, control_delay_us):
+    """Pipes of the endpoints in the descriptors, with the harness acting
+    as their firmware"""
+    lock = Lock()
+
+    def firmware(epnum, direction):
+        return HarnessFirmware(harness, EndpointType.epaddr(epnum, direction),
+                               lock)
+
+    pipes = [control_pipe(DEVICE_ADDRESS, firmware, control_delay_us)]
+    if ENDPOINTS:
+        for epnum in range(1, ENDPOINTS):
+            pipes.append(BulkOutPipe('ep{}out'.format(epnum),
+                                     DEVICE_ADDRESS, epnum, MAX_BULK_PACKET,
+                                     firmware(epnum, EndpointType.OUT)))
+            pipes.append(BulkInPipe('ep{}in'.format(epnum), DEVICE_ADDRESS,
+                                    epnum, MAX_BULK_PACKET,
+                                    firmware(epnum, EndpointType.IN)))
+        return pipes
+
+    bulk = find_endpoints(descriptorFile, 'Bulk')
+    interrupt = find_endpoints(descriptorFile, 'Interrupt').get(
+        'in', (INTERRUPT_EP, INTERRUPT_PACKET, 1))
+    if 'out' in bulk:
+        epnum, size, _ = bulk['out']
+        pipes.append(BulkOutPipe('ep{}out'.format(epnum), DEVICE_ADDRESS,
+                                 epnum, size,
+                                 firmware(epnum, EndpointType.OUT)))
+    if 'in' in bulk:
+        epnum, size, _ = bulk['in']
+        pipes.append(BulkInPipe('ep{}in'.format(epnum), DEVICE_ADDRESS,
+                                epnum, size,
+                                firmware(epnum, EndpointType.IN)))
+    epnum, size, interval = interrupt
+    pipes.append(InterruptInPipe('ep{}int'.format(epnum), DEVICE_ADDRESS,
+                                 epnum, size,
+                                 firmware(epnum, EndpointType.IN),
+                                 interval=interval))
+    return pipes
+
+
+def keep_busy(pipes):
+    """Frame callback submitting a new transfer to every idle pipe"""
+    descriptor = list(model.deviceDescriptor.get())
+
+    def submit(frame):
+        for pipe in pipes:
+            if pipe.pending:
+                continue
+            if isinstance(pipe, ControlInPipe):
+                pipe.submit((GET_DEVICE_DESCRIPTOR, descriptor))
+            elif isinstance(pipe, BulkOutPipe):
+                pipe.submit(payload(frame, BULK_BYTES))
+            elif isinstance(pipe, BulkInPipe):
+                pipe.submit(BULK_BYTES)
+            else:
+                pipe.submit(pipe.max_packet)
+
+    return submit
+
+
+@cocotb.coroutine
+def run_concurrent(dut, control_delay_us):
+    harness = get_harness(dut)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    if VARIANT == 'epfifo':
+        pipes = build_fifo_pipes(harness, control_delay_us)
+    else:
+        yield harness.set_device_address(DEVICE_ADDRESS)
+        yield harness.set_configuration(1)
+        pipes = build_pipes(harness, control_delay_us)
+    scheduler = Scheduler(harness, monitor, pipes)
+    scheduler.frame_callbacks.append(keep_busy(pipes))
+    start = get_sim_time('ns')
+    yield scheduler.run(DURATION_MS * 1e6)
+    elapsed_s = (get_sim_time('ns') - start) / 1e9
+
+    properties = {
+        'sched_variant': VARIANT,
+        'sched_control_delay_us': control_delay_us,
+        'sched_endpoints': len({pipe.epnum for pipe in pipes}),
+    }
+    for pipe in pipes:
+        for name, value in pipe.report(elapsed_s).items():
+            properties['sched_{}_{}'.format(pipe.name, name)] = value
+    report_properties(dut, properties)
+
+
+factory = TestFactory(run_concurrent)
+factory.add_option('control_delay_us', [0, 500])
+factory.generate_tests()
+skip_generated(factory, lambda control_delay_us: SKIP_REASON)
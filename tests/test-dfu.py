@@ -0,0 +1,186 @@
+"""DFU download throughput (foboot)
+
+Downloads an image with DFU_DNLOAD / DFU_GETSTATUS cycles and measures
+the effective throughput in KB per simulated second. The simulated SoC has
+no SPI flash, so the image written is not read back and the device is not
+slowed down by flash programming. The blocks are also written to a flash
+model (tests/flash.py) standing in for the missing flash: its erase and
+program time is reported, and added to the throughput figure for the part
+of it not already covered by the status polling.
+
+Between GETSTATUS requests the host either waits the bwPollTimeout the
+device asked for ('honor'), polls at once ('immediate') or waits as long
+as the flash model is busy with the block ('flash').
+
+The image size is set with DFU_IMAGE_SIZE.
+"""
+
+import json
+import random
+from os import environ
+
+import cocotb
+from cocotb.regression import TestFactory
+from cocotb.result import TestFailure
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time
+from tests.flash import FlashModel
+from tests.harness import get_harness, report_properties, skip_generated
+from tests.monitor import UsbMonitor
+from tests.transfers import control_read
+from cocotb_usb.device import UsbDevice
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+DFU_INTERFACE = 0
+IMAGE_SIZE = int(environ.get('DFU_IMAGE_SIZE', '4096'), 0)
+# Limit of GETSTATUS requests after a single block
+MAX_POLLS = 1000
+
+# DFU class requests
+DFU_DNLOAD = 1
+DFU_GETSTATUS = 3
+
+# DFU states
+DFU_IDLE = 2
+DFU_DNLOAD_SYNC = 3
+DFU_DNBUSY = 4
+DFU_DNLOAD_IDLE = 5
+DFU_MANIFEST_SYNC = 6
+DFU_MANIFEST = 7
+DFU_MANIFEST_WAIT_RESET = 8
+DFU_ERROR = 10
+
+
+def transfer_size(descriptor_file):
+    """Returns wTransferSize of the DFU functional descriptor, or None"""
+    with open(descriptor_file, 'r') as f:
+        descriptors = json.load(f)
+    for configuration in descriptors:
+        for interface in configuration.get('Interface', []):
+            for sub in interface.get('Subdescriptors', []):
+                if sub.get('name') == 'DFU Functional':
+                    return sub['wTransferSize']
+    return None
+
+
+def dfu_request(request, value, length, direction_in=False):
+    """Class request to the DFU interface"""
+    return [0xa1 if direction_in else 0x21, request,
+            value & 0xff, value >> 8,
+            DFU_INTERFACE, 0,
+            length & 0xff, length >> 8]
+
+
+class DfuStatus:
+    def __init__(self, data):
+        if len(data) != 6:
+            raise TestFailure("DFU_GETSTATUS returned {} bytes".format(
+                len(data)))
+        self.status = data[0]
+        self.poll_timeout_ms = data[1] | data[2] << 8 | data[3] << 16
+        self.state = data[4]
+
+
+@cocotb.coroutine
+def get_status(harness, monitor):
+    data = yield control_read(harness, monitor, DEVICE_ADDRESS,
+                              dfu_request(DFU_GETSTATUS, 0, 6, True))
+    return DfuStatus(data)
+
+
+@cocotb.coroutine
+def run_dfu_download(dut, block_size, poll_mode):
+    harness = get_harness(dut)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.set_configuration(1)
+
+    image = bytes(random.Random(IMAGE_SIZE).getrandbits(8)
+                  for _ in range(IMAGE_SIZE))
+    flash = FlashModel(size=max(1 << 20, IMAGE_SIZE))
+    polls = 0
+    poll_wait_us = 0
+    # Flash time of the blocks that outlasted their status polling
+    flash_extra_us = 0
+    start = get_sim_time('ns')
+
+    blocks = [image[i:i + block_size]
+              for i in range(0, len(image), block_size)]
+    # A zero length download ends the transfer
+    for block_num, block in enumerate(blocks + [b'']):
+        yield harness.control_transfer_out(
+            DEVICE_ADDRESS,
+            dfu_request(DFU_DNLOAD, block_num, len(block)),
+            list(block) if block else None)
+        flash_us = flash.write(block_num * block_size, block) if block else 0
+        block_busy_us = flash_us
+        polled = get_sim_time('ns')
+
+        for _ in range(MAX_POLLS):
+            status = yield get_status(harness, monitor)
+            polls += 1
+            if status.state == DFU_ERROR or status.status != 0:
+                raise TestFailure("DFU error, status {} in state {}".format(
+                    status.status, status.state))
+            if block and status.state == DFU_DNLOAD_IDLE:
+                break
+            if not block and status.state in (DFU_IDLE,
+                                              DFU_MANIFEST_WAIT_RESET):
+                break
+            if poll_mode == 'honor':
+                wait_us = status.poll_timeout_ms * 1e3
+            elif poll_mode == 'flash':
+                wait_us, flash_us = flash_us, 0
+            else:
+                wait_us = 0
+            if wait_us:
+                poll_wait_us += wait_us
+                yield Timer(wait_us, 'us')
+        else:
+            raise TestFailure("Block {} not done after {} polls".format(
+                block_num, MAX_POLLS))
+        polled_us = (get_sim_time('ns') - polled) / 1e3
+        flash_extra_us += max(0, block_busy_us - polled_us)
+
+    elapsed_s = (get_sim_time('ns') - start) / 1e9
+    properties = {
+        'dfu_block_size': block_size,
+        'dfu_poll_mode': poll_mode,
+        'dfu_bytes': len(image),
+        'dfu_kb_per_s': "{:.2f}".format(len(image) / 1024 / elapsed_s),
+        'dfu_getstatus_polls': polls,
+        'dfu_poll_wait_ms': "{:.1f}".format(poll_wait_us / 1e3),
+        'dfu_flash_busy_ms': "{:.1f}".format(flash.busy_us / 1e3),
+        'dfu_flash_kb_per_s': "{:.2f}".format(
+            len(image) / 1024 / (elapsed_s + flash_extra_us / 1e6)),
+    }
+    report_properties(dut, properties)
+
+
+def skip_reason(block_size, poll_mode):
+    max_transfer = transfer_size(descriptorFile)
+    if max_transfer is None:
+        return "target has no DFU interface"
+    if block_size > max_transfer:
+        return "block size above wTransferSize"
+    return None
+
+
+factory = TestFactory(run_dfu_download)
+factory.add_option('block_size', [64, 256, 1024])
+factory.add_option('poll_mode', ['honor', 'immediate', 'flash'])
+factory.generate_tests()
+skip_generated(factory, skip_reason)
@@ -1,6 +1,7 @@
 import cocotb
 
-from cocotb_usb.harness import get_harness
+from tests.enumtiming import time_enumeration
+from tests.harness import get_harness
 from cocotb_usb.device import UsbDevice
 from cocotb_usb.descriptors import Descriptor
 
@@ -16,6 +17,7 @@ model = UsbDevice(descriptorFile)
 @cocotb.test()
 def test_enumeration(dut):
     harness = get_harness(dut)
+    time_enumeration(harness, 'generic')
     harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
     yield harness.reset()
     yield harness.wait(1e3, units="us")
@@ -0,0 +1,95 @@
+"""Cost of the EP0 max packet size on descriptor fetches
+
+Fetches every descriptor of the device once and reports, for each fetch,
+the number of transactions (tokens sent by the host, NAKed ones included)
+and the simulated time it took. Run it with EP0_SIZE set to compare EP0
+max packet sizes, see tools/ep0sweep.py.
+"""
+
+from os import environ
+
+import cocotb
+from cocotb.utils import get_sim_time
+from tests.harness import get_harness, report_properties
+from tests.monitor import UsbMonitor
+from cocotb_usb.descriptors import Descriptor
+from cocotb_usb.device import UsbDevice
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+
+
+class FetchCounter:
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.properties = {}
+        self.total_transactions = 0
+        self.total_ns = 0
+
+    @cocotb.coroutine
+    def fetch(self, name, request):
+        first_packet = len(self.monitor.packets)
+        start = get_sim_time('ns')
+        yield request
+        elapsed = get_sim_time('ns') - start
+        transactions = sum(1 for packet in
+                           self.monitor.packets[first_packet:]
+                           if packet.is_token)
+        self.total_transactions += transactions
+        self.total_ns += elapsed
+        self.properties['ep0_{}_transactions'.format(name)] = transactions
+        self.properties['ep0_{}_us'.format(name)] = "{:.1f}".format(
+            elapsed / 1e3)
+
+
+@cocotb.test()
+def test_descriptor_fetch(dut):
+    harness = get_harness(dut)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+    counter = FetchCounter(monitor)
+
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.host_send_sof(0x02)
+
+    yield counter.fetch('device', harness.get_device_descriptor(
+        response=model.deviceDescriptor.get()))
+    total_config_len = model.configDescriptor[1].wTotalLength
+    yield counter.fetch('configuration', harness.get_configuration_descriptor(
+        length=total_config_len,
+        response=model.configDescriptor[1].get()[:total_config_len]))
+
+    indices = [idx for idx in (model.deviceDescriptor.iManufacturer,
+                               model.deviceDescriptor.iProduct,
+                               model.deviceDescriptor.iSerialNumber)
+               if idx != 0]
+    if indices:
+        yield counter.fetch('string0', harness.get_string_descriptor(
+            lang_id=Descriptor.LangId.UNSPECIFIED,
+            idx=0,
+            response=model.stringDescriptor[0].get()))
+        lang_id = model.stringDescriptor[0].wLangId[0]
+        for idx in indices:
+            yield counter.fetch(
+                'string{}'.format(idx), harness.get_string_descriptor(
+                    lang_id=lang_id,
+                    idx=idx,
+                    response=model.stringDescriptor[lang_id][idx].get()))
+
+    properties = {
+        'ep0_size': harness.max_packet_size,
+        'ep0_transactions': counter.total_transactions,
+        'ep0_us': "{:.1f}".format(counter.total_ns / 1e3),
+    }
+    properties.update(counter.properties)
+    report_properties(dut, properties)
@@ -30,15 +30,27 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 # Tests for the Fomu Tri-Endpoint
+from os import environ
+
 import cocotb
 from cocotb.result import TestFailure, TestSuccess
 from cocotb.triggers import RisingEdge
 
-from cocotb_usb.harness import get_harness
+from tests.harness import get_harness
+from cocotb_usb.device import UsbDevice
 from cocotb_usb.utils import grouper_tofit
 from cocotb_usb.usb.endpoint import EndpointType, EndpointResponse
 from cocotb_usb.usb.pid import PID
 
+# Generated from csr.csv when building dut.v
+from regmap import (CTRL_SCRATCH, USB_ADDRESS, USB_IN_CTRL, USB_IN_DATA,
+                    USB_IN_EV_PENDING, USB_OUT_CTRL, USB_OUT_EV_ENABLE,
+                    USB_OUT_EV_PENDING, USB_PULLUP_OUT, USB_SETUP_EV_PENDING)
+
+from tests.events import wait_irq
+
+model = UsbDevice(environ['TARGET_CONFIG'])
+
 
 @cocotb.test()
 def iobuf_validate(dut):
@@ -46,7 +58,6 @@ def iobuf_validate(dut):
     harness = get_harness(dut)
     yield harness.reset()
 
-    USB_PULLUP_OUT = harness.csrs['usb_pullup_out']
     val = yield harness.read(USB_PULLUP_OUT)
     dut._log.info("Value at start: {}".format(val))
     if dut.usb_pullup != 0:
@@ -68,7 +79,7 @@ def test_control_setup(dut):
     yield harness.connect()
     # We write to address 0, because we just want to test that the control
     # circuitry works.  Normally you wouldn't do this.
-    yield harness.write(harness.csrs['usb_address'], 0)
+    yield harness.write(USB_ADDRESS, 0)
     yield harness.transaction_setup(
         0, [0x80, 0x06, 0x00, 0x06, 0x00, 0x00, 0x00, 0x00])
     yield harness.transaction_data_in(0, 0, [])
@@ -84,7 +95,7 @@ def test_control_transfer_in_lazy(dut):
     yield harness.reset()
 
     yield harness.connect()
-    yield harness.write(harness.csrs['usb_address'], 0)
+    yield harness.write(USB_ADDRESS, 0)
     # SETUP packet
     harness.dut._log.info("sending initial SETUP packet")
     # Send a SETUP packet without draining it on the device side
@@ -98,7 +109,7 @@ def test_control_transfer_in_lazy(dut):
         0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A, 0x0B
     ]
     for b in data:
-        yield harness.write(harness.csrs['usb_in_data'], b)
+        yield harness.write(USB_IN_DATA, b)
 
     # Send a few packets while we "process" the data as a slow host
     for i in range(2):
@@ -107,7 +118,7 @@ def test_control_transfer_in_lazy(dut):
         yield harness.host_expect_nak()
 
     # Queue the IN response packet
-    yield harness.write(harness.csrs['usb_in_ctrl'], 0)
+    yield harness.write(USB_IN_CTRL, 0)
 
     # Read the data
     setup_data = yield harness.drain_setup()
@@ -170,7 +181,7 @@ def test_control_transfer_in_lazy(dut):
         raise TestFailure("1. expected setup data to be 10 bytes, "
                           "but was {} bytes: {}".format(len(setup_data),
                                                         setup_data))
-    yield harness.write(harness.csrs['usb_in_ctrl'], 0x40)  # Set STALL
+    yield harness.write(USB_IN_CTRL, 0x40)  # Set STALL
 
     # Perform the final "read"
     yield harness.host_send_token_packet(PID.IN, 0, 0)
@@ -185,7 +196,7 @@ def test_control_transfer_in_lazy(dut):
         PID.DATA0, [0x80, 0x06, 0x00, 0x06, 0x00, 0x00, 0x0A, 0x00])
     # yield harness.host_expect_ack()
 
-    yield harness.write(harness.csrs['usb_address'], 11)
+    yield harness.write(USB_ADDRESS, 11)
 
     # SETUP packet without draining
     harness.dut._log.info("sending a packet without draining SETUP")
@@ -200,7 +211,7 @@ def test_control_transfer_in_lazy(dut):
         0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A, 0x0B
     ]
     for b in data:
-        yield harness.write(harness.csrs['usb_in_data'], b)
+        yield harness.write(USB_IN_DATA, b)
 
     # Send a few packets while we "process" the data as a slow host
     for i in range(2):
@@ -214,7 +225,7 @@ def test_control_transfer_in_lazy(dut):
         raise TestFailure(
             "3. expected setup data to be 10 bytes, but was {} bytes: {}".
             format(len(setup_data), setup_data))
-    yield harness.write(harness.csrs['usb_in_ctrl'], 0)
+    yield harness.write(USB_IN_CTRL, 0)
 
     # Perform the final send
     yield harness.host_send_token_packet(PID.IN, 11, 0)
@@ -229,10 +240,11 @@ def test_control_transfer_in_large(dut):
     epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
 
     harness = get_harness(dut)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
     yield harness.reset()
 
     yield harness.connect()
-    yield harness.write(harness.csrs['usb_address'], 0)
+    yield harness.write(USB_ADDRESS, 0)
 
     # Set address to 11
     yield harness.control_transfer_out(
@@ -242,7 +254,7 @@ def test_control_transfer_in_large(dut):
         # 18 byte descriptor, max packet size 8 bytes
         None,
     )
-    yield harness.write(harness.csrs['usb_address'], 11)
+    yield harness.write(USB_ADDRESS, 11)
 
     # Send a packet that's longer than 64 bytes
     string_data = [
@@ -272,12 +284,13 @@ def test_control_transfer_in_large(dut):
 
     datax = PID.DATA1
     sent_data = 0
-    for i, chunk in enumerate(grouper_tofit(64, string_data)):
+    for i, chunk in enumerate(grouper_tofit(harness.max_packet_size,
+                                            string_data)):
         sent_data = 1
         harness.dut._log.debug("Actual data we're expecting: {}".format(chunk))
         for b in chunk:
-            yield harness.write(harness.csrs['usb_in_data'], b)
-        yield harness.write(harness.csrs['usb_in_ctrl'], 0)
+            yield harness.write(USB_IN_DATA, b)
+        yield harness.write(USB_IN_CTRL, 0)
         recv = cocotb.fork(harness.host_recv(datax, 11, 0, chunk))
         yield recv.join()
 
@@ -291,7 +304,7 @@ def test_control_transfer_in_large(dut):
         else:
             datax = PID.DATA0
     if not sent_data:
-        yield harness.write(harness.csrs['usb_in_ctrl'], 0)
+        yield harness.write(USB_IN_CTRL, 0)
         recv = cocotb.fork(harness.host_recv(datax, 11, 0, []))
         yield harness.send_data(datax, 0, string_data)
         yield recv.join()
@@ -322,7 +335,7 @@ def test_sof_is_ignored(dut):
 
     addr = 0x20
     epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
-    yield harness.write(harness.csrs['usb_address'], addr)
+    yield harness.write(USB_ADDRESS, addr)
 
     data = [0, 1, 8, 0, 4, 3, 0, 0]
 
@@ -350,9 +363,10 @@ def test_sof_is_ignored(dut):
         yield harness.host_send_sof(4)
 
     # Indicate that we're ready to receive data to EP0
-    # harness.write(harness.csrs['usb_in_ctrl'], 0)
+    # harness.write(USB_IN_CTRL, 0)
 
     xmit = cocotb.fork(send_setup_and_sof())
+    # Sleeps on the SETUP interrupt until the packet arrives, see use_irq()
     yield harness.expect_setup(epaddr_out, data)
     yield xmit.join()
 
@@ -370,7 +384,7 @@ def test_control_setup_clears_stall(dut):
 
     addr = 28
     epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
-    yield harness.write(harness.csrs['usb_address'], addr)
+    yield harness.write(USB_ADDRESS, addr)
     yield harness.host_send_sof(0)
 
     d = [0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0, 0]
@@ -386,7 +400,7 @@ def test_control_setup_clears_stall(dut):
 
     # STALL the endpoint now
     harness.dut._log.info("stalling EP0 IN")
-    yield harness.write(harness.csrs['usb_in_ctrl'], 0x40)
+    yield harness.write(USB_IN_CTRL, 0x40)
 
     # Do another receive, which should fail
     harness.dut._log.info("next transaction should stall")
@@ -410,7 +424,7 @@ def test_control_transfer_in_nak_data(dut):
     yield harness.connect()
 
     addr = 0
-    yield harness.write(harness.csrs['usb_address'], addr)
+    yield harness.write(USB_ADDRESS, addr)
     # Get descriptor, Index 0, Type 03, LangId 0000, wLength 64
     setup_data = [0x80, 0x06, 0x00, 0x03, 0x00, 0x00, 0x40, 0x00]
     in_data = [0x04, 0x03, 0x09, 0x04]
@@ -418,7 +432,7 @@ def test_control_transfer_in_nak_data(dut):
     epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
     # yield harness.clear_pending(epaddr_in)
 
-    yield harness.write(harness.csrs['usb_address'], addr)
+    yield harness.write(USB_ADDRESS, addr)
 
     # Setup stage
     # -----------
@@ -495,10 +509,10 @@ def test_control_transfer_in(dut):
             0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A,
             0x0B
         ]
-    yield harness.write(harness.csrs['usb_address'], 20)
+    yield harness.write(USB_ADDRESS, 20)
     yield harness.host_send_sof(0)
 
-    setup_ev = yield harness.read(harness.csrs['usb_setup_ev_pending'])
+    setup_ev = yield harness.read(USB_SETUP_EV_PENDING)
     if setup_ev != 0:
         raise TestFailure("setup_ev should be 0 at the start of the test, "
                           "was: {:02x}".format(setup_ev))
@@ -508,7 +522,7 @@ def test_control_transfer_in(dut):
     yield harness.transaction_setup(ADDR, SETUP_DATA)
 
     # Data stage
-    in_ev = yield harness.read(harness.csrs['usb_in_ev_pending'])
+    in_ev = yield harness.read(USB_IN_EV_PENDING)
     if in_ev != 0:
         raise TestFailure("in_ev should be 0 at the start of the test, "
                           "was: {:02x}".format(in_ev))
@@ -520,25 +534,24 @@ def test_control_transfer_in(dut):
     yield RisingEdge(harness.dut.clk12)
 
     # Status stage
-    yield harness.write(harness.csrs['usb_out_ctrl'], 0x10)  # Empty IN packet
+    yield harness.write(USB_OUT_CTRL, 0x10)  # Empty IN packet
     harness.dut._log.info("status stage")
-    out_ev = yield harness.read(harness.csrs['usb_out_ev_pending'])
+    out_ev = yield harness.read(USB_OUT_EV_PENDING)
     if out_ev != 0:
         raise TestFailure("i: out_ev should be 0 at the start of the test, "
                           "was: {:02x}".format(out_ev))
+    # Sleep until the OUT event went through the multiregs and the event
+    # manager instead of counting clock cycles
+    yield harness.write(USB_OUT_EV_ENABLE, 1)
     yield harness.transaction_status_out(ADDR, epaddr_out)
-    yield RisingEdge(harness.dut.clk12)
+    yield wait_irq(dut, timeout=100)
 
-    # give two cycles to percolate through multiregs and event manager
-    yield RisingEdge(harness.dut.clk12)
-    yield RisingEdge(harness.dut.clk12)
-
-    out_ev = yield harness.read(harness.csrs['usb_out_ev_pending'])
+    out_ev = yield harness.read(USB_OUT_EV_PENDING)
     if out_ev != 1:
         raise TestFailure("i: out_ev should be 1 at the end of the test, "
                           "was: {:02x}".format(out_ev))
-    yield harness.write(harness.csrs['usb_out_ctrl'], 0x20)  # Reset FIFO
-    yield harness.write(harness.csrs['usb_out_ev_pending'], out_ev)
+    yield harness.write(USB_OUT_CTRL, 0x20)  # Reset FIFO
+    yield harness.write(USB_OUT_EV_PENDING, out_ev)
 
 
 @cocotb.test()
@@ -558,14 +571,14 @@ def test_control_transfer_out(dut):
             0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x0A,
             0x0B
         ]
-    yield harness.write(harness.csrs['usb_address'], ADDR)
+    yield harness.write(USB_ADDRESS, ADDR)
     yield harness.host_send_sof(0)
 
     if (SETUP_DATA[0] & 0x80) == 0x80:
         raise Exception("setup_data indicated an IN transfer, but you "
                         "requested an OUT transfer")
 
-    setup_ev = yield harness.read(harness.csrs['usb_setup_ev_pending'])
+    setup_ev = yield harness.read(USB_SETUP_EV_PENDING)
     if setup_ev != 0:
         raise TestFailure("setup_ev should be 0 at the start of the test, "
                           "was: {:02x}".format(setup_ev))
@@ -575,7 +588,7 @@ def test_control_transfer_out(dut):
     yield harness.transaction_setup(ADDR, SETUP_DATA)
 
     # Data stage
-    out_ev = yield harness.read(harness.csrs['usb_out_ev_pending'])
+    out_ev = yield harness.read(USB_OUT_EV_PENDING)
     if out_ev != 0:
         raise TestFailure("out_ev should be 0 at the start of the test, "
                           "was: {:02x}".format(out_ev))
@@ -584,15 +597,15 @@ def test_control_transfer_out(dut):
 
     # Status stage
     harness.dut._log.info("status stage")
-    yield harness.write(harness.csrs['usb_in_ctrl'], 0)  # Send empty IN packet
-    in_ev = yield harness.read(harness.csrs['usb_in_ev_pending'])
+    yield harness.write(USB_IN_CTRL, 0)  # Send empty IN packet
+    in_ev = yield harness.read(USB_IN_EV_PENDING)
     if in_ev != 0:
         raise TestFailure("o: in_ev should be 0 at the start of the test, "
                           "was: {:02x}".format(in_ev))
     yield harness.transaction_status_in(ADDR, epaddr_in)
     yield RisingEdge(harness.dut.clk12)
     yield RisingEdge(harness.dut.clk12)
-    yield harness.write(harness.csrs['usb_in_ctrl'], 1 << 5)  # Reset IN buffer
+    yield harness.write(USB_IN_CTRL, 1 << 5)  # Reset IN buffer
     yield RisingEdge(harness.dut.clk12)
     yield RisingEdge(harness.dut.clk12)
 
@@ -635,7 +648,7 @@ def test_control_transfer_in_out_in(dut):
 
     yield harness.clear_pending(EndpointType.epaddr(0, EndpointType.OUT))
     yield harness.clear_pending(EndpointType.epaddr(0, EndpointType.IN))
-    yield harness.write(harness.csrs['usb_address'], 0)
+    yield harness.write(USB_ADDRESS, 0)
 
     yield harness.control_transfer_in(
         0,
@@ -656,7 +669,7 @@ def test_control_transfer_in_out_in(dut):
         None,
     )
 
-    yield harness.write(harness.csrs['usb_address'], 11)
+    yield harness.write(USB_ADDRESS, 11)
 
     yield harness.control_transfer_in(
         11,
@@ -678,7 +691,7 @@ def test_control_transfer_out_in(dut):
 
     yield harness.clear_pending(EndpointType.epaddr(0, EndpointType.OUT))
     yield harness.clear_pending(EndpointType.epaddr(0, EndpointType.IN))
-    yield harness.write(harness.csrs['usb_address'], 0)
+    yield harness.write(USB_ADDRESS, 0)
 
     yield harness.control_transfer_out(
         0,
@@ -688,7 +701,7 @@ def test_control_transfer_out_in(dut):
         None,
     )
 
-    yield harness.write(harness.csrs['usb_address'], 20)
+    yield harness.write(USB_ADDRESS, 20)
 
     yield harness.control_transfer_in(
         20,
@@ -752,7 +765,7 @@ def test_in_transfer(dut):
 
     addr = 0
     epaddr = EndpointType.epaddr(1, EndpointType.IN)
-    yield harness.write(harness.csrs['usb_address'], addr)
+    yield harness.write(USB_ADDRESS, addr)
 
     d = [0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0x8]
 
@@ -795,7 +808,7 @@ def test_in_transfer_stuff_last(dut):
 
     addr = 28
     epaddr = EndpointType.epaddr(1, EndpointType.IN)
-    yield harness.write(harness.csrs['usb_address'], addr)
+    yield harness.write(USB_ADDRESS, addr)
 
     d = [0x37, 0x75, 0x00, 0xe0]
 
@@ -815,13 +828,9 @@ def test_debug_in(dut):
     yield harness.connect()
 
     addr = 0
-    yield harness.write(harness.csrs['usb_address'], addr)
+    yield harness.write(USB_ADDRESS, addr)
     # The "scratch" register defaults to 0x12345678 at boot.
-    reg_addr = harness.csrs['ctrl_scratch']
-    setup_data = [
-        0xc3, 0x00, (reg_addr >> 0) & 0xff, (reg_addr >> 8) & 0xff,
-        (reg_addr >> 16) & 0xff, (reg_addr >> 24) & 0xff, 0x04, 0x00
-    ]
+    setup_data = [0xc3, 0x00, *CTRL_SCRATCH.le, 0x04, 0x00]
     epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
     epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
 
@@ -855,12 +864,7 @@ def test_debug_in(dut):
 #     yield harness.connect()
 
 #     addr = 28
-#     reg_addr = harness.csrs['ctrl_scratch']
-#     setup_data = [0xc3, 0x00,
-#                     (reg_addr >> 0) & 0xff,
-#                     (reg_addr >> 8) & 0xff,
-#                     (reg_addr >> 16) & 0xff,
-#                     (reg_addr >> 24) & 0xff, 0x04, 0x00]
+#     setup_data = [0xc3, 0x00, *CTRL_SCRATCH.le, 0x04, 0x00]
 #     epaddr_in = EndpointType.epaddr(0, EndpointType.IN)
 #     epaddr_out = EndpointType.epaddr(0, EndpointType.OUT)
 
@@ -891,12 +895,8 @@ def test_debug_out(dut):
     yield harness.connect()
 
     addr = 0
-    yield harness.write(harness.csrs['usb_address'], addr)
-    reg_addr = harness.csrs['ctrl_scratch']
-    setup_data = [
-        0x43, 0x00, (reg_addr >> 0) & 0xff, (reg_addr >> 8) & 0xff,
-        (reg_addr >> 16) & 0xff, (reg_addr >> 24) & 0xff, 0x04, 0x00
-    ]
+    yield harness.write(USB_ADDRESS, addr)
+    setup_data = [0x43, 0x00, *CTRL_SCRATCH.le, 0x04, 0x00]
     ep0in_addr = EndpointType.epaddr(0, EndpointType.IN)
     ep1in_addr = EndpointType.epaddr(1, EndpointType.IN)
     ep0out_addr = EndpointType.epaddr(0, EndpointType.OUT)
@@ -925,8 +925,8 @@ def test_debug_out(dut):
     yield harness.host_expect_data_packet(PID.DATA1, [])
     yield harness.host_send_ack()
 
-    new_value = yield harness.read(reg_addr)
+    new_value = yield harness.read(CTRL_SCRATCH)
     if new_value != 0x42:
         raise TestFailure(
             "memory at 0x{:08x} should be 0x{:08x}, but memory value\
-            was 0x{:08x}".format(reg_addr, 0x42, new_value))
+            was 0x{:08x}".format(CTRL_SCRATCH, 0x42, new_value))
@@ -0,0 +1,354 @@
+"""Error injection and recovery latency
+
+Host packets are sent through tests/linedriver.py and damaged at the rate
+FAULT_RATE (default 0.05 per packet), one kind of fault per test:
+
+- crc5: CRC error in tokens,
+- crc16: CRC error in SETUP and OUT data,
+- stuff, truncate, pid: bit stuffing violation, truncated packet or bad PID
+  check bits in any host packet,
+- no_handshake: the host drops the ACK of IN data.
+
+The device has to ignore every damaged packet. The host then retries the
+transaction after its timeout, like a host controller does, and drops data
+sent again with a toggle it already has. A transaction left unanswered
+MAX_ATTEMPTS times, or answered NAK_LIMIT times with a NAK, fails
+the test. For every transfer hit by a fault the time and the number of
+frames from the first fault to the end of the transfer are recorded; the
+'none' test gives the fault-free baseline.
+
+Transfers are control reads of the device descriptor, or bulk OUT and IN
+packets with the harness acting as firmware on valentyusb. FAULT_TRANSFERS
+sets their number and FAULT_SEED seeds the injection.
+"""
+
+import random
+from os import environ
+
+import cocotb
+from cocotb.regression import TestFactory
+from cocotb.result import TestFailure
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time
+from tests.harness import get_harness, min_mean_max, report_properties
+from tests.linedriver import (CRC, PID_CHECK, STUFF, TRUNCATE, LineDriver,
+                              data_packet, handshake_packet, sof_packet,
+                              token_packet)
+from tests.monitor import BIT_TIME_NS, UsbMonitor
+from tests.transfers import (NAK_LIMIT, HarnessFirmware, bulk_endpoints,
+                             toggled)
+from cocotb_usb.device import UsbDevice
+from cocotb_usb.usb.endpoint import EndpointType
+from cocotb_usb.usb.pid import PID
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+TRANSFERS = int(environ.get('FAULT_TRANSFERS', '50'))
+RATE = float(environ.get('FAULT_RATE', '0.05'))
+SEED = int(environ.get('FAULT_SEED', '0'))
+FRAME_NS = 1e6
+# Delay between the end of a packet and the next host packet
+GAP_BITS = 4
+# Host timeout waiting for the device answer
+TIMEOUT_BITS = 18
+# Time to wait for late answers before going on
+RESPONSE_TIMEOUT_US = 100
+# Attempts of a transaction before declaring the device lost
+MAX_ATTEMPTS = 20
+
+GET_DEVICE_DESCRIPTOR = [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x12, 0x00]
+
+# The host does not send the packet at all
+DROP = 'drop'
+# Fault kinds and the line driver fault they use in each kind of packet
+KINDS = {
+    'none': {},
+    'crc5': {'token': CRC},
+    'crc16': {'data': CRC},
+    'stuff': {'token': STUFF, 'data': STUFF, 'handshake': STUFF},
+    'truncate': {'token': TRUNCATE, 'data': TRUNCATE,
+                 'handshake': TRUNCATE},
+    'pid': {'token': PID_CHECK, 'data': PID_CHECK, 'handshake': PID_CHECK},
+    'no_handshake': {'handshake': DROP},
+}
+
+
+class FaultyHost:
+    """Host transactions with faults injected and retried until the device
+    answers"""
+
+    def __init__(self, dut, monitor, kind, rate, rng):
+        self.driver = LineDriver(dut)
+        self.monitor = monitor
+        self.faults = KINDS[kind]
+        self.rate = rate
+        self.rng = rng
+        self.frame = 0
+        self.next_sof = get_sim_time('ns')
+        self.injected = 0
+        self.retries = 0
+        # Time and frame of the first fault of the current transfer
+        self.fault = None
+        # [(ns, frames)] from the first fault to the end of the transfer
+        self.recoveries = []
+
+    def _inject(self, packet_kind):
+        if packet_kind not in self.faults or self.rng.random() >= self.rate:
+            return False
+        self.injected += 1
+        if self.fault is None:
+            self.fault = (get_sim_time('ns'), self.frame)
+        return True
+
+    @cocotb.coroutine
+    def send(self, packet, packet_kind):
+        """Send `packet` after the gap, damaged at the fault rate, and
+        return its index in the monitor, None if it was dropped"""
+        if self.monitor.packets:
+            delay = self.monitor.packets[-1].end + GAP_BITS * BIT_TIME_NS - \
+                get_sim_time('ns')
+            if delay > 0:
+                yield Timer(delay, 'ns')
+        fault = self.faults[packet_kind] if self._inject(packet_kind) \
+            else None
+        if fault == DROP:
+            return None
+        index = len(self.monitor.packets)
+        yield self.driver.send(packet, fault, self.rng)
+        packet = yield self.monitor.wait_packet(index, RESPONSE_TIMEOUT_US)
+        if packet is None:
+            raise TestFailure("Host packet not seen on the bus")
+        return index
+
+    @cocotb.coroutine
+    def response(self, last):
+        """Device answer to host packet number `last`, None if it did not
+        start within the host timeout or was damaged"""
+        end = self.monitor.packets[last].end + TIMEOUT_BITS * BIT_TIME_NS
+        if end > get_sim_time('ns'):
+            yield Timer(end - get_sim_time('ns'), 'ns')
+        driving = self.monitor.tx_en.value
+        if len(self.monitor.packets) <= last + 1 and \
+                not (driving.is_resolvable and int(driving)):
+            return None
+        packet = yield self.monitor.wait_response(last + 1,
+                                                  RESPONSE_TIMEOUT_US)
+        if packet is None or not packet.valid:
+            return None
+        return packet
+
+    @cocotb.coroutine
+    def keep_alive(self):
+        if get_sim_time('ns') >= self.next_sof:
+            yield self.send(sof_packet(self.frame), 'sof')
+            self.frame = (self.frame + 1) & 0x7ff
+            self.next_sof += FRAME_NS
+
+    def transfer_done(self):
+        if self.fault is not None:
+            time, frame = self.fault
+            self.recoveries.append((get_sim_time('ns') - time,
+                                    (self.frame - frame) & 0x7ff))
+            self.fault = None
+
+    def retry(self, count):
+        """Count a transaction left unanswered, `count` being the number of
+        previous ones"""
+        if count + 1 >= MAX_ATTEMPTS:
+            raise TestFailure("Device did not recover after {} "
+                              "attempts".format(MAX_ATTEMPTS))
+        self.retries += 1
+        return count + 1
+
+    def nak(self, count):
+        """Count a NAK, `count` being the number of previous ones. A device
+        answering NAK for good did not recover either."""
+        if count + 1 >= NAK_LIMIT:
+            raise TestFailure("Device did not recover, {} NAKs in a "
+                              "row".format(NAK_LIMIT))
+        return count + 1
+
+    @cocotb.coroutine
+    def setup(self, addr, data):
+        failed = 0
+        while True:
+            yield self.keep_alive()
+            yield self.send(token_packet(PID.SETUP, addr, 0), 'token')
+            last = yield self.send(data_packet(PID.DATA0, data), 'data')
+            response = yield self.response(last)
+            if response is not None and response.pid == PID.ACK:
+                return
+            failed = self.retry(failed)
+
+    @cocotb.coroutine
+    def data_out(self, addr, epnum, toggle, data):
+        failed = 0
+        naks = 0
+        while True:
+            yield self.keep_alive()
+            yield self.send(token_packet(PID.OUT, addr, epnum), 'token')
+            last = yield self.send(data_packet(toggle, data), 'data')
+            response = yield self.response(last)
+            if response is None or response.pid not in (PID.ACK, PID.NAK):
+                failed = self.retry(failed)
+            elif response.pid == PID.NAK:
+                naks = self.nak(naks)
+            else:
+                return
+
+    @cocotb.coroutine
+    def data_in(self, addr, epnum, toggle):
+        """Data of the next packet the device sends with `toggle`"""
+        failed = 0
+        naks = 0
+        while True:
+            yield self.keep_alive()
+            last = yield self.send(token_packet(PID.IN, addr, epnum),
+                                   'token')
+            response = yield self.response(last)
+            if response is None or \
+                    response.pid not in (PID.DATA0, PID.DATA1, PID.NAK):
+                failed = self.retry(failed)
+                continue
+            if response.pid == PID.NAK:
+                naks = self.nak(naks)
+                continue
+            ack = yield self.send(handshake_packet(PID.ACK), 'handshake')
+            if ack is None:
+                # Dropped, the device has to send the data again after
+                # timing out
+                yield Timer(TIMEOUT_BITS * BIT_TIME_NS, 'ns')
+                failed = self.retry(failed)
+                continue
+            if response.pid == toggle:
+                return response.data[:-2]
+            # Data sent again because its ACK was damaged
+
+    @cocotb.coroutine
+    def drain_in(self, addr, epnum, toggle):
+        """Acknowledge data sent again after a damaged ACK until the device
+        NAKs, so the firmware can queue the next packet, sent with `toggle`"""
+        failed = 0
+        while True:
+            yield self.keep_alive()
+            last = yield self.send(token_packet(PID.IN, addr, epnum),
+                                   'token')
+            response = yield self.response(last)
+            if response is None:
+                failed = self.retry(failed)
+            elif response.pid == PID.NAK:
+                return
+            elif response.is_data and response.pid != toggle:
+                yield self.send(handshake_packet(PID.ACK), 'handshake')
+            else:
+                raise TestFailure("Unexpected answer to IN: " +
+                                  repr(response))
+
+
+@cocotb.coroutine
+def control_reads(host, transfers):
+    """Read the device descriptor `transfers` times"""
+    expected = list(model.deviceDescriptor.get())
+    max_packet = model.deviceDescriptor.bMaxPacketSize0
+    for _ in range(transfers):
+        yield host.setup(DEVICE_ADDRESS, GET_DEVICE_DESCRIPTOR)
+        data = []
+        toggle = PID.DATA1
+        while len(data) < len(expected):
+            packet = yield host.data_in(DEVICE_ADDRESS, 0, toggle)
+            data += packet
+            toggle = toggled(toggle)
+            if len(packet) < max_packet:
+                break
+        if data != expected:
+            raise TestFailure("Device descriptor: got {}, expected {}".format(
+                bytes(data).hex(), bytes(expected).hex()))
+        yield host.data_out(DEVICE_ADDRESS, 0, PID.DATA1, [])
+        host.transfer_done()
+
+
+@cocotb.coroutine
+def bulk_transfers(host, harness, transfers):
+    """Write a packet to the bulk OUT endpoint and read one from the bulk
+    IN endpoint `transfers` times, the harness re-arming them"""
+    endpoints = bulk_endpoints(descriptorFile)
+    out_ep, out_size = endpoints['out']
+    in_ep, in_size = endpoints['in']
+    out_firmware = HarnessFirmware(
+        harness, EndpointType.epaddr(out_ep, EndpointType.OUT))
+    in_firmware = HarnessFirmware(
+        harness, EndpointType.epaddr(in_ep, EndpointType.IN))
+    out_toggle = in_toggle = PID.DATA0
+    for i in range(transfers):
+        data = [(i + j) & 0xff for j in range(max(out_size, in_size))]
+        yield out_firmware.arm()
+        yield host.data_out(DEVICE_ADDRESS, out_ep, out_toggle,
+                            data[:out_size])
+        out_toggle = toggled(out_toggle)
+        yield host.drain_in(DEVICE_ADDRESS, in_ep, in_toggle)
+        yield in_firmware.arm(data[:in_size])
+        packet = yield host.data_in(DEVICE_ADDRESS, in_ep, in_toggle)
+        in_toggle = toggled(in_toggle)
+        if packet != data[:in_size]:
+            raise TestFailure("Bulk IN: got {}, expected {}".format(
+                bytes(packet).hex(), bytes(data[:in_size]).hex()))
+        host.transfer_done()
+
+
+@cocotb.coroutine
+def run_faults(dut, kind):
+    harness = get_harness(dut)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.set_configuration(1)
+
+    host = FaultyHost(dut, monitor, kind, RATE, random.Random(SEED))
+    start = get_sim_time('ns')
+    if environ.get('TARGET') == 'valentyusb':
+        scenario = 'bulk'
+        yield bulk_transfers(host, harness, TRANSFERS)
+    else:
+        scenario = 'control_read'
+        yield control_reads(host, TRANSFERS)
+    elapsed_ns = get_sim_time('ns') - start
+
+    properties = {
+        'faults_kind': kind,
+        'faults_rate': RATE,
+        'faults_scenario': scenario,
+        'faults_transfers': TRANSFERS,
+        'faults_injected': host.injected,
+        'faults_retries': host.retries,
+        'faults_transfer_us_mean': "{:.1f}".format(
+            elapsed_ns / TRANSFERS / 1e3),
+        'faults_transfers_per_s': "{:.0f}".format(
+            TRANSFERS / elapsed_ns * 1e9),
+    }
+    if host.recoveries:
+        times = [ns / 1e3 for ns, _ in host.recoveries]
+        _, recovery_mean, recovery_max = min_mean_max(times)
+        properties.update({
+            'faults_recovered_transfers': len(times),
+            'faults_recovery_us_mean': "{:.1f}".format(recovery_mean),
+            'faults_recovery_us_max': "{:.1f}".format(recovery_max),
+            'faults_recovery_frames_max': max(
+                frames for _, frames in host.recoveries),
+        })
+    report_properties(dut, properties)
+
+
+factory = TestFactory(run_faults)
+factory.add_option('kind', list(KINDS))
+factory.generate_tests()
@@ -0,0 +1,72 @@
+from os import environ
+
+import cocotb
+
+from tests.enumtiming import time_enumeration
+from tests.harness import get_harness
+from cocotb_usb.device import UsbDevice
+from cocotb_usb.descriptors import Descriptor
+
+DESCRIPTOR_FILE = environ['TARGET_CONFIG']
+
+DEVICE_ADDRESS = 7
+model = UsbDevice(DESCRIPTOR_FILE)
+
+
+@cocotb.test()
+def test_enumeration_linux(dut):
+    """Request order of the Linux hub driver (new enumeration scheme)"""
+    harness = get_harness(dut)
+    time_enumeration(harness, 'linux')
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    # Read up to 64 bytes to learn bMaxPacketSize0, then reset the port
+    yield harness.get_device_descriptor(length=0x40,
+                                        response=model.deviceDescriptor.get())
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    yield harness.host_send_sof(0x02)
+
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    # There is a longish recovery period after setting address, so let's send
+    # a SOF to make sure DUT doesn't suspend
+    yield harness.host_send_sof(0x03)
+    yield harness.get_device_descriptor(
+        length=0x12, response=model.deviceDescriptor.get()[:0x12])
+
+    yield harness.get_configuration_descriptor(
+        length=0x09, response=model.configDescriptor[1].get()[:9])
+    total_length = model.configDescriptor[1].wTotalLength
+    yield harness.get_configuration_descriptor(
+        length=total_length,
+        response=model.configDescriptor[1].get()[:total_length])
+
+    # Strings are read with the largest possible length
+    str_to_check = [idx for idx in (model.deviceDescriptor.iProduct,
+                                    model.deviceDescriptor.iManufacturer,
+                                    model.deviceDescriptor.iSerialNumber)
+                    if idx != 0]
+    if str_to_check:
+        yield harness.get_string_descriptor(
+            lang_id=Descriptor.LangId.UNSPECIFIED,
+            idx=0,
+            length=0xFF,
+            response=model.stringDescriptor[0].get())
+        lang_id = model.stringDescriptor[0].wLangId[0]
+        for idx in str_to_check:
+            yield harness.get_string_descriptor(
+                lang_id=lang_id,
+                idx=idx,
+                length=0xFF,
+                response=model.stringDescriptor[lang_id][idx].get())
+
+    yield harness.set_configuration(1)
+    # Device is in CONFIGURED state now
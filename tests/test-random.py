@@ -0,0 +1,57 @@
+"""Constrained-random traffic, see tests/randomgen.py
+
+The seed is taken from RANDOM_SEED when the test starts, so persistent
+simulator servers can run many seeds (tools/seedfarm.py), which then checks
+every failing seed in a fresh simulation. A failing seed is reproduced
+with:
+
+    make TARGET=<target> TEST_SCRIPT=test-random RANDOM_SEED=<seed> sim
+"""
+
+import random
+from os import environ
+
+import cocotb
+from tests.harness import at_test_end, get_harness
+from tests.monitor import UsbMonitor
+from tests.randomgen import RandomStimulus
+from tests.transfers import descriptor_endpoints
+from cocotb_usb.device import UsbDevice
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+# Targets where the harness plays the firmware
+EMULATED_TARGETS = ('valentyusb',)
+
+
+@cocotb.test()
+def test_random(dut):
+    seed = int(environ.get('RANDOM_SEED', '0'))
+    length = int(environ.get('RANDOM_LENGTH', '50'))
+    dut._log.info("RANDOM_SEED={}".format(seed))
+    at_test_end(lambda result: {'random_seed': seed,
+                                'random_length': length})
+
+    harness = get_harness(dut)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.set_configuration(1)
+
+    stimulus = RandomStimulus(harness, monitor, model, random.Random(seed),
+                              DEVICE_ADDRESS,
+                              environ.get('TARGET') in EMULATED_TARGETS,
+                              [(epnum, direction) for epnum, direction, *_ in
+                               descriptor_endpoints(descriptorFile)])
+    yield stimulus.run(length)
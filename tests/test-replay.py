@@ -0,0 +1,56 @@
+"""Replay of a captured host session, see tests/replay.py
+
+The capture is taken from REPLAY_FILE when the test starts, so persistent
+simulator servers can replay many captures (tools/replay.py). Options:
+
+- REPLAY_TIME_SCALE: 1 keeps the captured timing, 0.01 runs it 100 times
+  faster, 0 sends the URBs back to back (default: 1),
+- REPLAY_DEVICE: `bus.address` of the device to replay (default: the one
+  with the most URBs),
+- REPLAY_STRICT: 1 fails the test when the answers differ from the capture.
+"""
+
+from os import environ
+
+import cocotb
+from cocotb.result import TestFailure
+from tests.capture import read_capture, select_device
+from tests.harness import at_test_end, get_harness
+from tests.monitor import UsbMonitor
+from tests.replay import Replayer
+from cocotb_usb.device import UsbDevice
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+# Targets where the harness plays the firmware
+EMULATED_TARGETS = ('valentyusb',)
+
+
+@cocotb.test()
+def test_replay(dut):
+    path = environ['REPLAY_FILE']
+    time_scale = float(environ.get('REPLAY_TIME_SCALE', '1'))
+    strict = environ.get('REPLAY_STRICT', '0') != '0'
+    urbs = select_device(read_capture(path),
+                         environ.get('REPLAY_DEVICE') or None)
+    dut._log.info("Replaying {} URBs of {}".format(len(urbs), path))
+
+    harness = get_harness(dut)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+
+    replayer = Replayer(harness, monitor, urbs, time_scale,
+                        environ.get('TARGET') in EMULATED_TARGETS)
+    at_test_end(replayer.report)
+    yield replayer.run()
+    if strict and replayer.mismatches:
+        raise TestFailure("{} answers differ from the capture".format(
+            len(replayer.mismatches)))
@@ -2,7 +2,7 @@
 from os import environ
 
 import cocotb
-from cocotb_usb.harness import get_harness
+from tests.harness import get_harness
 from cocotb_usb.device import UsbDevice
 from cocotb_usb.descriptors import Descriptor, getDescriptorRequest
 
@@ -0,0 +1,233 @@
+"""Back-to-back transaction stress
+
+The harness primitives leave generous gaps between packets. Here every
+host packet is sent a set time after the end of the previous packet on the
+bus: the minimum inter-packet delay of 2 bit times ('min' mode) or a random
+legal delay up to 7.5 bit times ('random' mode, seeded with STRESS_SEED).
+
+Transactions are repeated control reads of the first 8 bytes of the device
+descriptor (SETUP, IN and OUT status stages), or bulk OUT transactions with
+the harness acting as firmware on valentyusb. Each transaction is counted as
+answered, NAKed, timed out (no answer within 18 bit times, the host timeout
+of the specification) or failed (unexpected answer or data); the number of
+transactions handled per simulated second is the sustained rate of the core.
+
+STRESS_TRANSFERS sets the number of transfers.
+"""
+
+import random
+from os import environ
+
+import cocotb
+from cocotb.regression import TestFactory
+from cocotb.result import TestFailure
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time
+from tests.harness import get_harness, report_properties
+from tests.monitor import BIT_TIME_NS, UsbMonitor
+from tests.transfers import HarnessFirmware, bulk_endpoints, toggled
+from cocotb_usb.device import UsbDevice
+from cocotb_usb.usb.endpoint import EndpointType
+from cocotb_usb.usb.pid import PID
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+TRANSFERS = int(environ.get('STRESS_TRANSFERS', '100'))
+SEED = int(environ.get('STRESS_SEED', '0'))
+# Legal delays between the end of a packet and the next host packet
+MIN_GAP_BITS = 2
+MAX_GAP_BITS = 7.5
+# Host timeout waiting for the device answer
+TIMEOUT_BITS = 18
+# Time to wait for late answers before going on
+RESPONSE_TIMEOUT_US = 100
+# Giving up after that many consecutive transactions not answered
+MAX_FAILURES = 50
+
+GET_DESCRIPTOR_8 = [0x80, 0x06, 0x00, 0x01, 0x00, 0x00, 0x08, 0x00]
+
+OK, NAK, TIMEOUT, ERROR = 'ok', 'nak', 'timeout', 'error'
+
+
+class Pacer:
+    """Sends host packets at the chosen gap after the previous packet and
+    tallies the transaction outcomes"""
+
+    def __init__(self, harness, monitor, mode, rng):
+        self.harness = harness
+        self.monitor = monitor
+        self.mode = mode
+        self.rng = rng
+        self.outcomes = {OK: 0, NAK: 0, TIMEOUT: 0, ERROR: 0}
+        self.failures = 0
+
+    def gap_ns(self):
+        if self.mode == 'min':
+            return MIN_GAP_BITS * BIT_TIME_NS
+        return self.rng.uniform(MIN_GAP_BITS, MAX_GAP_BITS) * BIT_TIME_NS
+
+    @cocotb.coroutine
+    def send(self, primitive, *args):
+        """Send a packet with `primitive` after the gap, return its index"""
+        if self.monitor.packets:
+            delay = self.monitor.packets[-1].end + self.gap_ns() - \
+                get_sim_time('ns')
+            if delay > 0:
+                yield Timer(delay, 'ns')
+        index = len(self.monitor.packets)
+        yield primitive(*args)
+        packet = yield self.monitor.wait_packet(index, RESPONSE_TIMEOUT_US)
+        if packet is None:
+            raise TestFailure("Host packet not seen on the bus")
+        return index
+
+    @cocotb.coroutine
+    def response(self, index):
+        """Device answer to host packet `index`, None if it timed out"""
+        packet = yield self.monitor.wait_response(index + 1,
+                                                  RESPONSE_TIMEOUT_US)
+        if packet is None or (packet.turnaround or 0) > \
+                TIMEOUT_BITS * BIT_TIME_NS:
+            return None
+        return packet
+
+    def count(self, outcome):
+        self.outcomes[outcome] += 1
+        self.failures = 0 if outcome == OK else self.failures + 1
+        if self.failures > MAX_FAILURES:
+            raise TestFailure("{} transactions in a row not handled".format(
+                self.failures))
+        return outcome
+
+    def _classify(self, response, expected):
+        if response is None:
+            return self.count(TIMEOUT)
+        if response.valid and response.pid == PID.NAK:
+            return self.count(NAK)
+        if response.valid and response.pid == expected:
+            return self.count(OK)
+        return self.count(ERROR)
+
+    @cocotb.coroutine
+    def setup(self, addr, data):
+        token = yield self.send(self.harness.host_send_token_packet,
+                                PID.SETUP, addr, 0)
+        yield self.send(self.harness.host_send_data_packet, PID.DATA0, data)
+        response = yield self.response(token)
+        return self._classify(response, PID.ACK)
+
+    @cocotb.coroutine
+    def data_in(self, addr, epnum, pid, expected):
+        token = yield self.send(self.harness.host_send_token_packet,
+                                PID.IN, addr, epnum)
+        response = yield self.response(token)
+        if response is not None and response.is_data:
+            yield self.send(self.harness.host_send_ack)
+            if response.pid != pid or response.data[:-2] != expected:
+                return self.count(ERROR)
+        return self._classify(response, pid)
+
+    @cocotb.coroutine
+    def data_out(self, addr, epnum, pid, data):
+        token = yield self.send(self.harness.host_send_token_packet,
+                                PID.OUT, addr, epnum)
+        yield self.send(self.harness.host_send_data_packet, pid, data)
+        response = yield self.response(token)
+        return self._classify(response, PID.ACK)
+
+
+@cocotb.coroutine
+def control_reads(pacer, transfers):
+    """Read the start of the device descriptor `transfers` times"""
+    expected = list(model.deviceDescriptor.get()[:8])
+    for _ in range(transfers):
+        outcome = yield pacer.setup(DEVICE_ADDRESS, GET_DESCRIPTOR_8)
+        if outcome != OK:
+            continue
+        while True:
+            outcome = yield pacer.data_in(DEVICE_ADDRESS, 0, PID.DATA1,
+                                          expected)
+            if outcome != NAK:
+                break
+        if outcome != OK:
+            continue
+        while True:
+            outcome = yield pacer.data_out(DEVICE_ADDRESS, 0, PID.DATA1, [])
+            if outcome != NAK:
+                break
+
+
+@cocotb.coroutine
+def bulk_writes(pacer, harness, transfers):
+    """Write `transfers` packets to the bulk OUT endpoint, the harness
+    re-arming it after each one"""
+    epnum, max_packet = bulk_endpoints(descriptorFile)['out']
+    firmware = HarnessFirmware(harness,
+                               EndpointType.epaddr(epnum, EndpointType.OUT))
+    yield firmware.arm()
+    toggle = PID.DATA0
+    for i in range(transfers):
+        data = [(i + j) & 0xff for j in range(max_packet)]
+        while True:
+            outcome = yield pacer.data_out(DEVICE_ADDRESS, epnum, toggle,
+                                           data)
+            if outcome == OK:
+                break
+        toggle = toggled(toggle)
+        cocotb.fork(firmware.arm())
+
+
+@cocotb.coroutine
+def run_stress(dut, gap_mode):
+    harness = get_harness(dut)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.set_configuration(1)
+
+    pacer = Pacer(harness, monitor, gap_mode, random.Random(SEED))
+    first_packet = len(monitor.packets)
+    start = get_sim_time('ns')
+    if environ.get('TARGET') == 'valentyusb':
+        scenario = 'bulk_out'
+        yield bulk_writes(pacer, harness, TRANSFERS)
+    else:
+        scenario = 'control_read'
+        yield control_reads(pacer, TRANSFERS)
+    elapsed_s = (get_sim_time('ns') - start) / 1e9
+
+    packets = monitor.packets[first_packet:]
+    gaps = [(b.start - a.end) / BIT_TIME_NS
+            for a, b in zip(packets, packets[1:]) if not b.device]
+    outcomes = pacer.outcomes
+    total = sum(outcomes.values())
+    properties = {
+        'stress_gap_mode': gap_mode,
+        'stress_scenario': scenario,
+        'stress_transactions': total,
+        'stress_handled': outcomes[OK],
+        'stress_naks': outcomes[NAK],
+        'stress_timeouts': outcomes[TIMEOUT],
+        'stress_errors': outcomes[ERROR],
+        'stress_handled_ratio': "{:.3f}".format(outcomes[OK] / total),
+        'stress_handled_per_s': "{:.0f}".format(outcomes[OK] / elapsed_s),
+        'stress_gap_bits_min': "{:.2f}".format(min(gaps)),
+        'stress_gap_bits_mean': "{:.2f}".format(sum(gaps) / len(gaps)),
+    }
+    report_properties(dut, properties)
+
+
+factory = TestFactory(run_stress)
+factory.add_option('gap_mode', ['min', 'random'])
+factory.generate_tests()
@@ -0,0 +1,354 @@
+"""Suspend, resume and remote wakeup timing
+
+After enumeration the host keeps the device alive with SOFs for a few
+frames, then leaves the bus idle. The device must not suspend before 3 ms
+of idle bus and must be suspended after 10 ms. Its suspend indication is the
+1-bit signal named by SUSPEND_SIGNAL (path below the `dut` instance, e.g.
+`usb_suspend`), set in the wrappers Makefile of the targets that have one.
+Targets without it only get the idle bus and the resume.
+
+The host then drives resume signalling, K for RESUME_K_US (default 2000,
+the specification asks for 20000) and a low-speed EOP, and sends an IN
+token on EP0 every PROBE_US until the device answers. The time from the end
+of the EOP to the answer must stay within the 10 ms resume recovery.
+
+Remote wakeup is only tested on devices that advertise it in their
+configuration descriptor, the test is skipped on the others: after
+SET_FEATURE(DEVICE_REMOTE_WAKEUP) the bus is left idle for up to
+REMOTE_WAKEUP_WAIT_MS (default 20) and the K driven by the device is timed.
+The test fails if the device drives no K in that time, and a device driving
+the suspended bus without remote wakeup enabled fails either test.
+
+Idle time is not skipped: the device clock keeps running through the idle
+periods, which are simulated in full. What is saved is the host clock,
+stopped while the bus is idle (SUSPEND_GATE_CLOCK=0 keeps it running), and
+the idle bus is only checked every POLL_US. An idle period ends as soon as
+the device reports suspend. The device clock is stopped only during the
+resume K, except for its last CLOCK_WAKE_US, like the oscillator of a
+suspended device. The simulated and wall-clock time of the idle periods go
+to results.xml.
+"""
+
+import time
+from os import environ
+
+import cocotb
+from cocotb.clock import Clock
+from cocotb.result import TestFailure
+from cocotb.triggers import FallingEdge, First, RisingEdge, Timer
+from cocotb.utils import get_sim_time
+from tests.harness import (get_harness, report_properties, restart_clock,
+                           skip_if, stop_clock)
+from tests.linedriver import J, K, SE0
+from tests.monitor import UsbMonitor
+from tests.transfers import RESPONSE_TIMEOUT_US
+from cocotb_usb.device import UsbDevice
+from cocotb_usb.usb.pid import PID
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+CLOCK_PERIOD_PS = 20830
+FRAME_NS = 1e6
+# Frames with SOFs during which the device must stay awake
+KEEP_ALIVE_FRAMES = 4
+# Idle bus limits of the suspend entry
+SUSPEND_MIN_US = 3000
+SUSPEND_MAX_US = 10000
+# Idle time left to devices without a suspend indication
+IDLE_WITHOUT_SIGNAL_US = 5000
+# Time the device has to answer after resume signalling
+RESUME_RECOVERY_US = 10000
+# Remote wakeup: idle bus before the K and duration of the K
+REMOTE_WAKEUP_IDLE_US = 5000
+REMOTE_WAKEUP_K_MIN_US = 1000
+REMOTE_WAKEUP_K_MAX_US = 15000
+# Idle bus check period
+POLL_US = 50
+# Period of the IN tokens after resume
+PROBE_US = 100
+# Time the device clock runs before the end of the resume K
+CLOCK_WAKE_US = 100
+# Resume signalling ends with a low-speed EOP
+LOW_SPEED_BIT_NS = 1e3 / 1.5
+REMOTE_WAKEUP = 0x20
+SET_FEATURE_REMOTE_WAKEUP = [0x00, 0x03, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00]
+
+# bmAttributes of the configuration descriptor
+if model.configDescriptor[1].get()[7] & REMOTE_WAKEUP:
+    WAKEUP_SKIP_REASON = None
+else:
+    WAKEUP_SKIP_REASON = "remote wakeup not advertised"
+
+
+def find_suspend_signal(dut):
+    """Returns the suspend indication named by SUSPEND_SIGNAL, None if the
+    target has none"""
+    path = environ.get('SUSPEND_SIGNAL', '')
+    if not path:
+        return None
+    handle = dut.dut
+    try:
+        for name in path.split('.'):
+            handle = getattr(handle, name)
+    except AttributeError:
+        raise TestFailure("No suspend indication {} in the DUT".format(path))
+    if len(handle) != 1:
+        raise TestFailure("Suspend indication {} is not a 1-bit signal"
+                          .format(path))
+    return handle
+
+
+def _bit(signal):
+    value = signal.value
+    return int(value) if value.is_resolvable else 0
+
+
+class SuspendHost:
+    def __init__(self, dut, harness, monitor):
+        self.dut = dut
+        self.harness = harness
+        self.monitor = monitor
+        self.signal = find_suspend_signal(dut)
+        self.frame = 0x10
+        self.clock = None
+        self.gate_host_clock = environ.get('SUSPEND_GATE_CLOCK', '1') != '0'
+        self.host_clock_gated = False
+        # Simulated and wall-clock time of the idle periods
+        self.idle_sim_us = 0.0
+        self.idle_wall_s = 0.0
+        # Idle time in us when the device reported suspend
+        self.suspend_us = None
+        # Start of the K driven by the device, in ns
+        self.wakeup_ns = None
+        # Line values while nobody drives the bus
+        self.released = None
+
+    def start_clock(self):
+        self.clock = cocotb.fork(
+            Clock(self.dut.clk48_device, CLOCK_PERIOD_PS, 'ps').start())
+
+    def stop_clock(self):
+        self.clock.kill()
+        self.clock = None
+
+    def stop_host_clock(self):
+        """Stop the host clock started by the harness, returns whether it
+        has to be started again"""
+        stopped = stop_clock(self.harness, 'clk48_host')
+        if not stopped:
+            self.dut._log.warning("Host clock not found, left running")
+        self.host_clock_gated |= stopped
+        return stopped
+
+    def suspended(self):
+        return self.signal is not None and bool(_bit(self.signal))
+
+    @cocotb.coroutine
+    def keep_alive(self, frames):
+        """Send SOFs for `frames` frames, the device must stay awake"""
+        for _ in range(frames):
+            yield self.harness.host_send_sof(self.frame)
+            self.frame = (self.frame + 1) & 0x7ff
+            if self.suspended():
+                raise TestFailure("Device suspended while receiving SOFs")
+            yield Timer(FRAME_NS - (get_sim_time('ns') % FRAME_NS), 'ns')
+
+    @cocotb.coroutine
+    def idle(self, limit_us, wakeup_enabled=False):
+        """Leave the bus idle for up to `limit_us` after the last packet.
+
+        Returns early once the device reports suspend or, with remote
+        wakeup enabled, starts driving the bus."""
+        start = self.monitor.packets[-1].end
+        self.released = (self.dut.usb_d_p.value, self.dut.usb_d_n.value)
+        self.suspend_us = None
+        self.wakeup_ns = None
+        stopped = self.gate_host_clock and self.stop_host_clock()
+        sim_start = get_sim_time('ns')
+        wall_start = time.perf_counter()
+        try:
+            while True:
+                elapsed_us = (get_sim_time('ns') - start) / 1e3
+                if self.suspend_us is None and self.suspended():
+                    self.suspend_us = elapsed_us
+                    if not wakeup_enabled:
+                        return
+                if elapsed_us >= limit_us:
+                    return
+                timer = Timer(min(POLL_US, limit_us - elapsed_us), 'us')
+                trigger = yield First(RisingEdge(self.monitor.tx_en), timer)
+                if trigger is timer:
+                    continue
+                if not wakeup_enabled:
+                    raise TestFailure(
+                        "Device drove the bus after {:.0f} us of idle "
+                        "without remote wakeup enabled".format(elapsed_us))
+                self.wakeup_ns = get_sim_time('ns')
+                return
+        finally:
+            self.idle_wall_s += time.perf_counter() - wall_start
+            self.idle_sim_us += (get_sim_time('ns') - sim_start) / 1e3
+            if stopped:
+                restart_clock(self.harness, 'clk48_host')
+
+    def drive(self, state):
+        self.dut.usb_d_p <= state[0]
+        self.dut.usb_d_n <= state[1]
+
+    @cocotb.coroutine
+    def resume(self, k_us, gate_clock=True):
+        """Drive K for `k_us` and a low-speed EOP. Returns the end of the EOP
+        in ns."""
+        self.drive(K)
+        wake_us = min(CLOCK_WAKE_US, k_us)
+        if gate_clock and k_us > wake_us:
+            self.stop_clock()
+            yield Timer(k_us - wake_us, 'us')
+            self.start_clock()
+        if wake_us:
+            yield Timer(wake_us, 'us')
+        self.drive(SE0)
+        yield Timer(2 * LOW_SPEED_BIT_NS, 'ns')
+        self.drive(J)
+        yield Timer(LOW_SPEED_BIT_NS, 'ns')
+        self.drive(self.released)
+        return get_sim_time('ns')
+
+    @cocotb.coroutine
+    def wait_answer(self, since, limit_us):
+        """Keep SOFs going and send IN tokens on EP0 until the device
+        answers. Returns the start of the answer in ns, or None."""
+        next_sof = since
+        while get_sim_time('ns') - since < limit_us * 1e3:
+            if get_sim_time('ns') >= next_sof:
+                yield self.harness.host_send_sof(self.frame)
+                self.frame = (self.frame + 1) & 0x7ff
+                next_sof += FRAME_NS
+            index = len(self.monitor.packets)
+            yield self.harness.host_send_token_packet(PID.IN, DEVICE_ADDRESS,
+                                                      0)
+            response = yield self.monitor.wait_response(index + 1,
+                                                        RESPONSE_TIMEOUT_US)
+            if response is not None:
+                if response.is_data:
+                    yield self.harness.host_send_ack()
+                return response.start
+            yield Timer(PROBE_US, 'us')
+        return None
+
+
+@cocotb.coroutine
+def enumerate_device(dut):
+    device_clock = Clock(dut.clk48_device, CLOCK_PERIOD_PS, 'ps')
+    clock = cocotb.fork(device_clock.start())
+    harness = get_harness(dut, decouple_clocks=True)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+    host = SuspendHost(dut, harness, monitor)
+    host.clock = clock
+    dut._log.info("Suspend indication: {}".format(
+        host.signal._name if host.signal is not None else "none"))
+
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.set_configuration(1)
+    yield host.keep_alive(KEEP_ALIVE_FRAMES)
+    return host
+
+
+def check_suspend_entry(host, properties):
+    properties['suspend_signal'] = host.signal._name \
+        if host.signal is not None else 'none'
+    if host.signal is None:
+        return
+    if host.suspend_us is None:
+        raise TestFailure("Device not suspended after {} us of idle bus"
+                          .format(SUSPEND_MAX_US))
+    properties['suspend_entry_us'] = "{:.0f}".format(host.suspend_us)
+    if host.suspend_us < SUSPEND_MIN_US:
+        raise TestFailure("Device suspended after {:.0f} us of idle bus"
+                          .format(host.suspend_us))
+
+
+@cocotb.coroutine
+def check_answer(host, resumed, properties):
+    answer = yield host.wait_answer(resumed, RESUME_RECOVERY_US)
+    if answer is None:
+        raise TestFailure("No answer within {} us of resume".format(
+            RESUME_RECOVERY_US))
+    properties['resume_answer_us'] = "{:.1f}".format((answer - resumed) / 1e3)
+    if host.suspended():
+        raise TestFailure("Device still reports suspend after resume")
+    # The device kept its address and configuration
+    yield host.harness.get_device_descriptor(model.deviceDescriptor.get())
+
+
+def report(dut, host, properties):
+    if host is not None:
+        properties['suspend_idle_sim_us'] = "{:.0f}".format(host.idle_sim_us)
+        properties['suspend_idle_wall_s'] = "{:.3f}".format(host.idle_wall_s)
+        properties['suspend_host_clock_gated'] = int(host.host_clock_gated)
+    report_properties(dut, properties)
+
+
+@cocotb.test()
+def test_suspend_resume(dut):
+    k_us = float(environ.get('RESUME_K_US', '2000'))
+    host = yield enumerate_device(dut)
+    properties = {}
+
+    limit = SUSPEND_MAX_US if host.signal is not None \
+        else IDLE_WITHOUT_SIGNAL_US
+    yield host.idle(limit)
+    check_suspend_entry(host, properties)
+
+    resumed = yield host.resume(k_us)
+    properties['resume_k_us'] = "{:.0f}".format(k_us)
+    yield check_answer(host, resumed, properties)
+    report(dut, host, properties)
+
+
+@cocotb.test(skip=skip_if(WAKEUP_SKIP_REASON))
+def test_remote_wakeup(dut):
+    k_us = float(environ.get('RESUME_K_US', '2000'))
+    wait_ms = float(environ.get('REMOTE_WAKEUP_WAIT_MS', '20'))
+    properties = {}
+    host = yield enumerate_device(dut)
+    yield host.harness.control_transfer_out(DEVICE_ADDRESS,
+                                            SET_FEATURE_REMOTE_WAKEUP, None)
+    yield host.idle(wait_ms * 1e3, wakeup_enabled=True)
+    if host.signal is not None and host.suspend_us is not None:
+        properties['suspend_entry_us'] = "{:.0f}".format(host.suspend_us)
+    if host.wakeup_ns is None:
+        report(dut, host, properties)
+        raise TestFailure("No remote wakeup within {} ms of idle bus".format(
+            wait_ms))
+
+    idle_us = (host.wakeup_ns - host.monitor.packets[-1].end) / 1e3
+    properties['remote_wakeup_idle_us'] = "{:.0f}".format(idle_us)
+    if idle_us < REMOTE_WAKEUP_IDLE_US:
+        raise TestFailure("Remote wakeup after {:.0f} us of idle bus".format(
+            idle_us))
+    # The host takes over the K right away and keeps it after the device
+    # stops driving
+    host.drive(K)
+    yield First(FallingEdge(host.monitor.tx_en),
+                Timer(2 * REMOTE_WAKEUP_K_MAX_US, 'us'))
+    k_device_us = (get_sim_time('ns') - host.wakeup_ns) / 1e3
+    properties['remote_wakeup_k_us'] = "{:.0f}".format(k_device_us)
+    if not REMOTE_WAKEUP_K_MIN_US <= k_device_us <= REMOTE_WAKEUP_K_MAX_US:
+        raise TestFailure("Remote wakeup K lasted {:.0f} us".format(
+            k_device_us))
+    remaining_us = max(0, k_us - k_device_us)
+    resumed = yield host.resume(remaining_us, gate_clock=False)
+    yield check_answer(host, resumed, properties)
+    report(dut, host, properties)
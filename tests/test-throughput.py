@@ -0,0 +1,188 @@
+"""Bulk endpoint throughput
+
+Streams data through the first bulk IN and OUT endpoints of the device
+descriptor. Transactions are issued back-to-back inside 1 ms frames, as long
+as one more maximum size transaction fits before the end of the frame.
+
+The volumes streamed are set with THROUGHPUT_VOLUMES (comma separated
+byte counts). On valentyusb the harness plays the firmware: it refills the IN
+endpoint and drains the OUT endpoint, and the data the core received is
+checked against the data sent. The directions the descriptors have no bulk
+endpoint for are skipped.
+"""
+
+from os import environ
+
+import cocotb
+from cocotb.regression import TestFactory
+from cocotb.result import TestFailure
+from cocotb.triggers import Lock, Timer
+from cocotb.utils import get_sim_time
+from tests.harness import (get_harness, min_mean_max, report_properties,
+                           skip_generated)
+from tests.monitor import BIT_TIME_NS, UsbMonitor
+from tests.transfers import (HarnessFirmware, bulk_endpoints, in_transaction,
+                             out_transaction, toggled, transaction_ns)
+from cocotb_usb.usb.endpoint import EndpointType
+from cocotb_usb.usb.pid import PID
+
+descriptorFile = environ['TARGET_CONFIG']
+
+DEVICE_ADDRESS = 20
+FRAME_NS = 1e6
+# Give up after that many frames without any data going through
+MAX_IDLE_FRAMES = 10
+
+VOLUMES = [int(v, 0) for v in
+           environ.get('THROUGHPUT_VOLUMES', '1024,65536').split(',')]
+
+
+def payload(offset, length):
+    return [(offset + i) & 0xff for i in range(length)]
+
+
+@cocotb.coroutine
+def enumerate_device(harness):
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+
+    yield harness.port_reset(10e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.set_configuration(1)
+
+
+@cocotb.coroutine
+def drain(firmware, received):
+    data = yield firmware.drain()
+    received += data
+
+
+@cocotb.coroutine
+def run_throughput(dut, direction, volume):
+    harness = get_harness(dut)
+    epnum, max_packet = bulk_endpoints(descriptorFile)[direction]
+    ep_type = EndpointType.IN if direction == 'in' else EndpointType.OUT
+    epaddr = EndpointType.epaddr(epnum, ep_type)
+
+    # A monitor of our own is stopped at the end, the shared one keeps
+    # serving the harness extensions
+    own_monitor = harness.monitor is None
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+    yield enumerate_device(harness)
+
+    firmware = None
+    # Data drained from the OUT endpoint by the firmware
+    received = []
+    drain_task = None
+    if environ.get('TARGET') == 'valentyusb':
+        firmware = HarnessFirmware(harness, epaddr, Lock())
+        yield firmware.arm(payload(0, min(max_packet, volume))
+                           if direction == 'in' else None)
+
+    slot_ns = transaction_ns(max_packet)
+    first_packet = len(monitor.packets)
+    transferred = 0
+    transactions = 0
+    naks = 0
+    frame_bytes = []
+    toggle = PID.DATA0
+    frame = 2
+    start = get_sim_time('ns')
+
+    while transferred < volume:
+        frame_end = get_sim_time('ns') + FRAME_NS
+        yield harness.host_send_sof(frame & 0x7ff)
+        frame += 1
+        sent = 0
+        while transferred < volume and \
+                frame_end - get_sim_time('ns') > slot_ns:
+            length = min(max_packet, volume - transferred)
+            transactions += 1
+            if direction == 'in':
+                response = yield in_transaction(harness, monitor,
+                                                DEVICE_ADDRESS, epnum)
+            else:
+                response = yield out_transaction(
+                    harness, monitor, DEVICE_ADDRESS, epnum, toggle,
+                    payload(transferred, length))
+            if response.pid == PID.NAK:
+                naks += 1
+                continue
+
+            if direction == 'in':
+                if response.pid != toggle:
+                    # Retransmission of a packet we already have
+                    continue
+                # Strip CRC16
+                data = response.data[:-2]
+                if firmware is not None and \
+                        data != payload(transferred, length):
+                    raise TestFailure("Wrong data at byte {}: {}".format(
+                        transferred, bytes(data).hex()))
+            else:
+                data = payload(transferred, length)
+
+            transferred += len(data)
+            sent += len(data)
+            toggle = toggled(toggle)
+            if firmware is not None and direction == 'out':
+                drain_task = cocotb.fork(drain(firmware, received))
+            elif firmware is not None and transferred < volume:
+                cocotb.fork(firmware.arm(
+                    payload(transferred,
+                            min(max_packet, volume - transferred))))
+
+        frame_bytes.append(sent)
+        if len(frame_bytes) > MAX_IDLE_FRAMES and \
+                not any(frame_bytes[-MAX_IDLE_FRAMES:]):
+            raise TestFailure("No data went through in {} frames".format(
+                MAX_IDLE_FRAMES))
+        remaining = frame_end - get_sim_time('ns')
+        if remaining > 0 and transferred < volume:
+            yield Timer(remaining, 'ns')
+
+    elapsed_s = (get_sim_time('ns') - start) / 1e9
+    if drain_task is not None:
+        yield drain_task.join()
+        if received != payload(0, volume):
+            offset = next((i for i, (a, b) in enumerate(
+                zip(received, payload(0, volume))) if a != b),
+                min(len(received), volume))
+            raise TestFailure(
+                "Device received {} of {} bytes, wrong from byte {}".format(
+                    len(received), volume, offset))
+    turnarounds = [p.turnaround / BIT_TIME_NS
+                   for p in monitor.packets[first_packet:]
+                   if p.device and p.turnaround is not None]
+    if own_monitor:
+        monitor.stop()
+    ta_min, ta_mean, ta_max = min_mean_max(turnarounds)
+    _, per_frame, per_frame_max = min_mean_max(frame_bytes)
+    properties = {
+        'throughput_endpoint': "EP{} {}".format(epnum, direction.upper()),
+        'throughput_bytes': transferred,
+        'throughput_frames': len(frame_bytes),
+        'throughput_bytes_per_frame': "{:.1f}".format(per_frame),
+        'throughput_bytes_per_frame_max': per_frame_max,
+        'throughput_bytes_per_s': "{:.0f}".format(transferred / elapsed_s),
+        'throughput_nak_ratio': "{:.3f}".format(naks / transactions),
+        'turnaround_bits_min': "{:.2f}".format(ta_min),
+        'turnaround_bits_mean': "{:.2f}".format(ta_mean),
+        'turnaround_bits_max': "{:.2f}".format(ta_max),
+    }
+    report_properties(dut, properties)
+
+
+factory = TestFactory(run_throughput)
+factory.add_option('direction', ['in', 'out'])
+factory.add_option('volume', VOLUMES)
+factory.generate_tests()
+skip_generated(
+    factory, lambda direction, volume:
+    None if direction in bulk_endpoints(descriptorFile) else
+    "no bulk {} endpoint".format(direction.upper()))
@@ -0,0 +1,208 @@
+"""TinyFPGA bootloader programming throughput (tinyfpgabl)
+
+Drives the bootloader the way tinyprog does: every SPI flash command is
+sent over the CDC bulk OUT endpoint as a bootloader packet and read data is
+collected from the bulk IN endpoint. The flash is modelled by
+tests/spiflash.py behind the flash pins of the testbench.
+
+For each size in TINYPROG_SIZES the read, erase and program (erase, page
+programs and read back) sequences are timed, reporting the end-to-end bytes
+per simulated second and the host round trips per flash page. Flash busy
+times are scaled by SPIFLASH_TIME_SCALE to keep simulations short.
+"""
+
+import random
+import struct
+from os import environ
+
+import cocotb
+from cocotb.regression import TestFactory
+from cocotb.result import TestFailure
+from cocotb.utils import get_sim_time
+from tests import spiflash
+from tests.harness import get_harness, report_properties, skip_generated
+from tests.monitor import UsbMonitor
+from tests.transfers import BulkPipe, bulk_endpoints
+from cocotb_usb.device import UsbDevice
+from cocotb_usb.descriptors.cdc import (setLineCoding, setControlLineState,
+                                        LineCodingStructure)
+
+descriptorFile = environ['TARGET_CONFIG']
+model = UsbDevice(descriptorFile)
+
+DEVICE_ADDRESS = 20
+CDC_INTERFACE = 1
+SIZES = [int(size, 0) for size in
+         environ.get('TINYPROG_SIZES', '1024,4096').split(',')]
+TIME_SCALE = float(environ.get('SPIFLASH_TIME_SCALE', '1'))
+# Limit of status reads while the flash is busy with one operation
+MAX_POLLS = 10000
+
+# Bootloader opcode passing a command through to the SPI flash
+SPI_TRANSFER = 0x01
+# Largest read requested in one command, as done by tinyprog
+READ_CHUNK = 255
+# Programming starts past the bootloader image
+BASE_ADDRESS = 0x28000
+
+# Only the tinyfpgabl testbench has the SPI flash pins of the flash model
+if environ.get('TARGET') != 'tinyfpgabl':
+    SKIP_REASON = "target has no SPI flash"
+elif not {'in', 'out'} <= set(bulk_endpoints(descriptorFile)):
+    SKIP_REASON = "target has no bulk endpoints"
+else:
+    SKIP_REASON = None
+
+
+class Programmer:
+    """Host side of the bootloader protocol, counting round trips"""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.round_trips = 0
+        self.polls = 0
+
+    @cocotb.coroutine
+    def command(self, opcode, addr=None, data=b'', read_len=0):
+        """Run one flash command, returns the `read_len` bytes read back"""
+        spi = bytes([opcode]) + data
+        if addr is not None:
+            spi = bytes([opcode]) + struct.pack('>I', addr)[1:] + data
+        self.round_trips += 1
+        yield self.pipe.write(
+            struct.pack('<BHH', SPI_TRANSFER, len(spi), read_len) + spi)
+        result = b''
+        if read_len:
+            result = yield self.pipe.read(read_len)
+        return result
+
+    @cocotb.coroutine
+    def wait_ready(self):
+        for _ in range(MAX_POLLS):
+            status = yield self.command(spiflash.READ_STATUS, read_len=1)
+            self.polls += 1
+            if not status[0] & spiflash.STATUS_WIP:
+                return
+        raise TestFailure("Flash still busy after {} polls".format(
+            MAX_POLLS))
+
+    @cocotb.coroutine
+    def read(self, addr, length):
+        data = b''
+        while len(data) < length:
+            chunk = min(READ_CHUNK, length - len(data))
+            # FAST_READ needs a dummy byte after the address
+            data += yield self.command(spiflash.FAST_READ, addr + len(data),
+                                       b'\x00', chunk)
+        return data
+
+    @cocotb.coroutine
+    def erase(self, addr, length, sector_size):
+        for sector in range(addr, addr + length, sector_size):
+            yield self.command(spiflash.WRITE_ENABLE)
+            yield self.command(spiflash.SECTOR_ERASE, sector)
+            yield self.wait_ready()
+
+    @cocotb.coroutine
+    def program(self, addr, data, page_size):
+        for offset in range(0, len(data), page_size):
+            yield self.command(spiflash.WRITE_ENABLE)
+            yield self.command(spiflash.PAGE_PROGRAM, addr + offset,
+                               data[offset:offset + page_size])
+            yield self.wait_ready()
+
+
+@cocotb.coroutine
+def enumerate_device(harness):
+    yield harness.reset()
+    yield harness.wait(1e3, units="us")
+    yield harness.port_reset(1e3)
+    yield harness.connect()
+    yield harness.wait(1e3, units="us")
+    # After waiting (bus inactivity) let's start with SOF
+    yield harness.host_send_sof(0x01)
+    yield harness.set_device_address(DEVICE_ADDRESS)
+    yield harness.set_configuration(1)
+    line_coding = LineCodingStructure(115200,
+                                      LineCodingStructure.STOP_BITS_1,
+                                      LineCodingStructure.PARITY_NONE,
+                                      LineCodingStructure.DATA_BITS_8)
+    yield harness.control_transfer_out(DEVICE_ADDRESS,
+                                       setLineCoding(CDC_INTERFACE),
+                                       line_coding.get())
+    yield harness.control_transfer_out(
+        DEVICE_ADDRESS,
+        setControlLineState(interface=0, rts=1, dtr=1),
+        None)
+
+
+@cocotb.coroutine
+def run_programming(dut, operation, size):
+    harness = get_harness(dut)
+    endpoints = bulk_endpoints(descriptorFile)
+    harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
+    monitor = harness.monitor or UsbMonitor(dut)
+    monitor.start()
+    flash = spiflash.SpiFlash(dut, time_scale=TIME_SCALE)
+    flash.start()
+
+    yield enumerate_device(harness)
+
+    (out_ep, out_size), (in_ep, in_size) = endpoints['out'], endpoints['in']
+    pipe = BulkPipe(harness, monitor, DEVICE_ADDRESS, out_ep, in_ep,
+                    min(out_size, in_size))
+    programmer = Programmer(pipe)
+
+    yield programmer.command(spiflash.RELEASE_POWER_DOWN)
+    jedec_id = yield programmer.command(spiflash.READ_ID, read_len=3)
+    if tuple(jedec_id) != spiflash.JEDEC_ID:
+        raise TestFailure("Unexpected flash ID: " + jedec_id.hex())
+
+    image = bytes(random.Random(size).getrandbits(8) for _ in range(size))
+    model_flash = flash.flash
+    if operation == 'read':
+        model_flash.data[BASE_ADDRESS:BASE_ADDRESS + size] = image
+
+    # Only count the operation itself
+    programmer.round_trips = 0
+    pipe.naks = 0
+    busy_us = model_flash.busy_us
+    start = get_sim_time('ns')
+
+    if operation == 'read':
+        data = yield programmer.read(BASE_ADDRESS, size)
+        if data != image:
+            raise TestFailure("Data read back differs from the flash")
+    elif operation == 'erase':
+        yield programmer.erase(BASE_ADDRESS, size, model_flash.sector_size)
+        if model_flash.read(BASE_ADDRESS, size) != b'\xff' * size:
+            raise TestFailure("Flash not erased")
+    else:
+        yield programmer.erase(BASE_ADDRESS, size, model_flash.sector_size)
+        yield programmer.program(BASE_ADDRESS, image, model_flash.page_size)
+        data = yield programmer.read(BASE_ADDRESS, size)
+        if data != image or model_flash.read(BASE_ADDRESS, size) != image:
+            raise TestFailure("Programmed data differs from the image")
+
+    elapsed_s = (get_sim_time('ns') - start) / 1e9
+    pages = -(-size // model_flash.page_size)
+    properties = {
+        'tinyprog_operation': operation,
+        'tinyprog_bytes': size,
+        'tinyprog_bytes_per_s': "{:.0f}".format(size / elapsed_s),
+        'tinyprog_round_trips': programmer.round_trips,
+        'tinyprog_round_trips_per_page': "{:.2f}".format(
+            programmer.round_trips / pages),
+        'tinyprog_status_polls': programmer.polls,
+        'tinyprog_naks': pipe.naks,
+        'tinyprog_flash_busy_ms': "{:.1f}".format(
+            (model_flash.busy_us - busy_us) * TIME_SCALE / 1e3),
+    }
+    report_properties(dut, properties)
+
+
+factory = TestFactory(run_programming)
+factory.add_option('operation', ['read', 'erase', 'program'])
+factory.add_option('size', SIZES)
+factory.generate_tests()
+skip_generated(factory, lambda operation, size: SKIP_REASON)
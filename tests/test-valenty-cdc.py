@@ -1,6 +1,6 @@
 import cocotb
 
-from cocotb_usb.harness import get_harness
+from tests.harness import get_harness
 from cocotb_usb.device import UsbDevice
 from cocotb_usb.descriptors.cdc import (setLineCoding, setControlLineState,
                                         getLineCoding, LineCodingStructure)
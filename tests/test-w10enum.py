@@ -2,7 +2,8 @@ from os import environ
 
 import cocotb
 
-from cocotb_usb.harness import get_harness
+from tests.enumtiming import time_enumeration
+from tests.harness import get_harness
 from cocotb_usb.device import UsbDevice
 
 DESCRIPTOR_FILE = environ['TARGET_CONFIG']
@@ -14,6 +15,7 @@ model = UsbDevice(DESCRIPTOR_FILE)
 @cocotb.test()
 def test_enumeration_w10(dut):
     harness = get_harness(dut)
+    time_enumeration(harness, 'windows10')
     harness.max_packet_size = model.deviceDescriptor.bMaxPacketSize0
     yield harness.reset()
     yield harness.connect()
@@ -0,0 +1,416 @@
+"""Host transfers accepting whatever the device answers
+
+Unlike the harness primitives, which check the answer they expect, these
+return what the device sent, as decoded by the bus monitor. They are meant
+for protocols where the answer is not known up front (status requests,
+data produced by the device firmware).
+"""
+
+import json
+import re
+
+import cocotb
+from cocotb.result import TestFailure
+from tests.monitor import BIT_TIME_NS
+from cocotb_usb.usb.endpoint import EndpointType, EndpointResponse
+from cocotb_usb.usb.pid import PID
+
+# Time to wait for the device to answer a token or data packet
+RESPONSE_TIMEOUT_US = 100
+# Largest full-speed bulk packet
+MAX_BULK_PACKET = 64
+# USB_OUT_STATUS: the OUT FIFO holds data
+OUT_STATUS_HAVE = 0x10
+# NAKs accepted in a row before giving up on a transaction
+NAK_LIMIT = 50
+
+
+def toggled(pid):
+    """Data PID following `pid`"""
+    return PID.DATA1 if pid == PID.DATA0 else PID.DATA0
+
+
+def transaction_ns(max_packet):
+    """Time needed by the largest transaction with `max_packet` bytes of data:
+    token, stuffed data packet, handshake and the gaps between them"""
+    return (8 * max_packet * 7 / 6 + 150) * BIT_TIME_NS
+
+
+def _int(value):
+    return int(value, 0) if isinstance(value, str) else value
+
+
+TRANSFER_TYPES = {'Control': 0, 'Isochronous': 1, 'Bulk': 2, 'Interrupt': 3}
+
+
+def descriptor_endpoints(descriptor_file):
+    """Returns [(endpoint number, direction, transfer type, max packet size,
+    bInterval)] of the endpoints in the descriptor file, in their order"""
+    with open(descriptor_file, 'r') as f:
+        descriptors = json.load(f)
+    types = {value: name for name, value in TRANSFER_TYPES.items()}
+    endpoints = []
+
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+        elif isinstance(node, dict):
+            if node.get('name') == 'Endpoint':
+                attributes = node['bmAttributes']
+                if isinstance(attributes, dict):
+                    transfer = attributes['Transfer']
+                else:
+                    transfer = types[_int(attributes) & 0x3]
+                address = node['bEndpointAddress']
+                if isinstance(address, list):
+                    epnum, direction = address[0], address[1].lower()
+                else:
+                    address = _int(address)
+                    epnum = address & 0xf
+                    direction = 'in' if address & 0x80 else 'out'
+                size = min(_int(node['wMaxPacketSize']), MAX_BULK_PACKET)
+                endpoints.append((epnum, direction, transfer, size,
+                                  _int(node['bInterval'])))
+            for value in node.values():
+                walk(value)
+
+    walk(descriptors)
+    return endpoints
+
+
+def find_endpoints(descriptor_file, transfer='Bulk'):
+    """Returns {direction: (endpoint number, max packet size, bInterval)} of
+    the first endpoints of the `transfer` type found in the descriptor
+    file"""
+    endpoints = {}
+    for epnum, direction, found, size, interval in \
+            descriptor_endpoints(descriptor_file):
+        if found == transfer:
+            endpoints.setdefault(direction, (epnum, size, interval))
+    return endpoints
+
+
+def bulk_endpoints(descriptor_file):
+    """Returns {direction: (endpoint number, max packet size)} of the first
+    bulk endpoints found in the descriptor file"""
+    return {direction: endpoint[:2] for direction, endpoint in
+            find_endpoints(descriptor_file, 'Bulk').items()}
+
+
+class HarnessFirmware:
+    """Device side of the data endpoints for targets where the harness acts
+    as the firmware of the core (valentyusb). Every endpoint buffer is
+    refilled or drained after the host completed a transaction on it.
+
+    Firmwares of several endpoints armed concurrently must share a `lock`,
+    serializing their accesses to the CSR bus. The firmware of a data
+    endpoint armed concurrently with the transfers needs one too."""
+
+    def __init__(self, harness, epaddr, lock=None):
+        self.harness = harness
+        self.epaddr = epaddr
+        self.lock = lock
+
+    @cocotb.coroutine
+    def arm(self, data=None):
+        if self.lock is not None:
+            yield self.lock.acquire()
+        try:
+            yield self.harness.clear_pending(self.epaddr)
+            if data is not None:
+                yield self.harness.set_data(self.epaddr, data)
+            yield self.harness.set_response(self.epaddr,
+                                            EndpointResponse.ACK)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    @cocotb.coroutine
+    def drain(self):
+        """Read the packet received on the OUT endpoint out of the core FIFO
+        and arm the endpoint for the next one. Returns the packet data, CRC16
+        stripped."""
+        from regmap import USB_OUT_DATA, USB_OUT_STATUS
+        if self.lock is not None:
+            yield self.lock.acquire()
+        data = []
+        try:
+            while True:
+                status = yield self.harness.read(USB_OUT_STATUS)
+                if not status & OUT_STATUS_HAVE:
+                    break
+                value = yield self.harness.read(USB_OUT_DATA)
+                data.append(value)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        yield self.arm()
+        return data[:-2]
+
+    @cocotb.coroutine
+    def drain_setup(self):
+        """Read the SETUP packet received on EP0 out of the core. Returns its
+        data."""
+        if self.lock is not None:
+            yield self.lock.acquire()
+        try:
+            data = yield self.harness.drain_setup()
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        return data
+
+
+def fifo_endpoints():
+    """Returns {endpoint number: [directions]} of the endpoints of the
+    valentyusb epfifo core, found in its register map"""
+    import regmap
+    endpoints = {}
+    for name in sorted(dir(regmap)):
+        match = re.match(r'USB_EP_(\d+)_(IN|OUT)_RESPOND$', name)
+        if match:
+            direction = EndpointType.IN if match.group(2) == 'IN' else \
+                EndpointType.OUT
+            endpoints.setdefault(int(match.group(1)), []).append(direction)
+    return endpoints
+
+
+class FifoFirmware:
+    """Device side of one endpoint of the valentyusb epfifo core, played by
+    the harness through the CSRs the core has for every endpoint and
+    direction (USB_EP_<n>_<IN|OUT>_*). The core answers NAK after every
+    packet until the firmware sets the endpoint response to ACK again.
+
+    Same interface and locking as HarnessFirmware. The harness primitives
+    driving eptri (drain_setup(), set_device_address()) do not apply, the
+    device keeps address 0."""
+
+    def __init__(self, harness, epnum, direction, lock=None):
+        self.harness = harness
+        self.epnum = epnum
+        self.direction = direction
+        self.lock = lock
+        self.prefix = 'USB_EP_{}_{}_'.format(
+            epnum, 'IN' if direction == EndpointType.IN else 'OUT')
+
+    def csr(self, name):
+        import regmap
+        return getattr(regmap, self.prefix + name)
+
+    @cocotb.coroutine
+    def _clear_pending(self):
+        pending = yield self.harness.read(self.csr('EV_PENDING'))
+        yield self.harness.write(self.csr('EV_PENDING'), pending)
+
+    @cocotb.coroutine
+    def _read_fifo(self):
+        """Empty the OUT FIFO. Returns its content, CRC16 included."""
+        data = []
+        while True:
+            empty = yield self.harness.read(self.csr('OBUF_EMPTY'))
+            if empty:
+                break
+            value = yield self.harness.read(self.csr('OBUF_HEAD'))
+            data.append(value)
+            # Writing the head register pops the byte
+            yield self.harness.write(self.csr('OBUF_HEAD'), 0)
+        return data
+
+    @cocotb.coroutine
+    def arm(self, data=None):
+        if self.lock is not None:
+            yield self.lock.acquire()
+        try:
+            yield self._clear_pending()
+            if data is not None:
+                for value in data:
+                    yield self.harness.write(self.csr('IBUF_HEAD'), value)
+            yield self.harness.write(self.csr('RESPOND'),
+                                     EndpointResponse.ACK)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    @cocotb.coroutine
+    def drain(self):
+        """Read the packet received on the OUT endpoint out of its FIFO and
+        arm the endpoint for the next one. Returns the packet data, CRC16
+        stripped."""
+        if self.lock is not None:
+            yield self.lock.acquire()
+        try:
+            data = yield self._read_fifo()
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        yield self.arm()
+        return data[:-2]
+
+    @cocotb.coroutine
+    def drain_setup(self):
+        """Read the SETUP packet out of the EP0 OUT FIFO and start the data
+        stage of EP0 IN with DATA1. Returns the SETUP data."""
+        import regmap
+        if self.lock is not None:
+            yield self.lock.acquire()
+        try:
+            data = yield self._read_fifo()
+            yield self._clear_pending()
+            yield self.harness.write(regmap.USB_EP_0_IN_DTB, 1)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        return data[:-2]
+
+
+class Stall(TestFailure):
+    """The device answered STALL"""
+
+
+class NakLimit(TestFailure):
+    """The device answered NAK NAK_LIMIT times in a row"""
+
+
+@cocotb.coroutine
+def in_transaction(harness, monitor, addr, epnum,
+                   timeout_us=RESPONSE_TIMEOUT_US):
+    """Send an IN token, acknowledge data. Returns the device answer."""
+    index = len(monitor.packets)
+    yield harness.host_send_token_packet(PID.IN, addr, epnum)
+    response = yield monitor.wait_response(index + 1, timeout_us)
+    if response is None:
+        raise TestFailure("No response to IN on EP{}".format(epnum))
+    if response.valid and response.pid == PID.STALL:
+        raise Stall("EP{} IN stalled".format(epnum))
+    if response.is_data:
+        yield harness.host_send_ack()
+    elif not (response.valid and response.pid == PID.NAK):
+        raise TestFailure("Unexpected answer to IN: " + repr(response))
+    return response
+
+
+@cocotb.coroutine
+def out_transaction(harness, monitor, addr, epnum, pid, data,
+                    timeout_us=RESPONSE_TIMEOUT_US):
+    """Send an OUT token and data. Returns the device handshake."""
+    index = len(monitor.packets)
+    yield harness.host_send_token_packet(PID.OUT, addr, epnum)
+    yield harness.host_send_data_packet(pid, data)
+    response = yield monitor.wait_response(index + 1, timeout_us)
+    if response is None:
+        raise TestFailure("No response to OUT on EP{}".format(epnum))
+    if response.valid and response.pid == PID.STALL:
+        raise Stall("EP{} OUT stalled".format(epnum))
+    if not (response.valid and response.pid in (PID.ACK, PID.NAK)):
+        raise TestFailure("Unexpected answer to OUT: " + repr(response))
+    return response
+
+
+@cocotb.coroutine
+def control_read(harness, monitor, addr, setup):
+    """Control IN transfer returning the data stage sent by the device,
+    raises NakLimit if the device keeps answering NAK"""
+    yield harness.transaction_setup(addr, setup)
+    length = setup[6] | setup[7] << 8
+    data = []
+    toggle = PID.DATA1
+    retries = 0
+    while len(data) < length:
+        if retries == NAK_LIMIT:
+            raise NakLimit("EP0 IN answered NAK {} times".format(retries))
+        response = yield in_transaction(harness, monitor, addr, 0)
+        if not response.is_data:
+            retries += 1
+            continue
+        if response.pid != toggle:
+            # Retransmission of a packet we already have
+            retries += 1
+            continue
+        retries = 0
+        toggle = toggled(toggle)
+        # Strip CRC16
+        packet = response.data[:-2]
+        data += packet
+        if len(packet) < harness.max_packet_size:
+            break
+    yield harness.transaction_status_out(
+        addr, EndpointType.epaddr(0, EndpointType.OUT))
+    return data
+
+
+@cocotb.coroutine
+def control_write(harness, monitor, addr, setup, data):
+    """Control OUT transfer, raises Stall if the device stalls the data or
+    status stage and NakLimit if it keeps answering NAK"""
+    yield harness.transaction_setup(addr, setup)
+    data = list(data)
+    toggle = PID.DATA1
+    for offset in range(0, len(data), harness.max_packet_size):
+        chunk = data[offset:offset + harness.max_packet_size]
+        for _ in range(NAK_LIMIT):
+            response = yield out_transaction(harness, monitor, addr, 0,
+                                             toggle, chunk)
+            if response.pid == PID.ACK:
+                break
+        else:
+            raise NakLimit("EP0 OUT answered NAK {} times".format(NAK_LIMIT))
+        toggle = toggled(toggle)
+    # Status stage, a zero-length packet from the device
+    for _ in range(NAK_LIMIT):
+        response = yield in_transaction(harness, monitor, addr, 0)
+        if response.is_data:
+            break
+    else:
+        raise NakLimit("EP0 status stage answered NAK {} times".format(
+            NAK_LIMIT))
+
+
+class BulkPipe:
+    """Byte stream over a bulk OUT and a bulk IN endpoint, keeping track of
+    the data toggles and of the NAKs the device answered"""
+
+    def __init__(self, harness, monitor, addr, out_ep, in_ep, max_packet):
+        self.harness = harness
+        self.monitor = monitor
+        self.addr = addr
+        self.out_ep = out_ep
+        self.in_ep = in_ep
+        self.max_packet = max_packet
+        self.out_toggle = PID.DATA0
+        self.in_toggle = PID.DATA0
+        self.transactions = 0
+        self.naks = 0
+
+    @cocotb.coroutine
+    def write(self, data):
+        data = list(data)
+        for offset in range(0, len(data), self.max_packet):
+            chunk = data[offset:offset + self.max_packet]
+            while True:
+                self.transactions += 1
+                response = yield out_transaction(self.harness, self.monitor,
+                                                 self.addr, self.out_ep,
+                                                 self.out_toggle, chunk)
+                if response.pid == PID.ACK:
+                    break
+                self.naks += 1
+            self.out_toggle = toggled(self.out_toggle)
+
+    @cocotb.coroutine
+    def read(self, length):
+        data = []
+        while len(data) < length:
+            self.transactions += 1
+            response = yield in_transaction(self.harness, self.monitor,
+                                            self.addr, self.in_ep)
+            if not response.is_data:
+                self.naks += 1
+                continue
+            if response.pid != self.in_toggle:
+                # Retransmission of a packet we already have
+                continue
+            self.in_toggle = toggled(self.in_toggle)
+            # Strip CRC16
+            data += response.data[:-2]
+        return bytes(data)
@@ -0,0 +1,72 @@
+"""Device turnaround time checks
+
+The turnaround time is the time from the end of the EOP of a host packet to
+the start of the SYNC of the device answer. The samples of every test are
+grouped by answer PID and endpoint, summarized in results.xml and appended
+to a file from which tools/turnaround.py builds per-target histograms.
+"""
+
+import json
+
+from cocotb.result import TestFailure
+
+from tests.monitor import BIT_TIME_NS
+from tests.samples import format_summary
+from cocotb_usb.usb.pid import PID
+
+# Device turnaround limit with a captive cable, in bit times
+LIMIT_BITS = 7.5
+
+# Host packets the device answers, and the packets it answers with. Other
+# device line activity (the K of a remote wakeup) is not a turnaround.
+QUERIES = (PID.SETUP, PID.OUT, PID.IN, PID.DATA0, PID.DATA1)
+ANSWERS = (PID.DATA0, PID.DATA1, PID.ACK, PID.NAK, PID.STALL)
+
+
+class TurnaroundCheck:
+    def __init__(self, monitor, target, samples_file, limit_bits=LIMIT_BITS):
+        self.target = target
+        self.samples_file = samples_file
+        self.limit_bits = limit_bits
+        # {(PID name, endpoint): [turnaround in bit times]}
+        self.samples = {}
+        # Last host packet seen
+        self._query = None
+        monitor.callbacks.append(self.check)
+
+    def check(self, packet):
+        if not packet.device:
+            self._query = packet
+            return
+        query, self._query = self._query, None
+        if packet.turnaround is None or query is None or \
+                not (query.valid and query.pid in QUERIES) or \
+                not (packet.valid and packet.pid in ANSWERS):
+            return
+        bits = packet.turnaround / BIT_TIME_NS
+        endp = packet.token.endp if packet.token is not None else None
+        self.samples.setdefault((packet.name, endp), []).append(bits)
+        if bits > self.limit_bits:
+            raise TestFailure(
+                "Device answered {} after {:.2f} bit times, limit is "
+                "{}".format(packet.name, bits, self.limit_bits))
+
+    def report(self, result):
+        """at_test_end() callback: saves the samples of the test and returns
+        their summary as results.xml properties"""
+        if not self.samples:
+            return {}
+        if self.samples_file:
+            with open(self.samples_file, 'a') as f:
+                f.write(json.dumps({
+                    'target': self.target,
+                    'test': result['test'],
+                    'samples': [[pid, endp, values] for (pid, endp), values
+                                in self.samples.items()],
+                }) + "\n")
+        return {
+            'turnaround_{}_ep{}'.format(pid, '' if endp is None else endp):
+            format_summary(values)
+            for (pid, endp), values in sorted(self.samples.items(),
+                                              key=str)
+        }
@@ -0,0 +1,113 @@
+"""Frame-level bus utilization
+
+Splits the packets decoded by the bus monitor into frames starting with an
+SOF packet and sums the time the bus spent on each kind of packet. All
+packets of a transaction the device answered with NAK count as NAK
+retries. The rest of a frame is idle time.
+"""
+
+import csv
+import os
+
+from cocotb.utils import get_sim_time
+from cocotb_usb.usb.pid import PID
+
+CATEGORIES = ('sof', 'token', 'data', 'handshake', 'nak', 'other')
+COLUMNS = ('target', 'test', 'frame', 'start_us', 'duration_us') + tuple(
+    category + '_us' for category in CATEGORIES) + (
+    'idle_us', 'transactions', 'naks')
+
+HANDSHAKES = (PID.ACK, PID.NAK, PID.STALL)
+
+
+def classify(packets):
+    """Returns the category of each packet"""
+    categories = []
+    transaction = []
+    for packet in packets:
+        if packet.is_token or (packet.valid and packet.pid == PID.SOF):
+            transaction = []
+        if not packet.valid:
+            category = 'other'
+        elif packet.pid == PID.SOF:
+            category = 'sof'
+        elif packet.is_token:
+            category = 'token'
+        elif packet.is_data:
+            category = 'data'
+        elif packet.pid in HANDSHAKES:
+            category = 'handshake'
+        else:
+            category = 'other'
+        categories.append(category)
+        transaction.append(len(categories) - 1)
+        if packet.valid and packet.pid == PID.NAK and packet.token:
+            # The whole transaction was spent on nothing
+            for index in transaction:
+                categories[index] = 'nak'
+    return categories
+
+
+def frames(packets, end):
+    """Returns one dictionary of COLUMNS per frame. Traffic before the
+    first SOF is reported as frame -1."""
+    rows = []
+    row = None
+    for packet, category in zip(packets, classify(packets)):
+        if category == 'sof' or row is None:
+            if row is not None:
+                rows.append(row)
+            row = dict.fromkeys(CATEGORIES, 0.0)
+            row.update(frame=-1, start=packet.start, transactions=0, naks=0)
+            if category == 'sof':
+                row['frame'] = packet.data[0] | (packet.data[1] & 0x7) << 8
+        row[category] += packet.end - packet.start
+        if packet.is_token:
+            row['transactions'] += 1
+        if packet.valid and packet.pid == PID.NAK:
+            row['naks'] += 1
+    if row is not None:
+        rows.append(row)
+
+    for row, following in zip(rows, rows[1:] + [None]):
+        row_end = following['start'] if following else max(end, row['start'])
+        row['duration'] = row_end - row['start']
+        row['idle'] = row['duration'] - sum(row[c] for c in CATEGORIES)
+    return rows
+
+
+class UtilizationReport:
+    def __init__(self, monitor, target, directory):
+        self.monitor = monitor
+        self.target = target
+        self.directory = directory
+
+    def report(self, result):
+        """at_test_end() callback: writes the frames of the test to a CSV
+        file and returns the shares of the bus time as results.xml
+        properties"""
+        rows = frames(self.monitor.packets, get_sim_time('ns'))
+        if not rows:
+            return {}
+        test = result['test']
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory,
+                            "{}-{}.csv".format(self.target, test))
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            for row in rows:
+                writer.writerow(
+                    [self.target, test, row['frame'],
+                     "{:.3f}".format(row['start'] / 1e3),
+                     "{:.3f}".format(row['duration'] / 1e3)] +
+                    ["{:.3f}".format(row[c] / 1e3) for c in CATEGORIES] +
+                    ["{:.3f}".format(row['idle'] / 1e3),
+                     row['transactions'], row['naks']])
+
+        total = sum(row['duration'] for row in rows)
+        properties = {'utilization_frames': len(rows)}
+        for category in CATEGORIES + ('idle',):
+            share = sum(row[category] for row in rows) / total if total else 0
+            properties['utilization_' + category] = "{:.4f}".format(share)
+        return properties
@@ -0,0 +1,73 @@
+"""Per-test watchdog aborting hung simulations
+
+A test that waits forever for the DUT (e.g. a token that is never answered)
+would otherwise keep the simulator running until it is killed. The watchdog
+fails the test once it exceeds either its simulated time or its wall-clock
+budget, so the regression moves on to the next test.
+"""
+
+import re
+import time
+
+import cocotb
+from cocotb.result import TestFailure
+from cocotb.triggers import Timer
+from cocotb.utils import get_sim_time
+
+# How often the limits are checked, in simulated microseconds
+CHECK_PERIOD_US = 100
+
+# Registers added to every FSM by add_fsm_state_names() in the wrappers
+_STATE_NAME = re.compile(r'(?<!next_)state_name\d*$')
+
+
+def fsm_states(dut):
+    """Returns {signal name: current state name} of the FSMs in the DUT"""
+    states = {}
+    for handle in dut.dut:
+        if not _STATE_NAME.search(handle._name):
+            continue
+        value = handle.value
+        if not value.is_resolvable:
+            continue
+        raw = value.integer.to_bytes((len(value) + 7) // 8, byteorder="big")
+        states[handle._name] = raw.lstrip(b'\0').decode('ascii', 'replace')
+    return states
+
+
+def dump_state(harness):
+    """Log the latest harness primitives and the FSM states of the DUT"""
+    log = harness.dut._log
+    log.error("Last {} harness calls:".format(len(harness.history)))
+    for sim_time, name, args in harness.history:
+        log.error("  {:>14.3f} us  {}{}".format(
+            sim_time / 1e3, name, repr(args)[:120]))
+    states = fsm_states(harness.dut)
+    if states:
+        log.error("FSM states:")
+        for name in sorted(states):
+            log.error("  {}: {}".format(name, states[name]))
+
+
+@cocotb.coroutine
+def watchdog(harness, sim_limit_ms, wall_limit_s):
+    start_sim_us = get_sim_time('us')
+    start_wall = time.time()
+    while True:
+        yield Timer(CHECK_PERIOD_US, 'us')
+        sim_ms = (get_sim_time('us') - start_sim_us) / 1e3
+        wall_s = time.time() - start_wall
+        if sim_limit_ms and sim_ms > sim_limit_ms:
+            reason = "{:.1f} ms of simulated time".format(sim_ms)
+        elif wall_limit_s and wall_s > wall_limit_s:
+            reason = "{:.0f} s of wall-clock time".format(wall_s)
+        else:
+            continue
+        dump_state(harness)
+        raise TestFailure("Watchdog: test still running after " + reason)
+
+
+def start_watchdog(harness, sim_limit_ms=0, wall_limit_s=0):
+    """Fork the watchdog for the current test. A limit of 0 disables it."""
+    if sim_limit_ms or wall_limit_s:
+        cocotb.fork(watchdog(harness, sim_limit_ms, wall_limit_s))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# Runs tests/test-benchmark.py on the given targets and tracks the results
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+TARGETS = ['valentyusb', 'usb1device', 'foboot', 'tntusb', 'tinyfpgabl']
+
+# Metrics compared against the baseline. True if higher is better.
+METRICS = {
+    'build_s': False,
+    'startup_s': False,
+    'peak_rss_kb': False,
+    'waves_bytes': False,
+}
+SCENARIO_METRICS = {
+    'sim_us_per_s': True,
+}
+
+
+def measure(cmd):
+    """Run `cmd` in a child process, returns (wall time, peak RSS in kB).
+
+    The child only waits for `cmd`, so its RUSAGE_CHILDREN covers this
+    command alone and not the ones run before."""
+    probe = ("import json, resource, subprocess, sys, time\n"
+             "start = time.time()\n"
+             "ret = subprocess.call(sys.argv[1:], stdout=sys.stderr)\n"
+             "usage = resource.getrusage(resource.RUSAGE_CHILDREN)\n"
+             "print(json.dumps([ret, time.time() - start, usage.ru_maxrss]))")
+    out = subprocess.check_output([sys.executable, '-c', probe] + cmd)
+    ret, wall, maxrss = json.loads(out)
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+    return wall, maxrss
+
+
+def read_results(results):
+    """Returns {test: (sim time in ns, wall time in s)} from results.xml"""
+    scenarios = {}
+    for testcase in ET.parse(results).getroot().iter('testcase'):
+        if testcase.find('failure') is not None:
+            raise RuntimeError("benchmark scenario {} failed".format(
+                testcase.get('name')))
+        scenarios[testcase.get('name')] = (float(testcase.get('sim_time_ns')),
+                                           float(testcase.get('time')))
+    return scenarios
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run_target(target, coverage=False):
+    make = ['make', 'TARGET=' + target]
+    results = os.path.abspath('benchmark-{}.xml'.format(target))
+
+    # Some targets fail to clean files that are not there yet
+    subprocess.call(make + ['clean'], stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL)
+    build_s, _ = measure(make + [os.path.abspath('dut.v')])
+    # The simulator is compiled by the `sim` target, so that is part of the
+    # startup time
+    sim_s, peak_rss_kb = measure(
+        make + ['TEST_SCRIPT=test-benchmark', 'WAVES=1', 'PROFILE=0',
+                'COCOTB_RESULTS_FILE=' + results, 'sim'])
+
+    scenarios = {}
+    tests_s = 0
+    for name, (sim_ns, real_s) in read_results(results).items():
+        tests_s += real_s
+        scenarios[name] = {
+            'sim_ns': sim_ns,
+            'real_s': real_s,
+            'sim_us_per_s': sim_ns / 1e3 / real_s if real_s else 0,
+        }
+
+    if coverage:
+        # Same scenarios with the bus monitor and the coverage counts, the
+        # coverage files go out of the way of the ones of the tests
+        coverage_results = os.path.abspath(
+            'benchmark-{}-coverage.xml'.format(target))
+        measure(make + ['TEST_SCRIPT=test-benchmark', 'WAVES=1', 'PROFILE=0',
+                        'COVERAGE=1',
+                        'COVERAGE_DIR=' + os.path.abspath(
+                            'benchmark-coverage'),
+                        'COCOTB_RESULTS_FILE=' + coverage_results, 'sim'])
+        for name, (_, real_s) in read_results(coverage_results).items():
+            reference = scenarios[name]['real_s']
+            scenarios[name]['coverage_overhead'] = \
+                real_s / reference - 1 if reference else 0
+
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'target': target,
+        'build_s': build_s,
+        'startup_s': sim_s - tests_s,
+        'peak_rss_kb': peak_rss_kb,
+        'waves_bytes': os.path.getsize('dump.vcd')
+        if os.path.exists('dump.vcd') else 0,
+        'scenarios': scenarios,
+    }
+
+
+def regressions(record, baseline, threshold):
+    """Returns descriptions of metrics that got worse than `baseline` by
+    more than `threshold` (relative)"""
+    found = []
+
+    def compare(name, value, reference, higher_is_better):
+        if not reference:
+            return
+        change = (value - reference) / reference
+        worse = -change if higher_is_better else change
+        if worse > threshold:
+            found.append("{}: {:.6g} -> {:.6g} ({:+.0%})".format(
+                name, reference, value, change))
+
+    for metric, higher_is_better in METRICS.items():
+        compare(metric, record[metric], baseline.get(metric), higher_is_better)
+    for scenario, values in record['scenarios'].items():
+        reference = baseline.get('scenarios', {}).get(scenario, {})
+        for metric, higher_is_better in SCENARIO_METRICS.items():
+            compare(scenario + '.' + metric, values[metric],
+                    reference.get(metric), higher_is_better)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure simulation performance of the targets")
+    parser.add_argument('--targets',
+                        metavar='TARGET',
+                        nargs='+',
+                        default=['valentyusb'],
+                        choices=TARGETS,
+                        help='Targets to benchmark (default: valentyusb)')
+    parser.add_argument('--history',
+                        metavar='FILE',
+                        default='benchmark-history.jsonl',
+                        help='File the results are appended to, one JSON '
+                        'object per line (default: %(default)s)')
+    parser.add_argument('--baseline',
+                        metavar='FILE',
+                        default='benchmark-baseline.json',
+                        help='Results to compare against '
+                        '(default: %(default)s)')
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help='Store the results of this run as the baseline')
+    parser.add_argument('--coverage-overhead',
+                        action='store_true',
+                        help='Run the scenarios again with COVERAGE=1 and '
+                        'report the extra wall-clock time')
+    parser.add_argument('--threshold',
+                        metavar='FRACTION',
+                        type=float,
+                        default=0.2,
+                        help='Relative change reported as a regression '
+                        '(default: %(default)s)')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    found = []
+    for target in args.targets:
+        start = time.time()
+        record = run_target(target, args.coverage_overhead)
+        print("{}: build {:.1f} s, startup {:.1f} s, peak RSS {} kB, "
+              "waves {} bytes ({:.0f} s)".format(
+                  target, record['build_s'], record['startup_s'],
+                  record['peak_rss_kb'], record['waves_bytes'],
+                  time.time() - start))
+        for name, values in sorted(record['scenarios'].items()):
+            print("  {}: {:.1f} sim us/s{}".format(
+                name, values['sim_us_per_s'],
+                ", coverage {:+.1%}".format(values['coverage_overhead'])
+                if 'coverage_overhead' in values else ''))
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+        if args.save_baseline:
+            baseline[target] = record
+        elif target in baseline:
+            for regression in regressions(record, baseline[target],
+                                          args.threshold):
+                found.append("{} {}".format(target, regression))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+
+    for regression in found:
+        print("REGRESSION " + regression)
+    if found:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
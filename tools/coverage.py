@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Merges the coverage files written with COVERAGE=1 and lists the holes
+
+import argparse
+import glob
+import json
+import os
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from tests.coverage import GROUPS, bin_name, legal_bins  # noqa: E402
+
+
+def read_counts(paths):
+    """Returns {target: {group: counts}} summed over the files"""
+    merged = defaultdict(lambda: {name: [0] * size
+                                  for name, size in GROUPS.items()})
+    for path in paths:
+        with open(path, 'r') as f:
+            shard = json.load(f)
+        target = merged[shard['target']]
+        for group, counts in shard['counts'].items():
+            target[group] = [a + b for a, b in zip(target[group], counts)]
+    return merged
+
+
+def target_endpoints(target):
+    """{(number, direction)} of the endpoints in the target descriptors"""
+    endpoints = {(0, 'in'), (0, 'out')}
+    path = 'configs/{}_descriptors.json'.format(target)
+    if not os.path.exists(path):
+        return endpoints
+    with open(path, 'r') as f:
+        descriptors = json.load(f)
+
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+        elif isinstance(node, dict):
+            if node.get('name') == 'Endpoint':
+                address = node['bEndpointAddress']
+                if isinstance(address, list):
+                    endpoints.add((address[0], address[1].lower()))
+                else:
+                    address = int(address, 0) \
+                        if isinstance(address, str) else address
+                    endpoints.add((address & 0xf,
+                                   'in' if address & 0x80 else 'out'))
+            for value in node.values():
+                walk(value)
+
+    walk(descriptors)
+    return endpoints
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge coverage counts and report the bins not hit")
+    parser.add_argument('files',
+                        metavar='FILE',
+                        nargs='*',
+                        help='Coverage files (default: coverage/*.json)')
+    parser.add_argument('--targets',
+                        metavar='TARGET',
+                        nargs='+',
+                        help='Only report these targets')
+    parser.add_argument('--counts',
+                        action='store_true',
+                        help='Also list the bins hit with their counts')
+    args = parser.parse_args()
+
+    paths = args.files or sorted(glob.glob('coverage/*.json'))
+    if not paths:
+        sys.exit("No coverage files, run the tests with COVERAGE=1")
+
+    for target, groups in sorted(read_counts(paths).items()):
+        if args.targets and target not in args.targets:
+            continue
+        endpoints = target_endpoints(target)
+        print(target or '(no target)')
+        for group, counts in groups.items():
+            bins = legal_bins(group, endpoints)
+            holes = [index for index in bins if not counts[index]]
+            print("  {:10} {:4} of {:4} bins hit ({:.0%})".format(
+                group, len(bins) - len(holes), len(bins),
+                1 - len(holes) / len(bins) if bins else 1))
+            for index in holes:
+                print("    hole: " + bin_name(group, index))
+            if args.counts:
+                for index, count in enumerate(counts):
+                    if count:
+                        print("    {:8} {}".format(count,
+                                                   bin_name(group, index)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Shows the enumeration latency history written by the enumeration tests
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+
+
+def read_history(path):
+    """Returns {(target, profile): [record]} in the order of the runs"""
+    runs = defaultdict(list)
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                runs[(record['target'], record['profile'])].append(record)
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the enumeration latency per target and host "
+        "profile")
+    parser.add_argument('history',
+                        metavar='FILE',
+                        nargs='?',
+                        default='enumeration.jsonl',
+                        help='History written by the tests '
+                        '(default: %(default)s)')
+    parser.add_argument('--last',
+                        metavar='N',
+                        type=int,
+                        default=5,
+                        help='Number of runs shown per target and profile '
+                        '(default: %(default)s)')
+    parser.add_argument('--requests',
+                        action='store_true',
+                        help='Show the requests of the latest run')
+    parser.add_argument('--threshold',
+                        metavar='FRACTION',
+                        type=float,
+                        default=0.1,
+                        help='Slowdown of the latest run against the previous '
+                        'one reported as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    regressions = []
+    for (target, profile), records in sorted(read_history(args.history)
+                                             .items()):
+        print("{} / {}".format(target, profile))
+        shown = records[-args.last:]
+        previous = records[-len(shown) - 1] \
+            if len(records) > len(shown) else None
+        for record in shown:
+            change = ""
+            if previous is not None and previous['enumeration_us']:
+                change = "{:+.1%}".format(
+                    record['enumeration_us'] / previous['enumeration_us'] - 1)
+            print("  {:19} {:12.1f} us {:5} NAKs {:>7}".format(
+                record['date'], record['enumeration_us'], record['naks'],
+                change).rstrip())
+            previous = record
+        if len(records) > 1:
+            latest, before = records[-1], records[-2]
+            if before['enumeration_us'] and latest['enumeration_us'] > \
+                    before['enumeration_us'] * (1 + args.threshold):
+                regressions.append("{} / {}".format(target, profile))
+        if args.requests:
+            for request in records[-1]['requests']:
+                print("    {:30} at {:10.1f} us took {:8.1f} us, {} NAKs"
+                      .format(request['request'], request['start_us'],
+                              request['duration_us'], request['naks']))
+
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Runs the descriptor fetch, enumeration and control transfer tests with
+# every EP0 max packet size the targets support
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+
+from benchmark import git_revision
+from set_ep0_size import EP0_SIZES
+
+# Targets where the harness plays the firmware, so EP0 size is not fixed by
+# the design
+FIRMWARE_TARGETS = ['valentyusb']
+
+
+def native_size(target):
+    """bMaxPacketSize0 of the descriptor file of `target`"""
+    with open('configs/{}_descriptors.json'.format(target), 'r') as f:
+        descriptors = json.load(f)
+    for descriptor in descriptors:
+        if descriptor.get('name') == 'Device':
+            return descriptor['bMaxPacketSize0']
+    raise ValueError("No device descriptor for " + target)
+
+
+def read_testcases(results):
+    """Returns {test: (passed, properties)} from results.xml"""
+    testcases = {}
+    for testcase in ET.parse(results).getroot().iter('testcase'):
+        properties = {prop.get('name'): prop.get('value')
+                      for prop in testcase.iter('property')}
+        passed = testcase.find('failure') is None and \
+            testcase.find('error') is None
+        testcases[testcase.get('name')] = (passed, properties)
+    return testcases
+
+
+def run(target, size, test):
+    results = os.path.abspath('ep0-{}-{}-{}.xml'.format(target, size, test))
+    if os.path.exists(results):
+        os.remove(results)
+    subprocess.call(['make', 'TARGET=' + target, 'EP0_SIZE={}'.format(size),
+                     'TEST_SCRIPT=' + test, 'WAVES=0',
+                     'COCOTB_RESULTS_FILE=' + results, 'sim'])
+    if not os.path.exists(results):
+        return {'{}:build'.format(test): (False, {})}
+    return {'{}:{}'.format(test, name): value
+            for name, value in read_testcases(results).items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare control transfers across EP0 max packet sizes")
+    parser.add_argument('--targets',
+                        metavar='TARGET',
+                        nargs='+',
+                        default=['valentyusb'],
+                        help='Targets (default: %(default)s)')
+    parser.add_argument('--sizes',
+                        metavar='SIZE',
+                        nargs='+',
+                        type=int,
+                        choices=EP0_SIZES,
+                        default=EP0_SIZES,
+                        help='EP0 max packet sizes (default: %(default)s)')
+    parser.add_argument('--tests',
+                        metavar='TEST_SCRIPT',
+                        nargs='+',
+                        default=['test-ep0', 'test-enum'],
+                        help='Test scripts run for every size '
+                        '(default: %(default)s)')
+    parser.add_argument('--output',
+                        metavar='FILE',
+                        default='ep0sweep.jsonl',
+                        help='File the results are appended to, one JSON '
+                        'object per line (default: %(default)s)')
+    args = parser.parse_args()
+
+    for target in args.targets:
+        sizes = args.sizes
+        if target not in FIRMWARE_TARGETS:
+            sizes = [native_size(target)]
+            print("{}: EP0 size fixed by the design, running {} only".format(
+                target, sizes[0]))
+        for size in sizes:
+            testcases = {}
+            for test in args.tests:
+                testcases.update(run(target, size, test))
+            failed = sorted(name for name, (passed, _) in testcases.items()
+                            if not passed)
+            fetches = {}
+            for _, properties in testcases.values():
+                fetches.update({name: value for name, value in
+                                properties.items()
+                                if name.startswith('ep0_')})
+            print("{} EP0 {:2}: {} transactions, {} us in descriptor "
+                  "fetches, {}".format(
+                      target, size, fetches.get('ep0_transactions', '-'),
+                      fetches.get('ep0_us', '-'),
+                      "failed: " + ", ".join(failed) if failed else
+                      "all tests passed"))
+            for name, value in sorted(fetches.items()):
+                if name.endswith('_us') and name != 'ep0_us':
+                    fetch = name[len('ep0_'):-len('_us')]
+                    print("  {:14} {:4} transactions {:>10} us".format(
+                        fetch, fetches[name[:-len('_us')] + '_transactions'],
+                        value))
+            record = {
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'target': target,
+                'ep0_size': size,
+                'failed': failed,
+                'fetches': fetches,
+            }
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Generates a Python register map module from the csr.csv written by LiteX
+
+import argparse
+import csv
+
+HEADER = '''"""CSRs of the {target} DUT
+
+Generated from {source} by tools/generate_regmap.py, do not edit.
+"""
+
+
+class Csr(int):
+    """CSR address carrying its size, width, access mode and the
+    little-endian bytes of the address.
+
+    It is a plain int, so it can be passed to harness.read() and
+    harness.write() directly.
+    """
+
+    def __new__(cls, addr, size, width, mode, le):
+        csr = int.__new__(cls, addr)
+        csr.size = size
+        csr.width = width
+        csr.mode = mode
+        csr.le = le
+        return csr
+
+
+CSR_DATA_WIDTH = {data_width}
+'''
+
+
+def read_csrs(source):
+    """Returns (bases, registers, data width) found in the csr.csv file"""
+    bases = []
+    registers = []
+    data_width = 8
+    with open(source, 'r') as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#'):
+                continue
+            if row[0] == 'csr_base':
+                bases.append((row[1], int(row[2], base=0)))
+            elif row[0] == 'csr_register':
+                registers.append((row[1], int(row[2], base=0), int(row[3]),
+                                  row[4]))
+            elif row[0] == 'constant' and row[1].endswith('csr_data_width'):
+                data_width = int(row[2], base=0)
+    return bases, registers, data_width
+
+
+def generate(source, output, target):
+    bases, registers, data_width = read_csrs(source)
+    lines = [HEADER.format(target=target, source=source,
+                           data_width=data_width)]
+    for name, addr in bases:
+        lines.append("{}_BASE = 0x{:08x}".format(name.upper(), addr))
+    lines.append("")
+    for name, addr, size, mode in registers:
+        le = ", ".join("0x{:02x}".format((addr >> (8 * i)) & 0xff)
+                       for i in range(4))
+        lines.append("{} = Csr(0x{:08x}, {}, {}, '{}', ({}))".format(
+            name.upper(), addr, size, size * data_width, mode, le))
+    with open(output, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a Python register map from csr.csv")
+    parser.add_argument('csr',
+                        metavar='CSR',
+                        help='csr file written by the wrapper script')
+    parser.add_argument('output',
+                        metavar='OUTPUT',
+                        help='Python module to write')
+    parser.add_argument('--target',
+                        metavar='TARGET',
+                        default='',
+                        help='Target name put in the module docstring')
+    args = parser.parse_args()
+    generate(args.csr, args.output, args.target)
+
+
+if __name__ == "__main__":
+    main()
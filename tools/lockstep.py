@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# Runs a test on two targets simulated side by side and compares their answers
+
+import argparse
+import glob
+import os
+import re
+import subprocess
+import sys
+
+from simulate import make, make_variable
+
+# Targets that can be the second DUT: no bus the harness has to drive and no
+# firmware image loaded from the working directory
+SECOND_TARGETS = ('usb1device', 'tinyfpgabl')
+BUILD_DIR = 'build/lockstep'
+MODULE = 'dut_lockstep'
+# Values driven on the inputs of the second DUT the reference testbench has
+# no net for. Targets with other such inputs are rejected.
+UNMATCHED_INPUTS = {
+    # No flash fitted, reads as erased
+    'spiflash_miso': "1'b1",
+}
+
+SECOND_DUT = """// Second DUT of the lockstep run: {target}
+{wires}
+pulldown(b_usb_d_n);
+pulldown(b_usb_d_p);
+// Host traffic of the first bus, idle while the first DUT answers
+assign b_usb_d_p = b_usb_tx_en ? 1'bz : usb_tx_en ? 1'b1 : usb_d_p;
+assign b_usb_d_n = b_usb_tx_en ? 1'bz : usb_tx_en ? 1'b0 : usb_d_n;
+
+{inputs}
+{module} dut_b (
+{ports}
+);
+
+"""
+
+
+def tb_ports(tb):
+    """{name: (direction, width)} of the ports of a testbench"""
+    header = tb[:tb.index(');')]
+    return {name: (direction, width.strip())
+            for direction, width, name in re.findall(
+                r'(input|output|inout)\s+(\[[^\]]*\]\s*)?(\w+)', header)}
+
+
+def dut_connections(tb):
+    """[(port, net)] of the DUT instance of a testbench"""
+    instance = re.search(r'^dut dut \((.*?)^\);', tb, re.M | re.S).group(1)
+    return re.findall(r'\.(\w+)\((\w+)\)', instance)
+
+
+def second_dut(target, reference_tb, tb):
+    """Verilog of the second DUT, connected to the clocks and reset of the
+    reference testbench and to `b_` copies of everything else. Inputs of
+    the second testbench the reference has no net for are driven with
+    UNMATCHED_INPUTS."""
+    shared = {name for name, (direction, _) in tb_ports(reference_tb).items()
+              if direction == 'input'}
+    ports = tb_ports(tb)
+    wires = []
+    inputs = []
+    connections = []
+    for port, net in dut_connections(tb):
+        if net not in shared:
+            direction, width = ports[net]
+            wires.append("wire {}b_{};".format(width + ' ' if width else '',
+                                               net))
+            if direction == 'input':
+                if net not in UNMATCHED_INPUTS:
+                    sys.exit("{} input {} has no counterpart in the "
+                             "reference testbench".format(target, net))
+                inputs.append("assign b_{} = {};".format(
+                    net, UNMATCHED_INPUTS[net]))
+            net = 'b_' + net
+        connections.append("\t.{}({})".format(port, net))
+    return SECOND_DUT.format(target=target, wires="\n".join(wires),
+                             inputs="\n".join(inputs), module=MODULE,
+                             ports=",\n".join(connections))
+
+
+def compile_args(target):
+    """Include directories the target adds to COMPILE_ARGS"""
+    args = make_variable(target, 'COMPILE_ARGS')
+    return ['-I' + path for option, path in zip(args, args[1:])
+            if option == '-I']
+
+
+def build_second(target):
+    """Builds the second DUT and returns the Verilog sources it needs"""
+    make(target, 'clean/dut', 'clean/decode')
+    make(target, os.path.abspath('dut.v'))
+    with open('dut.v', 'r') as f:
+        verilog, count = re.subn(r'^module dut\b', 'module ' + MODULE,
+                                 f.read(), flags=re.M)
+    if count != 1:
+        sys.exit("Expected one dut module in the {} dut.v".format(target))
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    path = os.path.abspath(os.path.join(BUILD_DIR, target + '.v'))
+    with open(path, 'w') as f:
+        f.write(verilog)
+    sources = [path]
+    for pattern in make_variable(target, 'VERILOG_SOURCES'):
+        if os.path.basename(pattern) not in ('dut.v', 'tb.v'):
+            sources += sorted(glob.glob(pattern))
+    return sources
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate two targets side by side with the same host "
+        "traffic and report where their answers differ")
+    parser.add_argument('target',
+                        choices=SECOND_TARGETS,
+                        help='Target compared to the reference')
+    parser.add_argument('--reference',
+                        metavar='TARGET',
+                        default='valentyusb',
+                        help='Target driven and checked by the harness '
+                        '(default: %(default)s)')
+    parser.add_argument('--test',
+                        metavar='SCRIPT',
+                        default='test-enum',
+                        help='Test script (default: %(default)s)')
+    parser.add_argument('variables',
+                        metavar='VAR=VALUE',
+                        nargs='*',
+                        help='Other variables passed to make, e.g. TESTCASE')
+    args = parser.parse_args()
+    if args.reference == args.target:
+        sys.exit("The reference and the compared target must differ")
+
+    with open('wrappers/tb_{}.v'.format(args.target), 'r') as f:
+        tb = f.read()
+    if 'usb_tx_en' not in dict(dut_connections(tb)):
+        sys.exit("{} does not report when it drives the bus".format(
+            args.target))
+    sources = build_second(args.target)
+    include = compile_args(args.target)
+
+    make(args.reference, 'clean/dut', 'clean/decode')
+    make(args.reference, os.path.abspath('dut.v'))
+    with open('tb.v', 'r') as f:
+        reference_tb = f.read()
+    marker = reference_tb.index('  // Dump waves')
+    with open('tb.v', 'w') as f:
+        f.write(reference_tb[:marker] +
+                second_dut(args.target, reference_tb, tb) +
+                reference_tb[marker:])
+    # tb.v is newer now, keep make from rebuilding the reference dut.v
+    os.utime('dut.v')
+
+    try:
+        status = subprocess.call([
+            'make', 'TARGET=' + args.reference, 'LOCKSTEP=' + args.target,
+            'LOCKSTEP_SOURCES=' + ' '.join(sources),
+            'LOCKSTEP_ARGS=' + ' '.join(include),
+            'TEST_SCRIPT=' + args.test
+        ] + args.variables + ['sim'])
+    finally:
+        # Later runs must not pick up the lockstep testbench
+        make(args.reference, 'clean/dut', 'clean/decode')
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
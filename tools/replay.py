@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Replays host captures against a target on persistent simulator servers
+
+import argparse
+import os
+import sys
+
+from simclient import run_jobs, shutdown, start_servers
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from tests.capture import read_capture, select_device  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay USB captures (pcap or pcapng from usbmon, "
+        "USBPcap or `make decode`) and compare the device answers")
+    parser.add_argument('captures',
+                        metavar='CAPTURE',
+                        nargs='+',
+                        help='Capture files')
+    parser.add_argument('--target',
+                        metavar='TARGET',
+                        default='usb1device',
+                        help='Target (default: %(default)s, valentyusb '
+                        'answers control IN requests with the captured data '
+                        'and leaves the data endpoints unchecked)')
+    parser.add_argument('--time-scale',
+                        metavar='SCALE',
+                        type=float,
+                        default=1,
+                        help='Factor applied to the captured times, 0 sends '
+                        'the transfers back to back (default: %(default)s)')
+    parser.add_argument('--device',
+                        metavar='BUS.ADDRESS',
+                        help='Device to replay (default: the one with the '
+                        'most transfers in each capture)')
+    parser.add_argument('--workers',
+                        metavar='N',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Simulator servers (default: number of CPUs)')
+    parser.add_argument('--strict',
+                        action='store_true',
+                        help='Fail the captures where an answer differs')
+    parser.add_argument('--list',
+                        action='store_true',
+                        help='Only print the transfers that would be '
+                        'replayed')
+    args = parser.parse_args()
+
+    if args.list:
+        for path in args.captures:
+            print(path)
+            for urb in select_device(read_capture(path), args.device):
+                print("  {} {}".format(urb, urb.status))
+        return
+
+    env = {'REPLAY_TIME_SCALE': str(args.time_scale),
+           'REPLAY_DEVICE': args.device or '',
+           'REPLAY_STRICT': '1' if args.strict else '0'}
+    jobs = [{'module': 'tests.test-replay',
+             'test': 'test_replay',
+             'env': dict(env, REPLAY_FILE=os.path.abspath(path))}
+            for path in args.captures]
+    failed = []
+
+    def report(job, result):
+        path = job['env']['REPLAY_FILE']
+        if result['pass'] is False:
+            failed.append(path)
+            print("FAIL {} {}".format(path, result.get('error', '')).rstrip())
+        else:
+            print("PASS {}".format(path))
+        sys.stdout.flush()
+
+    servers = start_servers(min(args.workers, len(jobs)),
+                            ['TARGET=' + args.target])
+    sockets = [socket for socket, _ in servers]
+    try:
+        run_jobs(sockets, jobs, report)
+    finally:
+        shutdown(sockets)
+        for _, process in servers:
+            process.wait()
+
+    print("{} of {} captures failed".format(len(failed), len(jobs)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
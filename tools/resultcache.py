@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# Runs test scripts, reusing the results of those whose inputs did not change
+
+import argparse
+import ast
+import datetime
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+
+from benchmark import git_revision
+from simulate import make, make_variable, run
+
+TESTS_DIR = 'tests'
+# The options part of the key are derived from the sources: the environment
+# variables the test script and its helper modules read, the variables the
+# Makefiles let the environment set or test, and the cocotb ones below.
+# Those naming where results go, and those make sets itself from TARGET and
+# TEST_SCRIPT, are left out.
+COCOTB_OPTIONS = ('TESTCASE', 'RANDOM_SEED')
+OUTPUT_OPTIONS = (
+    'COCOTB_RESULTS_FILE', 'COVERAGE_DIR', 'ENUMERATION_HISTORY',
+    'PROFILE_FILE', 'SIM_SERVER', 'TURNAROUND_FILE', 'UTILIZATION_DIR',
+    'WAVES',
+)
+MAKE_OPTIONS = ('MODULE', 'TARGET', 'TARGET_CONFIG')
+# Variables assigned with ?= or tested with ifeq/ifneq in a Makefile
+MAKEFILE_OPTION = re.compile(
+    r'^\s*(\w+)\s*\?=|^\s*ifn?eq\s*\(\$\((\w+)\)', re.M)
+# Options naming a file whose contents are part of the key
+FILE_OPTIONS = ('REPLAY_FILE',)
+# Memory images written next to dut.v by the target generators
+MEMORY_IMAGES = 'build/gateware/*.init'
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def local_imports(path):
+    """Paths of the tests.* modules imported by the module at `path`"""
+    with open(path, 'r') as f:
+        tree = ast.parse(f.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.add(node.module)
+    paths = set()
+    for name in names:
+        package, _, module = name.partition('.')
+        candidate = os.path.join(TESTS_DIR, module + '.py')
+        if package == TESTS_DIR and os.path.exists(candidate):
+            paths.add(candidate)
+    return paths
+
+
+def test_modules(script):
+    """Paths of the test script and of the helper modules it uses"""
+    pending = [os.path.join(TESTS_DIR, script + '.py')]
+    paths = set()
+    while pending:
+        path = pending.pop()
+        if path in paths:
+            continue
+        paths.add(path)
+        pending += local_imports(path)
+    return sorted(paths)
+
+
+def module_hash(script):
+    """Hash of the test script and of the helper modules it uses"""
+    sources = {path: file_hash(path) for path in test_modules(script)}
+    return hashlib.sha256(json.dumps(sources, sort_keys=True).encode()) \
+        .hexdigest()
+
+
+def _environ_name(node):
+    """Name of the environment variable `node` reads: os.getenv('X'),
+    environ.get('X') or environ['X'], None for other nodes"""
+    def is_environ(value):
+        return (isinstance(value, ast.Name) and value.id == 'environ') or \
+            (isinstance(value, ast.Attribute) and value.attr == 'environ')
+
+    key = None
+    if isinstance(node, ast.Call) and node.args and \
+            isinstance(node.func, ast.Attribute):
+        if node.func.attr == 'getenv' or \
+                (node.func.attr == 'get' and is_environ(node.func.value)):
+            key = node.args[0]
+    elif isinstance(node, ast.Subscript) and is_environ(node.value):
+        key = node.slice
+        # Python < 3.9 wraps the subscript
+        key = getattr(key, 'value', key) if isinstance(key, ast.Index) \
+            else key
+    if isinstance(key, ast.Constant) and isinstance(key.value, str):
+        return key.value
+    return None
+
+
+def module_options(path):
+    """Environment variables read by the module at `path`"""
+    with open(path, 'r') as f:
+        tree = ast.parse(f.read(), path)
+    return {name for name in map(_environ_name, ast.walk(tree)) if name}
+
+
+def makefile_options(path):
+    with open(path, 'r') as f:
+        return {assigned or tested for assigned, tested in
+                MAKEFILE_OPTION.findall(f.read())}
+
+
+def test_options(target, script):
+    """Names of the options a run of `script` on `target` depends on"""
+    options = set(COCOTB_OPTIONS)
+    for path in test_modules(script):
+        options |= module_options(path)
+    for path in ('Makefile', os.path.join('wrappers', 'Makefile.' + target)):
+        options |= makefile_options(path)
+    return options - set(OUTPUT_OPTIONS) - set(MAKE_OPTIONS)
+
+
+def pattern_hashes(patterns):
+    """{path: hash} of the files matched by `patterns`, a pattern matching
+    nothing is kept with no hash"""
+    hashes = {}
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern))
+        if not paths:
+            hashes[pattern] = None
+        for path in paths:
+            hashes[path] = file_hash(path)
+    return hashes
+
+
+def environment_options(names):
+    """Options among `names` set in the environment, with the hashes of the
+    files they name"""
+    options = {name: value for name, value in os.environ.items()
+               if name in names}
+    for name in FILE_OPTIONS:
+        path = options.get(name)
+        if path:
+            options[name + '_hash'] = file_hash(path) \
+                if os.path.exists(path) else None
+    return options
+
+
+def package_version(*names):
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        return None
+    for name in names:
+        try:
+            return version(name)
+        except PackageNotFoundError:
+            continue
+    return None
+
+
+def cache_key(inputs, script):
+    inputs = dict(inputs, test_module=module_hash(script), script=script,
+                  environment=environment_options(
+                      test_options(inputs['target'], script)))
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()) \
+        .hexdigest()
+
+
+def write_results(path, scripts):
+    """Write all results, cached or not, in the results.xml format"""
+    suites = ET.Element('testsuites')
+    suite = ET.SubElement(suites, 'testsuite', name='all')
+    for script, (cached, testcases) in scripts.items():
+        for name, result in sorted(testcases.items()):
+            testcase = ET.SubElement(
+                suite, 'testcase', name=name, classname='tests.' + script,
+                time=repr(result['time']),
+                sim_time_ns=repr(result['sim_time_ns']))
+            properties = dict(result['properties'], cached=cached)
+            element = ET.SubElement(testcase, 'properties')
+            for prop, value in sorted(properties.items()):
+                ET.SubElement(element, 'property', name=prop,
+                              value=str(value))
+            if not result['pass']:
+                ET.SubElement(testcase, 'failure',
+                              message=result['message'])
+    ET.ElementTree(suites).write(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run test scripts, replaying the cached results of the "
+        "ones whose design sources, memory images, testbench, test sources "
+        "and options, descriptors and cocotb versions did not change")
+    parser.add_argument('tests',
+                        metavar='TEST_SCRIPT',
+                        nargs='+',
+                        help='Test scripts to run')
+    parser.add_argument('--target',
+                        metavar='TARGET',
+                        default='valentyusb',
+                        help='Target (default: %(default)s)')
+    parser.add_argument('--make-arg',
+                        metavar='VAR=VALUE',
+                        dest='make_args',
+                        action='append',
+                        default=[],
+                        help='Variable passed to make, part of the key, can '
+                        'be repeated')
+    parser.add_argument('--cache',
+                        metavar='FILE',
+                        default='result-cache.json',
+                        help='Cache file (default: %(default)s)')
+    parser.add_argument('--results',
+                        metavar='FILE',
+                        default='results-cached.xml',
+                        help='Results of all tests, cached or not, in the '
+                        'results.xml format (default: %(default)s)')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Simulate every test script and refresh the '
+                        'cache')
+    args = parser.parse_args()
+
+    # The key needs the current design
+    make(args.target, os.path.abspath('tb.v'), os.path.abspath('dut.v'),
+         *args.make_args)
+    config = make_variable(args.target, 'TARGET_CONFIG', *args.make_args)[0]
+    if not os.path.exists(config):
+        # Descriptors derived from the target ones (EP0_SIZE)
+        make(args.target, config, *args.make_args)
+    inputs = {
+        'target': args.target,
+        'make_args': sorted(args.make_args),
+        # Defaults of the testbench options
+        'makefile': file_hash('Makefile'),
+        'wrapper_makefile': file_hash(os.path.join(
+            'wrappers', 'Makefile.' + args.target)),
+        'dut': file_hash('dut.v'),
+        'tb': file_hash('tb.v'),
+        # Cores the generated design instantiates
+        'sources': pattern_hashes(make_variable(
+            args.target, 'VERILOG_SOURCES', *args.make_args)),
+        # ROM and RAM contents and the firmware they are built from
+        'images': pattern_hashes([MEMORY_IMAGES] + make_variable(
+            args.target, 'TARGET_DEPS', *args.make_args)),
+        'descriptors': file_hash(config),
+        'cocotb': package_version('cocotb'),
+        'cocotb_usb': package_version('cocotb_usb', 'cocotb-usb'),
+    }
+
+    cache = {}
+    if os.path.exists(args.cache):
+        with open(args.cache, 'r') as f:
+            cache = json.load(f)
+
+    scripts = {}
+    failed = []
+    simulated = 0
+    for script in args.tests:
+        key = cache_key(inputs, script)
+        cached = key in cache and not args.force
+        if cached:
+            testcases = cache[key]['tests']
+        else:
+            simulated += 1
+            testcases = run(args.target, script, args.make_args)
+            if testcases is None:
+                print("FAIL {}: no results, see the make output".format(
+                    script))
+                failed.append(script)
+                continue
+            cache[key] = {
+                'script': script,
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'tests': testcases,
+            }
+            with open(args.cache, 'w') as f:
+                json.dump(cache, f, indent=1, sort_keys=True)
+        scripts[script] = (cached, testcases)
+        for name, result in sorted(testcases.items()):
+            if not result['pass']:
+                failed.append('{}:{}'.format(script, name))
+            print("{} {}{}:{} sim: {:.0f} ns real: {:.2f} s {}".format(
+                'PASS' if result['pass'] else 'FAIL',
+                '(cached) ' if cached else '', script, name,
+                result['sim_time_ns'], result['time'],
+                result['message']).rstrip())
+    sys.stdout.flush()
+
+    write_results(args.results, scripts)
+    print("{} of {} test scripts simulated, {} failures".format(
+        simulated, len(args.tests), len(failed)))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Builds valentyusb with growing endpoint counts and measures build cost,
+# simulation speed and multi-endpoint throughput
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import subprocess
+import xml.etree.ElementTree as ET
+
+from benchmark import git_revision, measure, read_results
+
+# Test case of test-concurrent with control requests answered at once
+TESTCASE = 'run_concurrent_001'
+
+
+def read_properties(results):
+    """Returns the properties of the first test case of results.xml"""
+    testcase = next(ET.parse(results).getroot().iter('testcase'))
+    return {prop.get('name'): prop.get('value')
+            for prop in testcase.iter('property')}
+
+
+def endpoint_count(value):
+    return None if value == 'default' else int(value)
+
+
+def run_variant(variant, endpoints, duration_ms):
+    """Build and simulate `variant` with `endpoints` endpoints (None for the
+    default of the variant). Returns the record of the run, or None if the
+    generator rejected the endpoint count."""
+    make = ['make', 'TARGET=valentyusb', 'VALENTYUSB_VARIANT=' + variant,
+            'VALENTYUSB_ENDPOINTS={}'.format(endpoints or '')]
+    name = '{}-{}ep'.format(variant, endpoints or 'default')
+    results = os.path.abspath('scaling-{}.xml'.format(name))
+
+    subprocess.check_call(make + ['clean/dut'])
+    try:
+        build_s, _ = measure(make + [os.path.abspath('dut.v')])
+    except subprocess.CalledProcessError:
+        return None
+    measure(make + ['TEST_SCRIPT=test-concurrent', 'TESTCASE=' + TESTCASE,
+                    'SCHED_ENDPOINTS={}'.format(endpoints or 0),
+                    'SCHED_DURATION_MS={}'.format(duration_ms),
+                    'WAVES=0', 'PROFILE=0', 'TURNAROUND=0',
+                    'COCOTB_RESULTS_FILE=' + results, 'sim'])
+
+    (sim_ns, real_s), = read_results(results).values()
+    properties = read_properties(results)
+    throughput = {name[len('sched_'):-len('_bytes_per_s')]: float(value)
+                  for name, value in properties.items()
+                  if name.endswith('_bytes_per_s')}
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'variant': variant,
+        'endpoints': endpoints,
+        'build_s': build_s,
+        'dut_bytes': os.path.getsize('dut.v'),
+        'sim_us_per_s': sim_ns / 1e3 / real_s if real_s else 0,
+        'data_bytes_per_s': sum(value for pipe, value in throughput.items()
+                                if pipe != 'ep0'),
+        'throughput': throughput,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure how the valentyusb cores scale with the number "
+        "of endpoints")
+    parser.add_argument('--variants',
+                        metavar='VARIANT',
+                        nargs='+',
+                        default=['eptri', 'epfifo'],
+                        choices=['eptri', 'epfifo'],
+                        help='Endpoint interfaces (default: %(default)s)')
+    parser.add_argument('--endpoints',
+                        metavar='N',
+                        nargs='+',
+                        type=endpoint_count,
+                        default=[None, 1, 2, 4, 8, 16],
+                        help='Endpoint counts, EP0 included, "default" for '
+                        'the one of the variant (default: default 1 2 4 8 '
+                        '16)')
+    parser.add_argument('--duration-ms',
+                        metavar='MS',
+                        type=float,
+                        default=5,
+                        help='Simulated traffic time of every variant '
+                        '(default: %(default)s)')
+    parser.add_argument('--output',
+                        metavar='FILE',
+                        default='scaling.jsonl',
+                        help='File the results are appended to, one JSON '
+                        'object per line (default: %(default)s)')
+    args = parser.parse_args()
+
+    print("{:8} {:>7} {:>9} {:>11} {:>11} {:>14}".format(
+        'variant', 'eps', 'build s', 'dut.v KB', 'sim us/s', 'data bytes/s'))
+    skipped = []
+    for variant, endpoints in itertools.product(args.variants,
+                                                args.endpoints):
+        record = run_variant(variant, endpoints, args.duration_ms)
+        if record is None:
+            skipped.append("{} with {} endpoints: rejected by the "
+                           "generator".format(variant, endpoints))
+            continue
+        print("{:8} {:>7} {:9.1f} {:11.1f} {:11.1f} {:>14}".format(
+            variant, endpoints or 'default', record['build_s'],
+            record['dut_bytes'] / 1024, record['sim_us_per_s'],
+            "{:.0f}".format(record['data_bytes_per_s'])))
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    for line in skipped:
+        print("SKIP " + line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Runs many seeds of tests/test-random.py on persistent simulator servers
+
+import argparse
+import os
+import sys
+
+from simclient import run_jobs, shutdown, start_servers
+from simulate import run
+
+
+def reproduced(target, seed, length):
+    """Whether `seed` fails in a fresh simulation too, None when that
+    simulation gave no results"""
+    testcases = run(target, 'test-random',
+                    ['RANDOM_SEED={}'.format(seed),
+                     'RANDOM_LENGTH={}'.format(length)])
+    if not testcases:
+        return None
+    return not all(result['pass'] for result in testcases.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run constrained-random seeds across CPU cores")
+    parser.add_argument('--target',
+                        metavar='TARGET',
+                        default='valentyusb',
+                        help='Target (default: %(default)s)')
+    parser.add_argument('--seeds',
+                        metavar='N',
+                        type=int,
+                        default=1000,
+                        help='Number of seeds (default: %(default)s)')
+    parser.add_argument('--first-seed',
+                        metavar='SEED',
+                        type=int,
+                        default=0,
+                        help='First seed (default: %(default)s)')
+    parser.add_argument('--length',
+                        metavar='N',
+                        type=int,
+                        default=50,
+                        help='Operations per seed (default: %(default)s)')
+    parser.add_argument('--workers',
+                        metavar='N',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Simulator servers (default: number of CPUs)')
+    parser.add_argument('--failed',
+                        metavar='FILE',
+                        default='failed-seeds.txt',
+                        help='File listing the failing seeds '
+                        '(default: %(default)s)')
+    parser.add_argument('--no-confirm',
+                        dest='confirm',
+                        action='store_false',
+                        help='Do not rerun the failing seeds in a fresh '
+                        'simulation')
+    args = parser.parse_args()
+
+    seeds = range(args.first_seed, args.first_seed + args.seeds)
+    jobs = [{'module': 'tests.test-random',
+             'test': 'test_random',
+             'env': {'RANDOM_SEED': str(seed),
+                     'RANDOM_LENGTH': str(args.length)}}
+            for seed in seeds]
+    failed = []
+    done = []
+
+    def report(job, result):
+        done.append(job)
+        if result['pass'] is False:
+            failed.append(int(job['env']['RANDOM_SEED']))
+            print("FAIL seed {} {}".format(
+                job['env']['RANDOM_SEED'], result.get('error', '')).rstrip())
+        if len(done) % 100 == 0:
+            print("{} of {} seeds run, {} failed".format(
+                len(done), len(jobs), len(failed)))
+        sys.stdout.flush()
+
+    servers = start_servers(args.workers, ['TARGET=' + args.target])
+    sockets = [socket for socket, _ in servers]
+    try:
+        run_jobs(sockets, jobs, report)
+    finally:
+        shutdown(sockets)
+        for _, process in servers:
+            process.wait()
+
+    # Seeds run back to back in a server share the simulator state the
+    # test does not reset (memories of CPU targets), so a failure may come
+    # from the seeds before it
+    status = {}
+    for seed in sorted(failed):
+        if not args.confirm:
+            status[seed] = 'not confirmed'
+            continue
+        again = reproduced(args.target, seed, args.length)
+        status[seed] = {True: 'reproduced', False: 'not reproduced',
+                        None: 'no results'}[again]
+        print("seed {} in a fresh simulation: {}".format(seed, status[seed]))
+        sys.stdout.flush()
+
+    with open(args.failed, 'w') as f:
+        for seed in sorted(failed):
+            f.write("{} {}\n".format(seed, status[seed]))
+    print("{} of {} seeds failed, {} reproduced in a fresh simulation".format(
+        len(failed), len(jobs),
+        sum(value == 'reproduced' for value in status.values())))
+    for seed in sorted(failed):
+        print("  make TARGET={} TEST_SCRIPT=test-random RANDOM_SEED={} "
+              "RANDOM_LENGTH={} sim  # {}".format(args.target, seed,
+                                                  args.length, status[seed]))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
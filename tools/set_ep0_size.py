@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# Writes a copy of a descriptor file with another EP0 max packet size
+
+import argparse
+import json
+
+EP0_SIZES = [8, 16, 32, 64]
+
+
+def set_ep0_size(node, size):
+    """Set bMaxPacketSize0 of the device and device qualifier descriptors"""
+    if isinstance(node, list):
+        for item in node:
+            set_ep0_size(item, size)
+    elif isinstance(node, dict):
+        if 'bMaxPacketSize0' in node:
+            node['bMaxPacketSize0'] = size
+        for value in node.values():
+            set_ep0_size(value, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Change bMaxPacketSize0 in a descriptor file")
+    parser.add_argument('size',
+                        metavar='SIZE',
+                        type=int,
+                        choices=EP0_SIZES,
+                        help='EP0 max packet size: [%(choices)s]')
+    parser.add_argument('source',
+                        metavar='SOURCE',
+                        help='Descriptor file')
+    parser.add_argument('output',
+                        metavar='OUTPUT',
+                        help='Descriptor file written')
+    args = parser.parse_args()
+
+    with open(args.source, 'r') as f:
+        descriptors = json.load(f)
+    set_ep0_size(descriptors, args.size)
+    with open(args.output, 'w') as f:
+        json.dump(descriptors, f, indent=4)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
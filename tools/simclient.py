@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Client for the persistent simulator server (tests/server.py)
+
+import argparse
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client
+
+
+def parse_job(spec):
+    """Turn `test-sof:test_sof_stuffing` into a job dictionary"""
+    module, _, test = spec.partition(':')
+    if not module or not test:
+        raise argparse.ArgumentTypeError(
+            "job should be given as TEST_SCRIPT:TEST, got: " + spec)
+    if not module.startswith('tests.'):
+        module = 'tests.' + module
+    return {'module': module, 'test': test}
+
+
+def start_servers(count, make_args=(), timeout=3600):
+    """Start `count` servers in the current directory.
+
+    Every worker gets its own socket and results file and does not dump
+    waves, so they can share one build. The first worker is started alone
+    to make sure the design is built only once.
+    """
+    servers = []
+    for i in range(count):
+        socket = os.path.abspath('sim-{}.sock'.format(i))
+        if os.path.exists(socket):
+            os.unlink(socket)
+        cmd = ['make', 'serve', 'WAVES=0',
+               'SIM_SERVER=' + socket,
+               'COCOTB_RESULTS_FILE=results-{}.xml'.format(i)]
+        cmd += list(make_args)
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        servers.append((socket, process))
+        if i == 0:
+            wait_for_server(socket, process, timeout)
+    for socket, process in servers[1:]:
+        wait_for_server(socket, process, timeout)
+    return servers
+
+
+def wait_for_server(socket, process, timeout):
+    deadline = time.time() + timeout
+    while not os.path.exists(socket):
+        if process.poll() is not None:
+            raise RuntimeError(
+                "simulator server exited with {}".format(process.returncode))
+        if time.time() > deadline:
+            raise RuntimeError("simulator server did not start in time")
+        time.sleep(0.1)
+
+
+def job_name(job):
+    return '.'.join([job['module'], job['test']])
+
+
+def failed_result(job, error):
+    return {'test': job_name(job), 'pass': False, 'error': error}
+
+
+def run_jobs(sockets, jobs, callback):
+    """Run `jobs` on all servers, calling `callback(job, result)` as the
+    results stream back.
+
+    A job whose server went away is reported as failed and the server is
+    no longer used. Jobs left when no server remains are failed as well."""
+    pending = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    lock = threading.Lock()
+
+    def worker(socket):
+        job = None
+        try:
+            with Client(socket, family='AF_UNIX') as conn:
+                while True:
+                    try:
+                        job = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    conn.send(job)
+                    result = conn.recv()
+                    with lock:
+                        callback(job, result)
+                    job = None
+        except (OSError, EOFError) as e:
+            error = "server {} lost: {!r}".format(socket, e)
+            print(error, file=sys.stderr)
+            if job is not None:
+                with lock:
+                    callback(job, failed_result(job, error))
+
+    threads = [threading.Thread(target=worker, args=(socket,))
+               for socket in sockets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    while not pending.empty():
+        job = pending.get_nowait()
+        callback(job, failed_result(job, "not run, no server left"))
+
+
+def shutdown(sockets):
+    for socket in sockets:
+        with Client(socket, family='AF_UNIX') as conn:
+            conn.send(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run tests on persistent simulator servers")
+    parser.add_argument('jobs',
+                        metavar='JOB',
+                        nargs='*',
+                        type=parse_job,
+                        help='Test to run, as TEST_SCRIPT:TEST')
+    parser.add_argument('--socket',
+                        metavar='SOCKET',
+                        action='append',
+                        help='Server socket, can be repeated '
+                        '(default: sim.sock)')
+    parser.add_argument('--workers',
+                        metavar='N',
+                        type=int,
+                        default=0,
+                        help='Start N servers for this run instead of '
+                        'connecting to running ones')
+    parser.add_argument('--shutdown',
+                        action='store_true',
+                        help='Stop the servers after running the jobs')
+    args = parser.parse_args()
+
+    servers = []
+    if args.workers:
+        servers = start_servers(args.workers)
+        sockets = [socket for socket, _ in servers]
+    else:
+        sockets = args.socket or ['sim.sock']
+
+    failed = []
+
+    def report(job, result):
+        if result['pass'] is None:
+            status = 'SKIP'
+        elif result['pass']:
+            status = 'PASS'
+        else:
+            status = 'FAIL'
+            failed.append(result['test'])
+        print("{} {} sim: {} ns real: {:.2f} s {}".format(
+            status, result['test'], result.get('sim', 0),
+            result.get('real', 0), result.get('error', '')).rstrip())
+        sys.stdout.flush()
+
+    try:
+        run_jobs(sockets, args.jobs, report)
+    finally:
+        if args.shutdown or servers:
+            shutdown(sockets)
+        for _, process in servers:
+            process.wait()
+
+    if failed:
+        print("{} of {} jobs failed".format(len(failed), len(args.jobs)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Runs a test script in a fresh simulation and prints its results. Also
+# holds the make helpers shared by the other tools.
+
+import argparse
+import os
+import subprocess
+import sys
+import xml.etree.ElementTree as ET
+
+
+def make(target, *args):
+    subprocess.check_call(['make', 'TARGET=' + target] + list(args))
+
+
+def make_variable(target, name, *args):
+    output = subprocess.check_output(
+        ['make', '-s', 'TARGET=' + target] + list(args) + ['print-' + name])
+    return output.decode().split()
+
+
+def read_testcases(results):
+    """Returns {test: result} from results.xml"""
+    testcases = {}
+    for testcase in ET.parse(results).getroot().iter('testcase'):
+        failure = testcase.find('failure')
+        if failure is None:
+            failure = testcase.find('error')
+        testcases[testcase.get('name')] = {
+            'pass': failure is None,
+            'sim_time_ns': float(testcase.get('sim_time_ns', 0)),
+            'time': float(testcase.get('time', 0)),
+            'message': failure.get('message', '') if failure is not None
+            else '',
+            'properties': {prop.get('name'): prop.get('value')
+                           for prop in testcase.iter('property')},
+        }
+    return testcases
+
+
+def run(target, script, make_args):
+    """Simulate `script` on `target` with make, in a simulator of its own.
+    Returns {test: result}, or None when the simulation gave no results."""
+    results = os.path.abspath('simulate-{}-{}.xml'.format(target, script))
+    if os.path.exists(results):
+        os.remove(results)
+    subprocess.call(['make', 'TARGET=' + target, 'TEST_SCRIPT=' + script,
+                     'WAVES=0', 'COCOTB_RESULTS_FILE=' + results, 'sim'] +
+                    list(make_args))
+    if not os.path.exists(results):
+        return None
+    testcases = read_testcases(results)
+    os.remove(results)
+    return testcases
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a test script in a fresh simulation")
+    parser.add_argument('script',
+                        metavar='TEST_SCRIPT',
+                        help='Test script to run')
+    parser.add_argument('--target',
+                        metavar='TARGET',
+                        default='valentyusb',
+                        help='Target (default: %(default)s)')
+    parser.add_argument('make_args',
+                        metavar='VAR=VALUE',
+                        nargs='*',
+                        help='Variables passed to make')
+    args = parser.parse_args()
+
+    testcases = run(args.target, args.script, args.make_args)
+    if testcases is None:
+        sys.exit("FAIL {}: no results, see the make output".format(
+            args.script))
+    for name, result in sorted(testcases.items()):
+        print("{} {}:{} {}".format('PASS' if result['pass'] else 'FAIL',
+                                   args.script, name,
+                                   result['message']).rstrip())
+    if not all(result['pass'] for result in testcases.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Builds per-target device turnaround histograms from turnaround.jsonl files
+
+import argparse
+import json
+import math
+import os
+import sys
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from tests.samples import summary  # noqa: E402
+
+
+def read_samples(files):
+    """Returns {target: {(PID name, endpoint): [bit times]}}"""
+    samples = defaultdict(lambda: defaultdict(list))
+    for name in files:
+        with open(name, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                for pid, endp, values in record['samples']:
+                    samples[record['target']][(pid, endp)].extend(values)
+    return samples
+
+
+def histogram(values, bin_bits):
+    bins = defaultdict(int)
+    for value in values:
+        bins[math.floor(value / bin_bits)] += 1
+    width = max(bins.values())
+    lines = []
+    for index in range(min(bins), max(bins) + 1):
+        count = bins.get(index, 0)
+        lines.append("    {:6.2f} {:7} {}".format(
+            index * bin_bits, count,
+            '#' * math.ceil(40 * count / width)).rstrip())
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize device turnaround times per target")
+    parser.add_argument('files',
+                        metavar='FILE',
+                        nargs='*',
+                        default=['turnaround.jsonl'],
+                        help='Samples written by the tests '
+                        '(default: turnaround.jsonl)')
+    parser.add_argument('--histogram',
+                        metavar='BITS',
+                        type=float,
+                        default=0,
+                        help='Also print histograms with bins of BITS bit '
+                        'times')
+    args = parser.parse_args()
+
+    print("{:12} {:8} {:>4} {:>7} {:>6} {:>6} {:>6} {:>6}".format(
+        "target", "pid", "ep", "n", "min", "p50", "p99", "max"))
+    for target, groups in sorted(read_samples(args.files).items()):
+        groups = dict(groups)
+        groups[('all', '')] = [v for values in groups.values()
+                               for v in values]
+        for (pid, endp), values in sorted(groups.items(), key=str):
+            print("{:12} {:8} {:>4} {:7} {:6.2f} {:6.2f} {:6.2f} "
+                  "{:6.2f}".format(target, pid,
+                                   '' if endp is None else endp,
+                                   *summary(values)))
+            if args.histogram:
+                print("\n".join(histogram(values, args.histogram)))
+
+
+if __name__ == "__main__":
+    main()
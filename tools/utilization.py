@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Aggregates the per-frame bus utilization CSV files written by the tests
+
+import argparse
+import csv
+import glob
+import os
+from collections import defaultdict
+
+CATEGORIES = ('sof', 'token', 'data', 'handshake', 'nak', 'other', 'idle')
+
+
+def read_frames(paths):
+    """Returns {(target, test): [row]} of the given CSV files"""
+    tests = defaultdict(list)
+    for path in paths:
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                tests[(row['target'], row['test'])].append(row)
+    return tests
+
+
+def totals(rows):
+    result = defaultdict(float)
+    for row in rows:
+        result['frames'] += 1
+        result['duration'] += float(row['duration_us'])
+        result['transactions'] += int(row['transactions'])
+        result['naks'] += int(row['naks'])
+        for category in CATEGORIES:
+            result[category] += float(row[category + '_us'])
+    return result
+
+
+def format_totals(name, result):
+    duration = result['duration'] or 1
+    return "{:40} {:6.0f} {:10.1f} ".format(
+        name, result['frames'], result['duration']) + " ".join(
+            "{:9.1%}".format(result[c] / duration) for c in CATEGORIES) + \
+        " {:6.0f} {:6.0f}".format(result['transactions'], result['naks'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Summarize the bus utilization per target")
+    parser.add_argument('paths',
+                        metavar='PATH',
+                        nargs='*',
+                        default=['utilization'],
+                        help='CSV files or directories holding them '
+                        '(default: utilization)')
+    parser.add_argument('--tests',
+                        action='store_true',
+                        help='Also print every test')
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths += sorted(glob.glob(os.path.join(path, '*.csv')))
+        else:
+            paths.append(path)
+
+    print("{:40} {:>6} {:>10} ".format("target / test", "frames",
+                                       "time [us]") +
+          " ".join("{:>9}".format(c) for c in CATEGORIES) +
+          " {:>6} {:>6}".format("trans", "naks"))
+    targets = defaultdict(list)
+    for (target, test), rows in sorted(read_frames(paths).items()):
+        targets[target].append((test, rows))
+    for target, tests in sorted(targets.items()):
+        print(format_totals(target, totals(
+            [row for _, rows in tests for row in rows])))
+        if args.tests:
+            for test, rows in tests:
+                print(format_totals("  " + test, totals(rows)))
+
+
+if __name__ == "__main__":
+    main()
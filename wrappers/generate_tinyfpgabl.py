@@ -36,6 +36,12 @@ _io = [
         Subsignal("pullup", Pins(1)),
         Subsignal("tx_en", Pins(1)),
      ),
+    ("spiflash", 0,
+        Subsignal("cs_n", Pins(1)),
+        Subsignal("clk", Pins(1)),
+        Subsignal("mosi", Pins(1)),
+        Subsignal("miso", Pins(1)),
+     ),
     ("clk", 0,
         Subsignal("clk48", Pins(1)),
         Subsignal("clk12", Pins(1)),
@@ -155,6 +161,9 @@ class BaseSoC(SoCCore):
         self.comb += usb_pads.tx_en.eq(usb_tx_en)
         self.comb += usb_pads.pullup.eq(0b1)
 
+        # SPI flash, modelled by tests/spiflash.py
+        spiflash_pads = platform.request("spiflash")
+
         platform.add_source("../tinyfpga/common/tinyfpga_bootloader.v")
         self.specials += Instance("tinyfpga_bootloader",
                                   i_clk_48mhz=self.crg.cd_usb_48.clk,
@@ -165,7 +174,12 @@ class BaseSoC(SoCCore):
                                   o_usb_n_tx=usb_n_tx,
                                   i_usb_p_rx=usb_p_rx,
                                   i_usb_n_rx=usb_n_rx,
-                                  o_usb_tx_en=usb_tx_en
+                                  o_usb_tx_en=usb_tx_en,
+                                  # SPI flash
+                                  o_spi_cs=spiflash_pads.cs_n,
+                                  o_spi_sck=spiflash_pads.clk,
+                                  o_spi_mosi=spiflash_pads.mosi,
+                                  i_spi_miso=spiflash_pads.miso
                                   )
 
 
@@ -31,7 +31,7 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from migen import Module, Signal, ClockDomain
+from migen import Module, Signal, ClockDomain, If
 from migen.fhdl.structure import ResetSignal
 
 from litex.build.sim.platform import SimPlatform
@@ -42,8 +42,10 @@ from litex.soc.interconnect import wishbone
 
 from valentyusb.usbcore import io as usbio
 from valentyusb.usbcore.cpu import dummyusb, eptri, epfifo
+from valentyusb.usbcore.endpoint import EndpointType
 
 import argparse
+import inspect
 
 _io = [
     # Wishbone
@@ -66,6 +68,8 @@ _io = [
         Subsignal("d_n", Pins(1)),
         Subsignal("pullup", Pins(1)),
         Subsignal("tx_en", Pins(1)),
+        Subsignal("irq", Pins(1)),
+        Subsignal("suspend", Pins(1)),
     ),
     (
         "clk",
@@ -139,6 +143,23 @@ def copy_layout_directions(source, target):
         target.layout[i] = (name, width, direction)
 
 
+class _SuspendDetector(Module):
+    """Asserts `suspend` once the bus has stayed idle (J) for `idle_us`,
+    until the next non-idle state"""
+    def __init__(self, iobuf, idle_us=3000):
+        self.suspend = Signal()
+
+        idle_cycles = int(idle_us * 12)
+        counter = Signal(max=idle_cycles + 1)
+        idle = Signal()
+        self.comb += idle.eq(iobuf.usb_p_rx & ~iobuf.usb_n_rx)
+        self.sync.usb_12 += [
+            If(~idle, counter.eq(0), self.suspend.eq(0))
+            .Elif(counter == idle_cycles, self.suspend.eq(1))
+            .Else(counter.eq(counter + 1))
+        ]
+
+
 class BaseSoC(SoCCore):
     SoCCore.csr_map = {
         "ctrl": 0,  # provided by default (optional)
@@ -174,6 +195,7 @@ class BaseSoC(SoCCore):
                  output_dir="build",
                  usb_variant='dummy',
                  cdc=False,
+                 endpoints=None,
                  **kwargs):
         # Disable integrated RAM as we'll add it later
         self.integrated_sram_size = 0
@@ -204,8 +226,10 @@ class BaseSoC(SoCCore):
                                                              debug=True,
                                                              cdc=cdc)
         elif usb_variant == 'epfifo':
-            self.submodules.usb = epfifo.PerEndpointFifoInterface(usb_iobuf,
-                                                                  debug=True)
+            self.submodules.usb = epfifo.PerEndpointFifoInterface(
+                usb_iobuf,
+                debug=True,
+                **_core_options(epfifo.PerEndpointFifoInterface, endpoints))
         elif usb_variant == 'dummy':
             self.submodules.usb = dummyusb.DummyUsb(usb_iobuf,
                                                     debug=True,
@@ -215,6 +239,16 @@ class BaseSoC(SoCCore):
                 'Invalid endpoints value. It is currently \'eptri\'\
                         and \'dummy\''
             )
+        # Expose the interrupt (interrupt_map["usb"]) so that tests can
+        # wait for it instead of polling the pending registers
+        if hasattr(self.usb, "ev"):
+            self.comb += usb_pads.irq.eq(self.usb.ev.irq)
+        else:
+            self.comb += usb_pads.irq.eq(0)
+        # The core has no suspend output, report the suspend condition of
+        # the bus for test-suspend (SUSPEND_SIGNAL)
+        self.submodules.suspend = _SuspendDetector(usb_iobuf)
+        self.comb += usb_pads.suspend.eq(self.suspend.suspend)
         self.add_wb_master(self.usb.debug_bridge.wishbone)
 
         class _WishboneBridge(Module):
@@ -231,6 +265,22 @@ class BaseSoC(SoCCore):
         self.add_wb_master(sim_wishbone)
 
 
+# Variants whose endpoint interface takes the endpoints as a constructor
+# argument, the others have a fixed set of endpoints
+SCALABLE_VARIANTS = ('epfifo',)
+
+
+def _core_options(interface, endpoints):
+    """Constructor arguments setting the number of endpoints (EP0 included)
+    of `interface`"""
+    if endpoints is None:
+        return {}
+    if 'endpoints' not in inspect.signature(interface.__init__).parameters:
+        raise ValueError("{} takes no endpoints argument".format(
+            interface.__name__))
+    return {'endpoints': [EndpointType.BIDIR] * endpoints}
+
+
 def add_fsm_state_names():
     """Hack the FSM module to add state names to the output"""
     from migen.fhdl.visit import NodeTransformer
@@ -299,13 +349,14 @@ def add_fsm_state_names():
     fsm.FSM._lower_controls = my_lower_controls
 
 
-def generate(output_dir, csr_csv, cdc, variant):
+def generate(output_dir, csr_csv, cdc, variant, endpoints=None):
     platform = Platform()
     soc = BaseSoC(platform,
                   usb_variant=variant,
                   cpu_type=None,
                   cpu_variant=None,
                   cdc=cdc,
+                  endpoints=endpoints,
                   output_dir=output_dir)
     builder = Builder(soc,
                       output_dir=output_dir,
@@ -335,10 +386,20 @@ def main():
     parser.add_argument('--cdc',
                         action='store_true',
                         help='Add a fast clock domain to sys for CDC testing')
+    parser.add_argument('--endpoints',
+                        metavar='N',
+                        type=int,
+                        help='Number of endpoints, EP0 included (default: '
+                        'the one of the variant)')
     args = parser.parse_args()
+    if args.endpoints is not None and \
+            args.variant not in SCALABLE_VARIANTS:
+        parser.error("{} has a fixed set of endpoints, --endpoints is only "
+                     "supported by {}".format(args.variant,
+                                              ", ".join(SCALABLE_VARIANTS)))
     add_fsm_state_names()
     output_dir = args.dir
-    generate(output_dir, args.csr, args.cdc, args.variant)
+    generate(output_dir, args.csr, args.cdc, args.variant, args.endpoints)
 
     print("""Simulation build complete.  Output files:
     {}/gateware/dut.v               Source Verilog file. Run this under Cocotb.
@@ -29,8 +29,10 @@ dut dut (
 
   // Dump waves
   initial begin
-    $dumpfile("dump.vcd");
-    $dumpvars(0, tb);
+    if (!$test$plusargs("nodump")) begin
+      $dumpfile("dump.vcd");
+      $dumpvars(0, tb);
+    end
   end
 
 endmodule
@@ -9,6 +9,10 @@ module tb(
 	inout usb_d_n,
 	output usb_pullup,
 	output usb_tx_en,
+	output spiflash_cs_n,
+	output spiflash_clk,
+	output spiflash_mosi,
+	input spiflash_miso,
 	input [4095:0] test_name,
 	output clkdiff
 );
@@ -24,13 +28,19 @@ dut dut (
 	.usb_d_p(usb_d_p),
 	.usb_d_n(usb_d_n),
 	.usb_pullup(usb_pullup),
-	.usb_tx_en(usb_tx_en)
+	.usb_tx_en(usb_tx_en),
+	.spiflash_cs_n(spiflash_cs_n),
+	.spiflash_clk(spiflash_clk),
+	.spiflash_mosi(spiflash_mosi),
+	.spiflash_miso(spiflash_miso)
 );
 
   // Dump waves
   initial begin
-    $dumpfile("dump.vcd");
-    $dumpvars(0, tb);
+    if (!$test$plusargs("nodump")) begin
+      $dumpfile("dump.vcd");
+      $dumpvars(0, tb);
+    end
   end
 
 endmodule
@@ -10,6 +10,8 @@ module tb(
 	inout usb_d_n,
 	output usb_pullup,
 	output usb_tx_en,
+	output usb_irq,
+	output usb_suspend,
 	input [29:0] wishbone_adr,
 	output [31:0] wishbone_datrd,
 	input [31:0] wishbone_datwr,
@@ -38,6 +40,8 @@ dut dut (
 	.usb_d_n(usb_d_n),
 	.usb_pullup(usb_pullup),
 	.usb_tx_en(usb_tx_en),
+	.usb_irq(usb_irq),
+	.usb_suspend(usb_suspend),
 	.wishbone_adr(wishbone_adr),
 	.wishbone_dat_r(wishbone_datrd),
 	.wishbone_dat_w(wishbone_datwr),
@@ -53,8 +57,10 @@ dut dut (
 
   // Dump waves
   initial begin
-    $dumpfile("dump.vcd");
-    $dumpvars(0, tb);
+    if (!$test$plusargs("nodump")) begin
+      $dumpfile("dump.vcd");
+      $dumpvars(0, tb);
+    end
   end
 
 endmodule